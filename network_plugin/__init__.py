@@ -1,9 +1,21 @@
 from IPy import IP
+from cloudify import ctx
 from cloudify import exceptions as cfy_exc
 import collections
+import requests
+import time
 from pyvcloud.schema.vcd.v1_5.schemas.vcloud import taskType
 from vcloud_plugin_common import (wait_for_task, get_vcloud_config,
-                                  is_subscription)
+                                  is_subscription, PollingStrategy,
+                                  invalidate_inventory)
+from vcloud_plugin_common.transport import get_transport
+from vcloud_plugin_common.work_queue import (STATUS_SUCCESS, STATUS_BUSY,
+                                             STATUS_ERROR)
+from network_plugin.gateway_changes import (RecordingGateway,
+                                            ChangeSetStore,
+                                            apply_changes,
+                                            gateway_key)
+from network_plugin.ip_reservations import IpReservationStore
 
 VCLOUD_VAPP_NAME = 'vcloud_vapp_name'
 PUBLIC_IP = 'public_ip'
@@ -14,6 +26,34 @@ DELETE = 2
 
 AssignedIPs = collections.namedtuple('AssignedIPs', 'external internal')
 BUSY_MESSAGE = "The entity gateway is busy completing an operation."
+GATEWAY_TASK_DEADLINE = 10 * 60
+# time to wait for changes of other operations before commit
+GATEWAY_COMMIT_DELAY = 5
+GATEWAY_COMMIT_POLL = 1
+# writer of queue waits for busy gateway instead of operation retry
+GATEWAY_BUSY_TIMEOUT = 5 * 60
+GATEWAY_BUSY_MIN_INTERVAL = 2
+GATEWAY_BUSY_MAX_INTERVAL = 30
+GATEWAY_COMMIT_TIMEOUT = GATEWAY_BUSY_TIMEOUT + 2 * GATEWAY_TASK_DEADLINE
+EXTERNAL_IP_ACTION_API_VERSION = '5.11'
+ALLOCATE_EXTERNAL_IPS = """
+<ExternalIpAddressActionList
+ xmlns="http://www.vmware.com/vcloud/networkservice/1.0">
+<Allocation>
+    <NumberOfExternalIpAddressesToAllocate>{0}</NumberOfExternalIpAddressesToAllocate>
+</Allocation>
+</ExternalIpAddressActionList>
+"""
+DEALLOCATE_EXTERNAL_IPS = """
+<ExternalIpAddressActionList
+ xmlns="http://www.vmware.com/vcloud/networkservice/1.0">
+<Deallocation>
+{0}
+</Deallocation>
+</ExternalIpAddressActionList>
+"""
+# 2 ^ 16 - 1
+MAX_PORT_NUMBER = 65535
 
 
 def check_ip(address):
@@ -41,35 +81,175 @@ def is_ips_in_same_subnet(ips, netmask):
     return len(set(subnets)) == 1
 
 
-def CheckAssignedExternalIp(ip, gateway):
-    if ip in [address.external for address in collectAssignedIps(gateway)]:
+def CheckAssignedExternalIp(ip, gateway, index=None):
+    if index is None:
+        index = NatRuleIndex.from_gateway(gateway)
+    if index.is_external_assigned(ip):
         raise cfy_exc.NonRecoverableError(
             "IP address: {0} already assigned. Gateway has free IP: {1}"
-            .format(ip, getFreeIP(gateway)))
+            .format(ip, getFreeIP(gateway, index)))
 
 
-def CheckAssignedInternalIp(ip, gateway):
-    if ip in [address.internal for address in collectAssignedIps(gateway)]:
+def CheckAssignedInternalIp(ip, gateway, index=None):
+    if index is None:
+        index = NatRuleIndex.from_gateway(gateway)
+    if index.is_internal_assigned(ip):
         raise cfy_exc.NonRecoverableError(
             "VM private IP {0} already has public ip assigned ".format(ip))
 
 
 def collectAssignedIps(gateway):
-    ips = []
-    if gateway:
-        for natRule in gateway.get_nat_rules():
+    return NatRuleIndex.from_gateway(gateway).assigned
+
+
+def nat_rule_key(*values):
+    """
+        case insensitive key of NAT rule fields, ports can be int or string
+    """
+    return tuple(str(value).lower() for value in values)
+
+
+class PortOccupancy(object):
+    """
+        bitmap of used ports, bit n is set when port n is used
+    """
+
+    def __init__(self, ports=()):
+        self._used = 0
+        self.reserve(*ports)
+
+    def reserve(self, *ports):
+        for port in ports:
+            self._used |= 1 << int(port)
+
+    def is_free(self, port):
+        return not (self._used >> int(port)) & 1
+
+    def next_free(self, start, max_port=MAX_PORT_NUMBER):
+        """
+            first free port from start, None if all ports up to
+            max_port are used
+        """
+        start = int(start)
+        free = ~(self._used >> start)
+        port = start + (free & -free).bit_length() - 1
+        return port if port <= max_port else None
+
+    def find_free(self, start, count, max_port=MAX_PORT_NUMBER):
+        """
+            list of count first free ports from start, None if there
+            are not enough free ports
+        """
+        ports = []
+        port = int(start)
+        while len(ports) < count:
+            port = self.next_free(port, max_port)
+            if port is None:
+                return None
+            ports.append(port)
+            port += 1
+        return ports
+
+
+class NatRuleIndex(object):
+    """
+        lookup tables for NAT rules of one gateway snapshot, must be
+        created again after rules of gateway are changed
+    """
+
+    def __init__(self, nat_rules):
+        self.assigned = set()
+        self.by_external = {}
+        self.by_internal = {}
+        self.by_key = {}
+        self.ports = {}
+        for natRule in nat_rules:
             rule = natRule.get_GatewayNatRule()
-            rule_type = natRule.get_RuleType()
-            if rule_type == "DNAT":
-                ips.append(AssignedIPs(rule.get_OriginalIp(),
-                                       rule.get_TranslatedIp()))
-            else:
-                ips.append(AssignedIPs(rule.get_TranslatedIp(),
-                                       rule.get_OriginalIp()))
-    return set(ips)
+            self.add_rule(natRule.get_RuleType(), rule.get_OriginalIp(),
+                          rule.get_OriginalPort(), rule.get_TranslatedIp(),
+                          rule.get_TranslatedPort(), rule.get_Protocol(),
+                          natRule)
+
+    def add_rule(self, rule_type, original_ip, original_port, translated_ip,
+                 translated_port, protocol, natRule=None):
+        """
+            add rule to index, rules planned by operation and not saved
+            yet are represented by tuple of their values
+        """
+        values = (rule_type, original_ip, original_port, translated_ip,
+                  translated_port, protocol)
+        if natRule is None:
+            natRule = values
+        if rule_type == "DNAT":
+            address = AssignedIPs(original_ip, translated_ip)
+        else:
+            address = AssignedIPs(translated_ip, original_ip)
+        self.assigned.add(address)
+        self.by_external.setdefault(address.external, []).append(natRule)
+        self.by_internal.setdefault(address.internal, []).append(natRule)
+        # rule with undefined field is never equal to other rule
+        if all(values):
+            self.by_key.setdefault(
+                nat_rule_key(*values), []).append(natRule)
+            if str(original_port).isdigit():
+                self.port_occupancy(
+                    rule_type, original_ip, translated_ip, translated_port,
+                    protocol).reserve(original_port)
+
+    @classmethod
+    def from_gateway(cls, gateway):
+        return cls(gateway.get_nat_rules() if gateway else [])
+
+    def external_ips(self):
+        return set(self.by_external)
+
+    def is_external_assigned(self, ip):
+        return ip in self.by_external
+
+    def is_internal_assigned(self, ip):
+        return ip in self.by_internal
+
+    def find_rules(self, rule_type, original_ip, original_port,
+                   translated_ip, translated_port, protocol):
+        return self.by_key.get(nat_rule_key(
+            rule_type, original_ip, original_port, translated_ip,
+            translated_port, protocol), [])
+
+    def port_occupancy(self, rule_type, original_ip, translated_ip,
+                       translated_port, protocol):
+        """
+            original ports used by rules with the other fields equal
+        """
+        key = nat_rule_key(rule_type, original_ip, translated_ip,
+                           translated_port, protocol)
+        if key not in self.ports:
+            self.ports[key] = PortOccupancy()
+        return self.ports[key]
+
+    def is_rule_exists(self, rule_type, original_ip, original_port,
+                       translated_ip, translated_port, protocol):
+        return bool(self.find_rules(rule_type, original_ip, original_port,
+                                    translated_ip, translated_port,
+                                    protocol))
+
+
+def get_vm_ip(vca_client, ctx, gateway, connection=None):
+    """
+        IP address of VM in primary routed network, connection is
+        result of get_vm_primary_connection if it is already known
+    """
+    if connection is None:
+        connection = get_vm_primary_connection(vca_client, ctx)
+    if is_network_routed(vca_client, connection['network_name'], gateway):
+        return connection['ip']
+    raise cfy_exc.NonRecoverableError(
+        "Primary network {0} not routed".format(connection['network_name']))
 
 
-def get_vm_ip(vca_client, ctx, gateway):
+def get_vm_primary_connection(vca_client, ctx):
+    """
+        connected primary NIC of VM in vApp of source instance
+    """
     try:
         vappName = get_vapp_name(ctx.source.instance.runtime_properties)
         vdc = vca_client.get_vdc(get_vcloud_config()['vdc'])
@@ -82,14 +262,7 @@ def get_vm_ip(vca_client, ctx, gateway):
         # assume that we have 1 vm per vApp
         for connection in vm_info[0]:
             if connection['is_connected'] and connection['is_primary']:
-                if is_network_routed(vca_client,
-                                     connection['network_name'],
-                                     gateway):
-                    return connection['ip']
-                else:
-                    raise cfy_exc.NonRecoverableError(
-                        "Primary network {0} not routed"
-                        .format(connection['network_name']))
+                return connection
         raise cfy_exc.NonRecoverableError("No connected primary network")
     except IndexError:
         raise cfy_exc.NonRecoverableError("Could not get vm IP address")
@@ -104,9 +277,17 @@ def get_vapp_name(runtime_properties):
 
 
 def save_gateway_configuration(gateway, vca_client):
+    """
+        save services configuration of gateway, return False if gateway
+        is busy. With write queue changes are committed together with
+        changes of other operations.
+    """
+    if isinstance(gateway, RecordingGateway):
+        return _commit_queued(gateway, vca_client)
     task = gateway.save_services_configuration()
     if task:
-        wait_for_task(vca_client, task)
+        wait_for_task(vca_client, task,
+                      PollingStrategy(deadline=GATEWAY_TASK_DEADLINE))
         return True
     else:
         error = taskType.parseString(gateway.response.content, True)
@@ -116,17 +297,211 @@ def save_gateway_configuration(gateway, vca_client):
             raise cfy_exc.NonRecoverableError(error.message)
 
 
-def getFreeIP(gateway):
-    public_ips = set(gateway.get_public_ips())
-    allocated_ips = set([address.external
-                         for address in collectAssignedIps(gateway)])
-    available_ips = public_ips - allocated_ips
+def is_deferred_commit():
+    return bool(get_vcloud_config().get('gateway_deferred_commit'))
+
+
+def is_write_queue():
+    """
+        changes of gateway are saved through queue of the manager,
+        deferred commit always uses the queue
+    """
+    config = get_vcloud_config()
+    return bool(config.get('gateway_write_queue') or
+                config.get('gateway_deferred_commit'))
+
+
+def _commit_queued(gateway, vca_client):
+    """
+        add changes of operation to pending changes of gateway and wait
+        until they are committed, operation that gets lock of gateway
+        becomes writer and commits changes of all waiting operations
+    """
+    if not gateway.changes:
+        return True
+    config = get_vcloud_config()
+    store = get_change_set_store()
+    change_id = gateway.change_id or queue_gateway_changes(gateway, store)
+    # with deferred commit operations wait for changes of each other,
+    # plain write queue commits at once
+    if gateway.deferred or is_deferred_commit():
+        delay = config.get('gateway_commit_delay', GATEWAY_COMMIT_DELAY)
+        if delay:
+            time.sleep(delay)
+    deadline = time.time() + GATEWAY_COMMIT_TIMEOUT
+    while True:
+        result = store.result(gateway.key, change_id)
+        if result is None:
+            with store.lock(gateway.key) as locked:
+                if locked:
+                    _write_pending(vca_client, store, gateway)
+                    result = store.result(gateway.key, change_id)
+        if result is not None:
+            gateway.changes = []
+            gateway.change_id = None
+            if result['status'] == STATUS_SUCCESS:
+                return True
+            if result['status'] == STATUS_BUSY:
+                return False
+            raise cfy_exc.NonRecoverableError(result['message'])
+        if time.time() > deadline:
+            store.discard(gateway.key, change_id)
+            raise cfy_exc.NonRecoverableError(
+                "Changes of gateway {0} were not committed in {1} seconds"
+                .format(gateway.gateway_name, GATEWAY_COMMIT_TIMEOUT))
+        time.sleep(GATEWAY_COMMIT_POLL)
+
+
+def get_change_set_store():
+    return ChangeSetStore(get_vcloud_config().get('gateway_changes_path'))
+
+
+def queue_gateway_changes(gateway, store):
+    """
+        add changes of recording gateway to queue, they are committed
+        by save_gateway_configuration
+    """
+    gateway.change_id = store.add(gateway.key, gateway.changes)
+    return gateway.change_id
+
+
+def get_planning_nat_index(vca_client, recording, store):
+    """
+        NAT rules of gateway together with rules waiting in queue, must
+        be called with planning lock of gateway
+    """
+    pending = store.pending(recording.key)
+    # gateway is requested after pending changes are read, so changes
+    # committed meanwhile are in gateway
+    invalidate_inventory(vca_client)
+    gateway = vca_client.get_gateway(recording.vdc_name,
+                                     recording.gateway_name)
+    index = NatRuleIndex.from_gateway(gateway)
+    for _, changes in pending:
+        for method, args in changes:
+            if method == 'add_nat_rule':
+                index.add_rule(*args)
+    return index
+
+
+def _write_pending(vca_client, store, recording):
+    """
+        commit pending change sets of gateway, while gateway is busy
+        wait with growing interval and commit again together with
+        change sets added meanwhile
+    """
+    strategy = PollingStrategy(deadline=GATEWAY_BUSY_TIMEOUT,
+                               min_interval=GATEWAY_BUSY_MIN_INTERVAL,
+                               max_interval=GATEWAY_BUSY_MAX_INTERVAL)
+    while True:
+        batch = store.pending(recording.key)
+        if not batch:
+            return
+        waiting = 0
+        for change_ids, status, message in _commit_batch(
+                vca_client, recording, batch):
+            if status == STATUS_BUSY and not strategy.is_expired():
+                waiting += len(change_ids)
+                continue
+            store.complete(recording.key, change_ids, status, message)
+            ctx.logger.info("{0} change sets of gateway {1} committed: {2}"
+                            .format(len(change_ids), recording.gateway_name,
+                                    status))
+        if not waiting:
+            return
+        ctx.logger.info("Gateway {0} is busy, {1} change sets wait"
+                        .format(recording.gateway_name, waiting))
+        time.sleep(strategy.next_interval())
+
+
+def _commit_batch(vca_client, recording, batch):
+    """
+        commit change sets with one save, return list of change ids
+        with status and error message. Failed batch is split in halves
+        and they are committed separately, so the error is reported
+        only for failed change sets.
+    """
+    status, message = _commit_change_sets(vca_client, recording, batch)
+    if status != STATUS_ERROR or len(batch) < 2:
+        return [([change_id for change_id, _ in batch], status, message)]
+    middle = len(batch) // 2
+    return (_commit_batch(vca_client, recording, batch[:middle]) +
+            _commit_batch(vca_client, recording, batch[middle:]))
+
+
+def _commit_change_sets(vca_client, recording, batch):
+    """
+        apply change sets to fresh gateway and save it once, return
+        status and error message
+    """
+    # cached gateway can have changes of this operation or of failed
+    # attempt already
+    invalidate_inventory(vca_client)
+    try:
+        gateway = vca_client.get_gateway(recording.vdc_name,
+                                         recording.gateway_name)
+        if not gateway:
+            raise cfy_exc.NonRecoverableError(
+                "Gateway {0}  not found".format(recording.gateway_name))
+        for _, changes in batch:
+            apply_changes(gateway, changes)
+        if save_gateway_configuration(gateway, vca_client):
+            return STATUS_SUCCESS, None
+        return STATUS_BUSY, None
+    except cfy_exc.NonRecoverableError as e:
+        return STATUS_ERROR, str(e)
+
+
+def getFreeIP(gateway, index=None, owner=None):
+    """
+        free public IP of gateway, with owner address is reserved for
+        owner until release_public_ip
+    """
+    if index is None:
+        index = NatRuleIndex.from_gateway(gateway)
+    available_ips = set(gateway.get_public_ips()) - index.external_ips()
+    if owner and available_ips:
+        store, key = _get_ip_reservations(gateway)
+        public_ip = store.reserve(key, sorted(available_ips), owner)
+        if not public_ip:
+            raise cfy_exc.NonRecoverableError(
+                "Can't get public IP address, all free addresses are "
+                "reserved by other operations")
+        return public_ip
     if not available_ips:
         raise cfy_exc.NonRecoverableError(
             "Can't get public IP address")
     return list(available_ips)[0]
 
 
+def is_ip_reservations():
+    return bool(get_vcloud_config().get('public_ip_reservations'))
+
+
+def _get_ip_reservations(gateway):
+    config = get_vcloud_config()
+    store = IpReservationStore(config.get('public_ip_reservations_path'),
+                               config.get('public_ip_reservation_timeout'))
+    return store, gateway_key(config, gateway.get_name())
+
+
+def reservation_owner(ctx):
+    """
+        owner of public IP reservation for relationship operation
+    """
+    return "{0}/{1}".format(ctx.source.instance.id, ctx.target.instance.id)
+
+
+def release_public_ip(gateway, ctx):
+    """
+        release reservation of public IP after NAT rules with it are
+        committed to gateway
+    """
+    if is_ip_reservations():
+        store, key = _get_ip_reservations(gateway)
+        store.release(key, reservation_owner(ctx))
+
+
 def get_network_name(properties):
     if properties.get('use_external_resource'):
         name = properties.get('resource_id')
@@ -175,7 +550,8 @@ def get_ondemand_public_ip(vca_client, gateway, ctx):
     old_public_ips = set(gateway.get_public_ips())
     task = gateway.allocate_public_ip()
     if task:
-        wait_for_task(vca_client, task)
+        wait_for_task(vca_client, task,
+                      PollingStrategy(deadline=GATEWAY_TASK_DEADLINE))
     else:
         raise cfy_exc.NonRecoverableError(
             "Can't get public ip for ondemand service")
@@ -194,28 +570,117 @@ def get_ondemand_public_ip(vca_client, gateway, ctx):
 def del_ondemand_public_ip(vca_client, gateway, ip, ctx):
     task = gateway.deallocate_public_ip(ip)
     if task:
-        wait_for_task(vca_client, task)
+        wait_for_task(vca_client, task,
+                      PollingStrategy(deadline=GATEWAY_TASK_DEADLINE))
         ctx.logger.info("Public IP {0} deallocated".format(ip))
     else:
         raise cfy_exc.NonRecoverableError(
             "Can't deallocate public ip {0} for ondemand service".format(ip))
 
 
-def get_public_ip(vca_client, gateway, service_type, ctx):
+def get_pooled_public_ip(vca_client, gateway, ctx, pool_size, index=None):
+    """
+        on demand public IP from pool of gateway, pool_size addresses
+        are allocated with one task when pool is empty
+    """
+    if index is None:
+        index = NatRuleIndex.from_gateway(gateway)
+    store, key = _get_ip_reservations(gateway)
+    public_ip = store.take_from_pool(
+        key, set(gateway.get_public_ips()) - index.external_ips())
+    if not public_ip:
+        with store.filling(key):
+            # pool could be filled by other operation while we waited
+            invalidate_inventory(vca_client)
+            gateway = vca_client.get_gateways(get_vcloud_config()['vdc'])[0]
+            public_ips = set(gateway.get_public_ips())
+            public_ip = store.take_from_pool(
+                key, public_ips - index.external_ips())
+            if not public_ip:
+                manage_external_ips(vca_client, gateway,
+                                    ALLOCATE_EXTERNAL_IPS.format(pool_size))
+                # update gateway for new IP addresses
+                gateway = vca_client.get_gateways(
+                    get_vcloud_config()['vdc'])[0]
+                new_ips = set(gateway.get_public_ips()) - public_ips
+                store.add_to_pool(key, sorted(new_ips))
+                public_ip = store.take_from_pool(key, new_ips)
+            if not public_ip:
+                raise cfy_exc.NonRecoverableError(
+                    "Can't get new public IP address")
+    ctx.logger.info("Assign public IP {0} from pool".format(public_ip))
+    return public_ip
+
+
+def release_ondemand_public_ip(vca_client, gateway, ip, ctx):
+    """
+        deallocate on demand public IP or return it to pool, all pool
+        is deallocated when no address of it is used
+    """
+    pool_size = get_vcloud_config().get('public_ip_pool_size')
+    if not pool_size:
+        return del_ondemand_public_ip(vca_client, gateway, ip, ctx)
+    store, key = _get_ip_reservations(gateway)
+    surplus = store.return_to_pool(key, ip, pool_size)
+    if surplus:
+        try:
+            manage_external_ips(
+                vca_client, gateway, DEALLOCATE_EXTERNAL_IPS.format(
+                    "\n".join("<ExternalIpAddress>{0}</ExternalIpAddress>"
+                              .format(address) for address in surplus)))
+        except cfy_exc.NonRecoverableError:
+            # keep addresses for next attempt
+            store.add_to_pool(key, surplus)
+            raise
+        ctx.logger.info("Public IPs {0} deallocated".format(surplus))
+    else:
+        ctx.logger.info("Public IP {0} returned to pool".format(ip))
+
+
+def manage_external_ips(vca_client, gateway, body):
+    """
+        run allocation or deallocation of public IPs for gateway as one
+        task
+    """
+    headers = dict(gateway.headers)
+    headers['Accept'] = 'application/*+xml;version={0}'.format(
+        EXTERNAL_IP_ACTION_API_VERSION)
+    href = gateway.me.get_href() + '/action/manageExternalIpAddresses'
+    response = get_transport().put(href, data=body, headers=headers)
+    if response.status_code != requests.codes.ok:
+        raise cfy_exc.NonRecoverableError(
+            "Can't change public ips of gateway: {0}"
+            .format(response.content))
+    task = taskType.parseString(response.content, True)
+    wait_for_task(vca_client, task,
+                  PollingStrategy(deadline=GATEWAY_TASK_DEADLINE))
+
+
+def get_public_ip(vca_client, gateway, service_type, ctx, index=None):
     if is_subscription(service_type):
-        public_ip = getFreeIP(gateway)
+        owner = reservation_owner(ctx) if is_ip_reservations() else None
+        public_ip = getFreeIP(gateway, index, owner)
         ctx.logger.info("Assign external IP {0}".format(public_ip))
     else:
-        public_ip = get_ondemand_public_ip(vca_client, gateway, ctx)
+        pool_size = get_vcloud_config().get('public_ip_pool_size')
+        if pool_size:
+            public_ip = get_pooled_public_ip(vca_client, gateway, ctx,
+                                             pool_size, index)
+        else:
+            public_ip = get_ondemand_public_ip(vca_client, gateway, ctx)
     return public_ip
 
 
-def get_gateway(vca_client, gateway_name):
-    gateway = vca_client.get_gateway(get_vcloud_config()['vdc'],
-                                     gateway_name)
+def get_gateway(vca_client, gateway_name, write_queue=False):
+    config = get_vcloud_config()
+    gateway = vca_client.get_gateway(config['vdc'], gateway_name)
     if not gateway:
         raise cfy_exc.NonRecoverableError(
             "Gateway {0}  not found".format(gateway_name))
+    if write_queue or is_write_queue():
+        gateway = RecordingGateway(gateway,
+                                   gateway_key(config, gateway_name),
+                                   config['vdc'], gateway_name)
     return gateway
 
 
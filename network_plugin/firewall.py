@@ -0,0 +1,441 @@
+# Copyright (c) 2014 GigaSpaces Technologies Ltd. All rights reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+#  * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  * See the License for the specific language governing permissions and
+#  * limitations under the License.
+
+import collections
+
+from IPy import IP
+from pyvcloud.schema.vcd.v1_5.schemas.vcloud import networkType
+
+# protocols in order of pyvcloud ProtocolsType flags
+PROTOCOLS = ("Tcp", "Udp", "Icmp", "Any")
+# fields of pyvcloud FirewallRuleType that are compared to find the same
+# rule on fresh copy of gateway
+GATEWAY_RULE_FIELDS = ('IsEnabled', 'MatchOnTranslate', 'Description',
+                       'Policy', 'IcmpSubType', 'Port',
+                       'DestinationPortRange', 'DestinationIp',
+                       'SourcePort', 'SourcePortRange', 'SourceIp',
+                       'Direction', 'EnableLogging')
+
+FirewallRule = collections.namedtuple(
+    'FirewallRule', 'description action protocol dest_port dest_ip '
+                    'source_port source_ip log')
+
+
+def rule_key(rule):
+    """
+        canonical key of firewall rule: protocol, ports, addresses and
+        action compared case insensitive, description and logging are
+        not part of rule identity
+    """
+    return tuple(str(value).lower() for value in (
+        rule.protocol, rule.dest_port, rule.dest_ip, rule.source_port,
+        rule.source_ip, rule.action))
+
+
+def get_protocol(protocols):
+    """
+        name of protocol for flags of pyvcloud ProtocolsType, "Tcpudp"
+        for Tcp and Udp; other combinations get names that are not
+        equal to any protocol of security group
+    """
+    if protocols is None:
+        return "Any"
+    names = [name for name in PROTOCOLS
+             if getattr(protocols, 'get_' + name)()]
+    if protocols.get_Other():
+        names.append("Other:{0}".format(protocols.get_Other()))
+    if names == ["Tcp", "Udp"]:
+        return "Tcpudp"
+    return "+".join(names) or "Any"
+
+
+def from_gateway_rule(fw_rule):
+    return FirewallRule(fw_rule.get_Description(), fw_rule.get_Policy(),
+                        get_protocol(fw_rule.get_Protocols()),
+                        fw_rule.get_DestinationPortRange(),
+                        fw_rule.get_DestinationIp(),
+                        fw_rule.get_SourcePortRange(),
+                        fw_rule.get_SourceIp(),
+                        fw_rule.get_EnableLogging())
+
+
+def gateway_rule_fields(fw_rule):
+    """
+        fields of pyvcloud FirewallRuleType as dict that can be saved
+        with changes of gateway
+    """
+    fields = dict((name, getattr(fw_rule, 'get_' + name)())
+                  for name in GATEWAY_RULE_FIELDS)
+    protocols = fw_rule.get_Protocols()
+    fields['Protocols'] = dict(
+        (name, getattr(protocols, 'get_' + name)() if protocols else None)
+        for name in PROTOCOLS + ("Other", ))
+    return fields
+
+
+def rule_fields(rule):
+    """
+        fields of new enabled gateway rule for rule of security group
+    """
+    fields = dict.fromkeys(GATEWAY_RULE_FIELDS)
+    fields.update({
+        'IsEnabled': True,
+        'Description': rule.description,
+        'Policy': rule.action,
+        'DestinationPortRange': rule.dest_port,
+        'DestinationIp': rule.dest_ip,
+        'SourcePortRange': rule.source_port,
+        'SourceIp': rule.source_ip,
+        'EnableLogging': rule.log
+    })
+    protocols = ["Tcp", "Udp"] if rule.protocol == "Tcpudp" \
+        else [rule.protocol]
+    fields['Protocols'] = dict(
+        (name, True if name in protocols else None)
+        for name in PROTOCOLS + ("Other", ))
+    return fields
+
+
+def replace_gateway_rules(gateway, removed, added):
+    """
+        remove one gateway rule with the same fields for each item of
+        removed and insert rules with fields of added at place of first
+        removed rule, at the end when nothing is removed. Other rules
+        of gateway are not changed, so disabled rules and rules with
+        protocols that pyvcloud can't express stay as they are.
+    """
+    fw_rules = list(gateway.get_fw_rules())
+    position = None
+    for fields in removed:
+        for i, fw_rule in enumerate(fw_rules):
+            if gateway_rule_fields(fw_rule) == fields:
+                del fw_rules[i]
+                position = i if position is None else min(position, i)
+                break
+    if position is None:
+        position = len(fw_rules)
+    fw_rules[position:position] = [_new_gateway_rule(fields)
+                                   for fields in added]
+    gateway._getFirewallService().set_FirewallRule(fw_rules)
+
+
+def _new_gateway_rule(fields):
+    fields = dict(fields)
+    fields['Protocols'] = networkType.ProtocolsType(**fields['Protocols'])
+    return networkType.FirewallRuleType(**fields)
+
+
+class FirewallRuleIndex(object):
+    """
+        firewall rules of gateway snapshot by canonical key, original
+        pyvcloud rules are kept, so rules that are not changed by
+        operation are never written again
+    """
+
+    def __init__(self, fw_rules):
+        self.by_key = collections.OrderedDict()
+        self._fw_rules = list(fw_rules or [])
+        for fw_rule in self._fw_rules:
+            key = rule_key(from_gateway_rule(fw_rule))
+            self.by_key.setdefault(key, []).append(fw_rule)
+
+    @classmethod
+    def from_gateway(cls, gateway):
+        return cls(gateway.get_fw_rules())
+
+    def find(self, rule):
+        """
+            pyvcloud rules of gateway with the same key as rule
+        """
+        return self.by_key.get(rule_key(rule), [])
+
+    def gateway_rules(self):
+        return list(self._fw_rules)
+
+    def rules(self):
+        return [from_gateway_rule(fw_rule) for fw_rule in self._fw_rules]
+
+
+def reconcile(index, rules, create):
+    """
+        minimal changes for gateway with rules in index: pyvcloud rules
+        to delete and rules to add, so that each of rules exists exactly
+        once for create or does not exist for delete
+    """
+    to_delete = []
+    to_add = []
+    seen = set()
+    for rule in rules:
+        key = rule_key(rule)
+        if key in seen:
+            continue
+        seen.add(key)
+        existing = index.find(rule)
+        if not create:
+            to_delete.extend(existing)
+        elif not existing:
+            to_add.append(rule)
+        else:
+            # first copy is kept as is, only extra copies are removed
+            to_delete.extend(existing[1:])
+    return to_delete, to_add
+
+
+# addresses that are not IPs and can't be merged
+ADDRESS_KEYWORDS = ("any", "internal", "external")
+MAX_ADDRESSES = 2 ** 32
+
+
+def parse_address(address):
+    """
+        interval (first, last) of IPs for address, range or network;
+        None for keywords
+    """
+    address = str(address).strip()
+    if address.lower() in ADDRESS_KEYWORDS:
+        return None
+    try:
+        if '-' in address:
+            first, last = [IP(part.strip()).int()
+                           for part in address.split('-', 1)]
+        else:
+            network = IP(address)
+            first = network.int()
+            last = first + network.len() - 1
+    except ValueError:
+        return None
+    if first > last:
+        return None
+    return first, last
+
+
+def format_address(interval):
+    first, last = interval
+    if first == last:
+        return str(IP(first))
+    return "{0}-{1}".format(IP(first), IP(last))
+
+
+def merge_intervals(intervals):
+    """
+        sorted list of intervals with overlapping and adjacent ones
+        joined
+    """
+    merged = []
+    for first, last in sorted(intervals):
+        if merged and first <= merged[-1][1] + 1:
+            if last > merged[-1][1]:
+                merged[-1] = (merged[-1][0], last)
+        else:
+            merged.append((first, last))
+    return merged
+
+
+def subtract_interval(interval, removed):
+    """
+        parts of interval that are not in removed
+    """
+    first, last = interval
+    if removed[1] < first or removed[0] > last:
+        return [interval]
+    parts = []
+    if removed[0] > first:
+        parts.append((first, removed[0] - 1))
+    if removed[1] < last:
+        parts.append((removed[1] + 1, last))
+    return parts
+
+
+def _coverage(rule):
+    size = 1
+    for address in (rule.source_ip, rule.dest_ip):
+        interval = parse_address(address)
+        size *= (interval[1] - interval[0] + 1) if interval \
+            else MAX_ADDRESSES
+    return size
+
+
+def _join_key(rule, *fields):
+    """
+        key of rules that can be joined by IPs in fields, rules with
+        other logging are not joined
+    """
+    return rule_key(rule._replace(**dict.fromkeys(fields, ''))) + \
+        (str(bool(rule.log)).lower(), )
+
+
+def _join_descriptions(rules):
+    parts = []
+    for rule in rules:
+        for part in (rule.description or '').split('; '):
+            if part and part not in parts:
+                parts.append(part)
+    return '; '.join(parts)
+
+
+def _merge_field(rules, field):
+    """
+        join rules that differ only by IPs in field, joined rule gets
+        descriptions of all its rules
+    """
+    groups = collections.OrderedDict()
+    for rule in rules:
+        interval = parse_address(getattr(rule, field))
+        if interval is None:
+            groups[(_join_key(rule), )] = [rule]
+            continue
+        groups.setdefault(_join_key(rule, field), []).append(rule)
+    result = []
+    for members in groups.values():
+        if len(members) == 1:
+            result.append(members[0])
+            continue
+        originals = dict((parse_address(getattr(rule, field)),
+                          getattr(rule, field)) for rule in members)
+        for interval in merge_intervals(originals.keys()):
+            joined = [rule for rule in members
+                      if _within(parse_address(getattr(rule, field)),
+                                 interval)]
+            address = originals.get(interval) or format_address(interval)
+            result.append(joined[0]._replace(**{
+                field: address,
+                'description': _join_descriptions(joined)
+            }))
+    return result
+
+
+def _within(interval, outer):
+    return outer[0] <= interval[0] and interval[1] <= outer[1]
+
+
+def _covers(rule, other):
+    """
+        rule matches all packets of other rule
+    """
+    if _join_key(rule, 'source_ip', 'dest_ip') != \
+            _join_key(other, 'source_ip', 'dest_ip'):
+        return False
+    for field in ('source_ip', 'dest_ip'):
+        address = getattr(rule, field)
+        other_address = getattr(other, field)
+        if str(address).lower() == str(other_address).lower():
+            continue
+        interval = parse_address(address)
+        other_interval = parse_address(other_address)
+        if interval is None or other_interval is None or \
+                not _within(other_interval, interval):
+            return False
+    return True
+
+
+def compile_rules(rules):
+    """
+        smaller list of rules with the same effect: rules that differ
+        only by source or destination IPs are joined into rules with IP
+        ranges, and wider rules go first. Only rules in runs of rules
+        with the same action are joined and reordered, so the first
+        matching rule gives the same action for any packet.
+    """
+    runs = []
+    for rule in rules:
+        if runs and runs[-1][0].action.lower() == rule.action.lower():
+            runs[-1].append(rule)
+        else:
+            runs.append([rule])
+    result = []
+    for run in runs:
+        run = _merge_field(_merge_field(run, 'source_ip'), 'dest_ip')
+        result.extend(sorted(run, key=_coverage, reverse=True))
+    return result
+
+
+def subtract_rules(current, rules):
+    """
+        current rules without rules, IPs of removed rule are cut out of
+        ranges of joined rules
+    """
+    result = list(current)
+    for removed in rules:
+        remaining = []
+        for rule in result:
+            if rule_key(rule) == rule_key(removed):
+                continue
+            remaining.extend(_subtract_rule(rule, removed))
+        result = remaining
+    return result
+
+
+def _subtract_rule(rule, removed):
+    for field in ('source_ip', 'dest_ip'):
+        if rule_key(rule._replace(**{field: ''})) != \
+                rule_key(removed._replace(**{field: ''})):
+            continue
+        interval = parse_address(getattr(rule, field))
+        removed_interval = parse_address(getattr(removed, field))
+        if interval is None or removed_interval is None:
+            continue
+        return [rule._replace(**{field: format_address(part)})
+                for part in subtract_interval(interval, removed_interval)]
+    return [rule]
+
+
+def _is_plain(fw_rule):
+    """
+        enabled rule of gateway that FirewallRule describes completely,
+        only such rules are compiled
+    """
+    protocols = fw_rule.get_Protocols()
+    return (bool(fw_rule.get_IsEnabled()) and
+            not fw_rule.get_MatchOnTranslate() and
+            not (protocols and protocols.get_Other()) and
+            str(fw_rule.get_IcmpSubType() or 'any').lower() == 'any' and
+            fw_rule.get_DestinationVm() is None and
+            fw_rule.get_SourceVm() is None)
+
+
+def compiled_changes(index, rules, create):
+    """
+        changes that compile rules of group with rules of gateway they
+        can be joined with: list of (pyvcloud rules to remove, rules to
+        insert at their place). Only enabled rules with the same
+        protocol, ports, action and logging as rules of group are
+        compiled, each run of such rules next to each other separately,
+        so other rules of gateway are not changed and keep their place.
+        New rules go to the end of table as pyvcloud adds them, and are
+        compiled with the run that ends the table.
+    """
+    keys = set(_join_key(rule, 'source_ip', 'dest_ip') for rule in rules)
+    runs = [[]]
+    for fw_rule in index.gateway_rules():
+        key = _join_key(from_gateway_rule(fw_rule), 'source_ip', 'dest_ip')
+        if _is_plain(fw_rule) and key in keys:
+            runs[-1].append(fw_rule)
+        elif runs[-1]:
+            runs.append([])
+    managed = [from_gateway_rule(fw_rule) for run in runs for fw_rule in run]
+    new_rules = [rule for rule in rules
+                 if not any(_covers(current, rule) for current in managed)]
+    changes = []
+    for position, run in enumerate(runs):
+        current = [from_gateway_rule(fw_rule) for fw_rule in run]
+        if not create:
+            compiled = compile_rules(subtract_rules(current, rules))
+        elif position == len(runs) - 1:
+            compiled = compile_rules(current + new_rules)
+        else:
+            compiled = compile_rules(current)
+        if [_join_key(rule) for rule in compiled] != \
+                [_join_key(rule) for rule in current]:
+            changes.append((run, compiled))
+    return changes
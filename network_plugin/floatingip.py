@@ -3,11 +3,14 @@ from cloudify import exceptions as cfy_exc
 from cloudify.decorators import operation
 from vcloud_plugin_common import (with_vca_client, get_vcloud_config,
                                   is_subscription, is_ondemand, get_mandatory)
+from vcloud_plugin_common.parallel import run_parallel_clients
 from network_plugin import (check_ip, CheckAssignedExternalIp,
                             CheckAssignedInternalIp, get_vm_ip,
+                            get_vm_primary_connection, get_network,
                             save_gateway_configuration, getFreeIP,
                             CREATE, DELETE, PUBLIC_IP, get_gateway,
-                            get_public_ip, del_ondemand_public_ip)
+                            get_public_ip, release_ondemand_public_ip,
+                            NatRuleIndex, release_public_ip)
 
 
 @operation
@@ -40,19 +43,30 @@ def creation_validation(vca_client, **kwargs):
 
 def _floatingip_operation(operation, vca_client, ctx):
     service_type = get_vcloud_config().get('service_type')
-    gateway = get_gateway(
-        vca_client, ctx.target.node.properties['floatingip']['edge_gateway'])
-    internal_ip = get_vm_ip(vca_client, ctx, gateway)
+    gateway_name = ctx.target.node.properties['floatingip']['edge_gateway']
+
+    def vm_connection(client):
+        connection = get_vm_primary_connection(client, ctx)
+        # network is cached by client for check of routing
+        get_network(client, connection['network_name'])
+        return connection
+
+    # gateway and VM network don't depend on each other
+    gateway, connection = run_parallel_clients(vca_client, [
+        lambda client: get_gateway(client, gateway_name), vm_connection])
+    internal_ip = get_vm_ip(vca_client, ctx, gateway, connection)
 
     nat_operation = None
     public_ip = (ctx.target.instance.runtime_properties.get(PUBLIC_IP)
                  or ctx.target.node.properties['floatingip'].get(PUBLIC_IP))
     if operation == CREATE:
-        CheckAssignedInternalIp(internal_ip, gateway)
+        nat_index = NatRuleIndex.from_gateway(gateway)
+        CheckAssignedInternalIp(internal_ip, gateway, nat_index)
         if public_ip:
-            CheckAssignedExternalIp(public_ip, gateway)
+            CheckAssignedExternalIp(public_ip, gateway, nat_index)
         else:
-            public_ip = get_public_ip(vca_client, gateway, service_type, ctx)
+            public_ip = get_public_ip(vca_client, gateway, service_type, ctx,
+                                      nat_index)
 
         nat_operation = _add_nat_rule
     elif operation == DELETE:
@@ -74,10 +88,11 @@ def _floatingip_operation(operation, vca_client, ctx):
 
     if operation == CREATE:
         ctx.target.instance.runtime_properties[PUBLIC_IP] = external_ip
+        release_public_ip(gateway, ctx)
     else:
         if is_ondemand(service_type):
             if not ctx.target.node.properties['floatingip'].get(PUBLIC_IP):
-                del_ondemand_public_ip(
+                release_ondemand_public_ip(
                     vca_client,
                     gateway,
                     ctx.target.instance.runtime_properties[PUBLIC_IP],
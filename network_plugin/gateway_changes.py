@@ -0,0 +1,93 @@
+# Copyright (c) 2014 GigaSpaces Technologies Ltd. All rights reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+#  * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  * See the License for the specific language governing permissions and
+#  * limitations under the License.
+
+from vcloud_plugin_common.work_queue import WorkQueue, scope_key
+from network_plugin import firewall
+
+# methods of pyvcloud Gateway that change services configuration
+CHANGE_METHODS = ('add_nat_rule', 'del_nat_rule', 'add_fw_rule',
+                  'delete_fw_rule', 'add_dhcp_pool', 'delete_dhcp_pool')
+# changes of services configuration that pyvcloud Gateway can't make,
+# called as function(gateway, *args)
+CHANGE_FUNCTIONS = {
+    'replace_fw_rules': firewall.replace_gateway_rules
+}
+
+
+class RecordingGateway(object):
+    """
+        wrapper of pyvcloud Gateway, calls of CHANGE_METHODS are applied
+        to wrapped gateway and recorded, so the same changes can be
+        applied to fresh copy of gateway later
+    """
+
+    def __init__(self, gateway, key, vdc_name, gateway_name):
+        self._gateway = gateway
+        self.key = key
+        self.vdc_name = vdc_name
+        self.gateway_name = gateway_name
+        self.changes = []
+        # id of changes already added to queue by operation
+        self.change_id = None
+        # commit waits for changes of other operations
+        self.deferred = False
+
+    def __getattr__(self, name):
+        attr = getattr(self._gateway, name)
+        if name not in CHANGE_METHODS:
+            return attr
+
+        def record(*args):
+            self.changes.append([name, list(args)])
+            return attr(*args)
+        return record
+
+
+def change_gateway(gateway, name, *args):
+    """
+        apply change of CHANGE_FUNCTIONS to gateway, change is recorded
+        when gateway is RecordingGateway
+    """
+    if isinstance(gateway, RecordingGateway):
+        gateway.changes.append([name, list(args)])
+        gateway = gateway._gateway
+    CHANGE_FUNCTIONS[name](gateway, *args)
+
+
+def apply_changes(gateway, changes):
+    for method, args in changes:
+        if method in CHANGE_FUNCTIONS:
+            CHANGE_FUNCTIONS[method](gateway, *args)
+        else:
+            getattr(gateway, method)(*args)
+
+
+def gateway_key(cfg, gateway_name):
+    """
+        identity of edge gateway for config with url, org and vdc
+    """
+    return scope_key(cfg, gateway_name)
+
+
+class ChangeSetStore(WorkQueue):
+    """
+        on disk queue of changes for edge gateways, shared by operations
+        of all processes on the manager. Each operation adds its change
+        set to pending ones of the gateway, operation that holds lock of
+        the gateway applies all pending sets with single commit and
+        writes result for each of them.
+    """
+
+    STORE_PATH_ENV_VAR = 'VCLOUD_GATEWAY_CHANGES_PATH'
+    STORE_PATH_DEFAULT = '~/.vcloud_gateway_changes'
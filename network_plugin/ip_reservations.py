@@ -0,0 +1,203 @@
+# Copyright (c) 2014 GigaSpaces Technologies Ltd. All rights reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+#  * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  * See the License for the specific language governing permissions and
+#  * limitations under the License.
+
+import contextlib
+import errno
+import fcntl
+import json
+import os
+import tempfile
+import time
+
+# reservation must live until NAT rules of operation are committed,
+# including retries of operation while gateway is busy
+RESERVATION_TIMEOUT = 10 * 60
+
+
+class IpReservationStore(object):
+    """
+        on disk reservations of public IPs of edge gateways shared by
+        operations of all processes on the manager. Address reserved by
+        operation is not given to other operations until reservation
+        expires: after commit of gateway configuration owner releases
+        it and the address is kept as used by committed rules, because
+        other operations may still check rules on older gateway.
+        Store also keeps pool of on demand addresses allocated for
+        gateway in advance and addresses given out from it.
+    """
+
+    STORE_PATH_ENV_VAR = 'VCLOUD_IP_RESERVATIONS_PATH'
+    STORE_PATH_DEFAULT = '~/.vcloud_ip_reservations'
+
+    def __init__(self, path=None, timeout=None):
+        if not path:
+            default_location = os.path.expanduser(self.STORE_PATH_DEFAULT)
+            path = os.getenv(self.STORE_PATH_ENV_VAR, default_location)
+        self.path = os.path.expanduser(path)
+        self.timeout = timeout or RESERVATION_TIMEOUT
+
+    def reserve(self, key, candidates, owner):
+        """
+            reserve first address from candidates that is not reserved by
+            other owner and return it, None if there is no such address;
+            address already reserved by owner is returned again, so
+            retried operation gets the same address
+        """
+        with self._data(key) as data:
+            reservations = data['reservations']
+            own = [ip for ip in candidates
+                   if reservations.get(ip, {}).get('owner') == owner
+                   and not reservations[ip].get('committed')]
+            free = [ip for ip in candidates if ip not in reservations]
+            ip = (own or free or [None])[0]
+            if ip:
+                reservations[ip] = {'owner': owner,
+                                    'expires': time.time() + self.timeout}
+            return ip
+
+    def release(self, key, owner):
+        """
+            release reservations of owner after commit of its rules; in
+            the same lock address is marked as used by committed rules
+            until reservation expires, so it never looks free to
+            operations that checked rules before the commit
+        """
+        with self._data(key) as data:
+            for reservation in data['reservations'].values():
+                if reservation['owner'] == owner:
+                    reservation['committed'] = True
+                    reservation['expires'] = time.time() + self.timeout
+
+    def reserved(self, key):
+        """
+            dict of addresses reserved by operations that are not
+            committed yet and their owners
+        """
+        with self._data(key) as data:
+            return dict((ip, reservation['owner'])
+                        for ip, reservation in data['reservations'].items()
+                        if not reservation.get('committed'))
+
+    def add_to_pool(self, key, ips):
+        """
+            add allocated addresses to pool, addresses already given out
+            are skipped
+        """
+        with self._data(key) as data:
+            for ip in ips:
+                if ip not in data['pool'] and ip not in data['issued']:
+                    data['pool'].append(ip)
+
+    def take_from_pool(self, key, available):
+        """
+            give out first address of pool that is in available, None
+            if there is no such address
+        """
+        with self._data(key) as data:
+            for ip in data['pool']:
+                if ip in available:
+                    data['pool'].remove(ip)
+                    data['issued'].append(ip)
+                    return ip
+            return None
+
+    def return_to_pool(self, key, ip, size):
+        """
+            return address that is not used anymore, list of addresses
+            that must be deallocated: returned one if pool is full, all
+            pool when no address of pool is used anymore
+        """
+        with self._data(key) as data:
+            if ip in data['issued']:
+                data['issued'].remove(ip)
+            if not data['issued']:
+                surplus = data['pool'] + [ip]
+                data['pool'] = []
+                return surplus
+            if len(data['pool']) < size:
+                data['pool'].append(ip)
+                return []
+            return [ip]
+
+    def pool(self, key):
+        with self._data(key) as data:
+            return list(data['pool'])
+
+    @contextlib.contextmanager
+    def filling(self, key):
+        """
+            exclusive lock for filling of empty pool, operation checks
+            pool again, allocates addresses and adds them to pool while
+            other operations wait
+        """
+        self._make_dir()
+        with open(os.path.join(self.path, key + '.fill'), 'a') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    @contextlib.contextmanager
+    def _data(self, key):
+        # short exclusive lock, data is read, changed and written back
+        # by one process at a time
+        self._make_dir()
+        file_name = os.path.join(self.path, key + '.json')
+        with open(os.path.join(self.path, key + '.lock'), 'a') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                data = self._read(file_name)
+                original = json.dumps(data, sort_keys=True)
+                now = time.time()
+                reservations = data['reservations']
+                for ip, reservation in reservations.items():
+                    if reservation['expires'] < now:
+                        del reservations[ip]
+                yield data
+                if json.dumps(data, sort_keys=True) != original:
+                    self._write(file_name, data)
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def _make_dir(self):
+        if not os.path.isdir(self.path):
+            try:
+                os.makedirs(self.path, 0o700)
+            except OSError as e:
+                if e.errno != errno.EEXIST:
+                    raise
+
+    def _read(self, file_name):
+        data = {}
+        try:
+            with open(file_name) as f:
+                data = json.load(f)
+        except (IOError, ValueError):
+            pass
+        data.setdefault('reservations', {})
+        data.setdefault('pool', [])
+        data.setdefault('issued', [])
+        return data
+
+    def _write(self, file_name, data):
+        fd, tmp_name = tempfile.mkstemp(dir=self.path, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'w') as f:
+                json.dump(data, f)
+            os.rename(tmp_name, file_name)
+        except (IOError, OSError):
+            if os.path.exists(tmp_name):
+                os.remove(tmp_name)
+            raise
@@ -16,16 +16,21 @@ from cloudify import ctx
 from cloudify import exceptions as cfy_exc
 from cloudify.decorators import operation
 from vcloud_plugin_common import (with_vca_client, wait_for_task,
-                                  get_vcloud_config, get_mandatory)
+                                  get_vcloud_config, get_mandatory,
+                                  PollingStrategy, run_task, retry_for_task)
+from vcloud_plugin_common.query import find_records
 import collections
 from network_plugin import (check_ip, is_valid_ip_range, is_separate_ranges,
                             is_ips_in_same_subnet, save_gateway_configuration,
-                            get_network_name, is_network_exists)
+                            get_network_name, is_network_exists,
+                            get_gateway)
 
 
 VCLOUD_NETWORK_NAME = 'vcloud_network_name'
 ADD_POOL = 1
 DELETE_POOL = 2
+NETWORK_TASK_DEADLINE = 10 * 60
+CREATE_NETWORK_TASK = 'create_network'
 
 
 @operation
@@ -43,40 +48,46 @@ def create(vca_client, **kwargs):
         return
     net_prop = ctx.node.properties["network"]
     network_name = get_network_name(ctx.node.properties)
-    if network_name in _get_network_list(vca_client,
-                                         get_vcloud_config()['vdc']):
-        raise cfy_exc.NonRecoverableError(
-            "Network {0} already exists, but parameter "
-            "'use_external_resource' is 'false' or absent"
-            .format(network_name))
 
-    ip = _split_adresses(net_prop['static_range'])
-    gateway_name = net_prop['edge_gateway']
-    if not vca_client.get_gateway(vdc_name, gateway_name):
-        raise cfy_exc.NonRecoverableError(
-            "Gateway {0} not found".format(gateway_name))
-    start_address = ip.start
-    end_address = ip.end
-    gateway_ip = net_prop["gateway_ip"]
-    netmask = net_prop["netmask"]
-    dns1 = ""
-    dns2 = ""
-    dns_list = net_prop.get("dns")
-    if dns_list:
-        dns1 = dns_list[0]
-        if len(dns_list) > 1:
-            dns2 = dns_list[1]
-    dns_suffix = net_prop.get("dns_suffix")
-    success, result = vca_client.create_vdc_network(
-        vdc_name, network_name, gateway_name, start_address,
-        end_address, gateway_ip, netmask, dns1, dns2, dns_suffix)
-    if success:
-        ctx.logger.info("Network {0} has been successfully created."
-                        .format(network_name))
-    else:
-        raise cfy_exc.NonRecoverableError(
-            "Could not create network {0}: {1}".format(network_name, result))
-    wait_for_task(vca_client, result)
+    def create_network():
+        if network_name in _get_network_list(vca_client, vdc_name):
+            raise cfy_exc.NonRecoverableError(
+                "Network {0} already exists, but parameter "
+                "'use_external_resource' is 'false' or absent"
+                .format(network_name))
+
+        ip = _split_adresses(net_prop['static_range'])
+        gateway_name = net_prop['edge_gateway']
+        if not vca_client.get_gateway(vdc_name, gateway_name):
+            raise cfy_exc.NonRecoverableError(
+                "Gateway {0} not found".format(gateway_name))
+        start_address = ip.start
+        end_address = ip.end
+        gateway_ip = net_prop["gateway_ip"]
+        netmask = net_prop["netmask"]
+        dns1 = ""
+        dns2 = ""
+        dns_list = net_prop.get("dns")
+        if dns_list:
+            dns1 = dns_list[0]
+            if len(dns_list) > 1:
+                dns2 = dns_list[1]
+        dns_suffix = net_prop.get("dns_suffix")
+        success, result = vca_client.create_vdc_network(
+            vdc_name, network_name, gateway_name, start_address,
+            end_address, gateway_ip, netmask, dns1, dns2, dns_suffix)
+        if success:
+            ctx.logger.info("Network {0} has been successfully created."
+                            .format(network_name))
+        else:
+            raise cfy_exc.NonRecoverableError(
+                "Could not create network {0}: {1}"
+                .format(network_name, result))
+        return result
+
+    if run_task(vca_client, CREATE_NETWORK_TASK, create_network,
+                PollingStrategy(deadline=NETWORK_TASK_DEADLINE)):
+        return retry_for_task(CREATE_NETWORK_TASK)
     ctx.instance.runtime_properties[VCLOUD_NETWORK_NAME] = network_name
     _dhcp_operation(vca_client, network_name, ADD_POOL)
 
@@ -99,7 +110,8 @@ def delete(vca_client, **kwargs):
     else:
         raise cfy_exc.NonRecoverableError(
             "Could not delete network {0}".format(network_name))
-    wait_for_task(vca_client, task)
+    wait_for_task(vca_client, task,
+                  PollingStrategy(deadline=NETWORK_TASK_DEADLINE))
 
 
 @operation
@@ -151,10 +163,7 @@ def _dhcp_operation(vca_client, network_name, operation):
     if dhcp_settings is None:
         return
     gateway_name = ctx.node.properties["network"]['edge_gateway']
-    gateway = vca_client.get_gateway(get_vcloud_config()['vdc'], gateway_name)
-    if not gateway:
-        raise cfy_exc.NonRecoverableError(
-            "Gateway {0} not found!".format(gateway_name))
+    gateway = get_gateway(vca_client, gateway_name)
 
     if operation == ADD_POOL:
         ip = _split_adresses(dhcp_settings['dhcp_range'])
@@ -194,8 +203,5 @@ def _split_adresses(address_range):
 
 
 def _get_network_list(vca_client, vdc_name):
-    vdc = vca_client.get_vdc(vdc_name)
-    if not vdc:
-        raise cfy_exc.NonRecoverableError(
-            "Vdc {0} not found.".format(vdc_name))
-    return [net.name for net in vdc.AvailableNetworks.Network]
+    return [record['name'] for record in
+            find_records(vca_client, 'orgVdcNetwork', vdcName=vdc_name)]
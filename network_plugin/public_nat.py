@@ -3,15 +3,18 @@ from cloudify import exceptions as cfy_exc
 from cloudify.decorators import operation
 from vcloud_plugin_common import (with_vca_client, get_vcloud_config,
                                   get_mandatory, is_subscription, is_ondemand)
+from vcloud_plugin_common.query import find_records, get_entity
 from network_plugin import (check_ip, save_gateway_configuration,
                             get_vm_ip, get_public_ip,
                             get_gateway, getFreeIP, CREATE, DELETE, PUBLIC_IP,
-                            check_protocol, del_ondemand_public_ip)
+                            check_protocol, release_ondemand_public_ip,
+                            NatRuleIndex, release_public_ip,
+                            get_change_set_store, get_planning_nat_index,
+                            queue_gateway_changes)
 from network_plugin.network import VCLOUD_NETWORK_NAME
 from IPy import IP
+from pyvcloud.schema.vcd.v1_5.schemas.vcloud import networkType
 
-# 2 ^ 16 - 1
-MAX_PORT_NUMBER = 65535
 PORT_REPLACEMENT = 'port_replacement'
 
 
@@ -86,30 +89,57 @@ def prepare_network_operation(vca_client, operation):
 
 def prepare_server_operation(vca_client, operation):
     try:
-        gateway = get_gateway(vca_client, ctx.target.node.properties['nat']['edge_gateway'])
-        public_ip = _obtain_public_ip(vca_client, ctx, gateway, operation)
+        nat = ctx.target.node.properties['nat']
+        # rules of all servers are planned against queued rules of
+        # each other and saved with one commit
+        batch = nat.get('rules_batch', False)
+        gateway = get_gateway(vca_client, nat['edge_gateway'],
+                              write_queue=batch)
         private_ip = get_vm_ip(vca_client, ctx, gateway)
-        for rule in ctx.target.node.properties['rules']:
-            rule_type = rule['type']
-            protocol = rule.get('protocol', "any")
-            original_port = rule.get('original_port', "any")
-            translated_port = rule.get('translated_port', "any")
-            nat_network_operation(vca_client, gateway, operation, rule_type, public_ip,
-                                  private_ip, original_port, translated_port,
-                                  protocol)
+        if batch:
+            store = get_change_set_store()
+            with store.planning(gateway.key):
+                nat_index = get_planning_nat_index(vca_client, gateway,
+                                                   store)
+                # free IP is chosen against queued rules too
+                public_ip = _obtain_public_ip(vca_client, ctx, gateway,
+                                              operation, nat_index)
+                _server_rules_operation(vca_client, gateway, operation,
+                                        public_ip, private_ip, nat_index)
+                if gateway.changes:
+                    queue_gateway_changes(gateway, store)
+            gateway.deferred = True
+        else:
+            public_ip = _obtain_public_ip(vca_client, ctx, gateway,
+                                          operation)
+            _server_rules_operation(vca_client, gateway, operation,
+                                    public_ip, private_ip)
     except KeyError as e:
         raise cfy_exc.NonRecoverableError("Parameter not found: {0}".format(e))
     _save_configuration(gateway, vca_client, operation, public_ip)
 
 
+def _server_rules_operation(vca_client, gateway, operation, public_ip,
+                            private_ip, nat_index=None):
+    for rule in ctx.target.node.properties['rules']:
+        rule_type = rule['type']
+        protocol = rule.get('protocol', "any")
+        original_port = rule.get('original_port', "any")
+        translated_port = rule.get('translated_port', "any")
+        nat_network_operation(vca_client, gateway, operation, rule_type, public_ip,
+                              private_ip, original_port, translated_port,
+                              protocol, nat_index)
+
+
 def nat_network_operation(vca_client, gateway, operation, rule_type, public_ip,
                           private_ip, original_port, translated_port,
-                          protocol):
+                          protocol, nat_index=None):
     function = None
     message = None
     if operation == CREATE:
         new_original_port = _get_original_port_for_create(gateway, rule_type, public_ip, original_port,
-                                                          private_ip, translated_port, protocol)
+                                                          private_ip, translated_port, protocol,
+                                                          nat_index)
         function = gateway.add_nat_rule
         message = "Add"
     elif operation == DELETE:
@@ -128,15 +158,20 @@ protocol '{3}', original_port '{4}', translated_port '{5}'"""
             info_message.format(private_ip, public_ip, rule_type, protocol,
                                 new_original_port, translated_port,
                                 message))
-        function(
-            rule_type, private_ip, "any", public_ip, "any", "any")
+        args = (rule_type, private_ip, "any", public_ip, "any", "any")
     elif rule_type == "DNAT":
         ctx.logger.info(
             info_message.format(public_ip, private_ip, rule_type, protocol,
                                 new_original_port, translated_port,
                                 message))
-        function(rule_type, public_ip, str(new_original_port), private_ip,
-                 str(translated_port), protocol)
+        args = (rule_type, public_ip, str(new_original_port), private_ip,
+                str(translated_port), protocol)
+    else:
+        return
+    function(*args)
+    if nat_index is not None and operation == CREATE:
+        # next rules of batch see this rule and its port
+        nat_index.add_rule(*args)
 
 
 def _save_configuration(gateway, vca_client, operation, public_ip):
@@ -146,11 +181,12 @@ def _save_configuration(gateway, vca_client, operation, public_ip):
     ctx.logger.info("NAT configuration has been saved")
     if operation == CREATE:
         ctx.target.instance.runtime_properties[PUBLIC_IP] = public_ip
+        release_public_ip(gateway, ctx)
     else:
         service_type = get_vcloud_config().get('service_type')
         if is_ondemand(service_type):
             if not ctx.target.node.properties['nat'].get(PUBLIC_IP):
-                del_ondemand_public_ip(
+                release_ondemand_public_ip(
                     vca_client, gateway,
                     ctx.target.instance.runtime_properties[PUBLIC_IP], ctx)
         del ctx.target.instance.runtime_properties[PUBLIC_IP]
@@ -158,8 +194,8 @@ def _save_configuration(gateway, vca_client, operation, public_ip):
 
 def _create_ip_range(vca_client, gateway):
     network_name = ctx.source.instance.runtime_properties[VCLOUD_NETWORK_NAME]
-    org_name = get_vcloud_config()['org']
-    net = _get_network_ip_range(vca_client, org_name, network_name)
+    net = _get_network_ip_range(vca_client, network_name,
+                                get_vcloud_config()['vdc'])
     gate = _get_gateway_ip_range(gateway, network_name)
     if not net:
         raise cfy_exc.NonRecoverableError(
@@ -170,13 +206,15 @@ def _create_ip_range(vca_client, gateway):
         return "{} - {}".format(min(net), max(net))
 
 
-def _get_network_ip_range(vca_client, org_name, network_name):
+def _get_network_ip_range(vca_client, network_name, vdc_name):
     """
-        return ips for network from network configuration ipscopes
+        return ips for network of vdc from network configuration ipscopes
     """
-    networks = vca_client.get_networks(org_name)
-    ip_scope = [net.Configuration.IpScopes.IpScope
-                for net in networks if network_name == net.get_name()]
+    records = find_records(vca_client, 'orgVdcNetwork', name=network_name,
+                           vdcName=vdc_name)
+    networks = [get_entity(vca_client, record['href'], networkType)
+                for record in records]
+    ip_scope = [net.Configuration.IpScopes.IpScope for net in networks]
     addresses = []
     for scope in ip_scope:
         for ip in scope[0].IpRanges.IpRange:
@@ -203,18 +241,20 @@ def _get_gateway_ip_range(gateway, network_name):
         return None
 
 
-def _obtain_public_ip(vca_client, ctx, gateway, operation):
+def _obtain_public_ip(vca_client, ctx, gateway, operation, nat_index=None):
     """
         return public ip for rules,
         in delete case - returned already used
-        in create case - return new free ip
+        in create case - return new free ip, not used by rules of
+        nat_index
     """
     public_ip = None
     if operation == CREATE:
         public_ip = ctx.target.node.properties['nat'].get(PUBLIC_IP)
         if not public_ip:
             service_type = get_vcloud_config().get('service_type')
-            public_ip = get_public_ip(vca_client, gateway, service_type, ctx)
+            public_ip = get_public_ip(vca_client, gateway, service_type, ctx,
+                                      nat_index)
     elif operation == DELETE:
         if PUBLIC_IP in ctx.target.instance.runtime_properties:
             public_ip = ctx.target.instance.runtime_properties[PUBLIC_IP]
@@ -228,17 +268,18 @@ def _obtain_public_ip(vca_client, ctx, gateway, operation):
 
 def _get_original_port_for_create(
     gateway, rule_type, original_ip, original_port, translated_ip,
-    translated_port, protocol
+    translated_port, protocol, nat_index=None
 ):
     """
         return port that can be used in rule, if port have already used
         return new port that is next free port after current
     """
-    nat_rules = gateway.get_nat_rules()
+    if nat_index is None:
+        nat_index = NatRuleIndex.from_gateway(gateway)
     if isinstance(original_port, basestring) and original_port.lower() == 'any':
-        if _is_rule_exists(nat_rules, rule_type, original_ip,
-                            original_port, translated_ip,
-                            translated_port, protocol):
+        if nat_index.is_rule_exists(rule_type, original_ip,
+                                    original_port, translated_ip,
+                                    translated_port, protocol):
             raise cfy_exc.NonRecoverableError(
                 "The same NAT rule already exsists: original_ip '{0}',translated_ip '{1}', "
                 "rule type '{2}', protocol '{3}', original_port '{4}, "
@@ -248,21 +289,20 @@ def _get_original_port_for_create(
             return original_port
 
     # origin port can be string
-    for port in xrange(int(original_port), MAX_PORT_NUMBER + 1):
-        if not _is_rule_exists(nat_rules, rule_type, original_ip,
-                                port, translated_ip,
-                                translated_port, protocol):
-            if port == original_port:
-                return original_port
-            else:
-                ctx.logger.info("For IP {} replace original port {} -> {}".format(original_ip, original_port, port))
-                if PORT_REPLACEMENT not in ctx.target.instance.runtime_properties:
-                    ctx.target.instance.runtime_properties[PORT_REPLACEMENT] = {}
-                ctx.target.instance.runtime_properties[PORT_REPLACEMENT][(original_ip, original_port)] = port
-                return port
-    raise cfy_exc.NonRecoverableError(
-        "Can't create NAT rule because maximum port number was reached"
-    )
+    ports = nat_index.port_occupancy(rule_type, original_ip, translated_ip,
+                                     translated_port, protocol)
+    port = ports.next_free(original_port)
+    if port is None:
+        raise cfy_exc.NonRecoverableError(
+            "Can't create NAT rule because maximum port number was reached"
+        )
+    if port == original_port:
+        return original_port
+    ctx.logger.info("For IP {} replace original port {} -> {}".format(original_ip, original_port, port))
+    if PORT_REPLACEMENT not in ctx.target.instance.runtime_properties:
+        ctx.target.instance.runtime_properties[PORT_REPLACEMENT] = {}
+    ctx.target.instance.runtime_properties[PORT_REPLACEMENT][(original_ip, original_port)] = port
+    return port
 
 
 def _get_original_port_for_delete(original_ip, original_port):
@@ -283,18 +323,6 @@ def _is_rule_exists(nat_rules, rule_type, original_ip, original_port, translated
     """
         check if we already have some rule with same properties
     """
-    # gatewayNatRule properties may be None or string
-    # convert to str, bacause port can be int
-    cicmp = lambda t: t[1] and (str(t[0]).lower() == str(t[1]).lower())
-    for natRule in nat_rules:
-        gatewayNatRule = natRule.get_GatewayNatRule()
-        if (all(map(cicmp, [(rule_type, natRule.get_RuleType()),
-                            (original_ip, gatewayNatRule.get_OriginalIp()),
-                            (str(original_port), gatewayNatRule.get_OriginalPort()),
-                            (translated_ip, gatewayNatRule.get_TranslatedIp()),
-                            (str(translated_port), gatewayNatRule.get_TranslatedPort()),
-                            (protocol, gatewayNatRule.get_Protocol())]))):
-            break
-    else:
-        return False
-    return True
+    return NatRuleIndex(nat_rules).is_rule_exists(
+        rule_type, original_ip, original_port, translated_ip,
+        translated_port, protocol)
@@ -5,6 +5,10 @@ from vcloud_plugin_common import (with_vca_client, get_mandatory,
                                   get_vcloud_config)
 from network_plugin import (check_ip, get_vm_ip, save_gateway_configuration,
                             check_protocol, check_port, get_gateway)
+from network_plugin.firewall import (FirewallRule, FirewallRuleIndex,
+                                     reconcile, compiled_changes,
+                                     gateway_rule_fields, rule_fields)
+from network_plugin.gateway_changes import change_gateway
 
 
 CREATE_RULE = 1
@@ -77,6 +81,7 @@ def creation_validation(vca_client, **kwargs):
 def _rule_operation(operation, vca_client):
     gateway = get_gateway(
         vca_client, _get_gateway_name(ctx.target.node.properties))
+    rules = []
     for rule in ctx.target.node.properties['rules']:
         description = rule.get('description', "Rule added by pyvcloud").strip()
         source_ip = rule.get("source", "external").capitalize()
@@ -94,24 +99,63 @@ def _rule_operation(operation, vca_client):
         protocol = rule.get('protocol', 'any').capitalize()
         action = rule.get("action", "allow")
         log = rule.get('log_traffic', False)
-
-        if operation == CREATE_RULE:
-            gateway.add_fw_rule(
-                True, description, action, protocol, dest_port, dest_ip,
-                source_port, source_ip, log)
-            ctx.logger.info(
-                "Firewall rule has been created: {0}".format(description))
-        elif operation == DELETE_RULE:
-            gateway.delete_fw_rule(protocol, dest_port, dest_ip.lower(),
-                                   source_port, source_ip.lower())
-            ctx.logger.info(
-                "Firewall rule has been deleted: {0}".format(description))
+        rules.append(FirewallRule(description, action, protocol, dest_port,
+                                  dest_ip, source_port, source_ip, log))
+
+    # rules of gateway are compared with rules of group, so repeated
+    # operation does not add the same rules again
+    index = FirewallRuleIndex.from_gateway(gateway)
+    if _is_compile_rules(ctx.target.node.properties):
+        changes = compiled_changes(index, rules, operation == CREATE_RULE)
+        ctx.logger.info(
+            "Firewall rules compiled: {0} rules on gateway are replaced "
+            "with {1} rules".format(
+                sum(len(removed) for removed, _ in changes),
+                sum(len(added) for _, added in changes)))
+    else:
+        to_delete, to_add = reconcile(index, rules,
+                                      operation == CREATE_RULE)
+        changes = [(to_delete, []), ([], to_add)]
+    changes = [(removed, added) for removed, added in changes
+               if removed or added]
+    if not changes:
+        ctx.logger.info("Firewall rules are up to date")
+        return
+    _apply_rules(gateway, changes)
+    for removed, added in changes:
+        for fw_rule in removed:
+            ctx.logger.info("Firewall rule has been deleted: {0}"
+                            .format(fw_rule.get_Description()))
+        for rule in added:
+            ctx.logger.info("Firewall rule has been created: {0}"
+                            .format(rule.description))
 
     if not save_gateway_configuration(gateway, vca_client):
         return ctx.operation.retry(message='Waiting for gateway.',
                                    retry_after=10)
 
 
+def _apply_rules(gateway, changes):
+    """
+        remove exactly the pyvcloud rules and insert rules of group at
+        their place, pyvcloud add_fw_rule and delete_fw_rule are not
+        used: they can't express Tcp and Udp in one rule and remove all
+        copies of rule at once
+    """
+    for removed, added in changes:
+        change_gateway(gateway, 'replace_fw_rules',
+                       [gateway_rule_fields(fw_rule) for fw_rule in removed],
+                       [rule_fields(rule) for rule in added])
+
+
+def _is_compile_rules(properties):
+    """
+        rules of gateway are joined and ordered by compiler, see
+        network_plugin.firewall.compile_rules
+    """
+    return bool(properties.get('security_group', {}).get('compile_rules'))
+
+
 def _get_gateway_name(properties):
     security_group = properties.get('security_group')
     if security_group and 'edge_gateway' in security_group:
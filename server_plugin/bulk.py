@@ -0,0 +1,228 @@
+# Copyright (c) 2014 GigaSpaces Technologies Ltd. All rights reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+#  * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  * See the License for the specific language governing permissions and
+#  * limitations under the License.
+
+import time
+
+from cloudify import ctx
+from cloudify import exceptions as cfy_exc
+import requests
+from pyvcloud.schema.vcd.v1_5.schemas.vcloud import taskType
+
+from vcloud_plugin_common import (get_vcloud_config, wait_for_tasks,
+                                  TASK_DEADLINE, TASK_QUERY_SIZE)
+from vcloud_plugin_common.query import query_records, quote_value, get_entity
+from vcloud_plugin_common.transport import get_transport
+from vcloud_plugin_common.work_queue import (WorkQueue, scope_key,
+                                             STATUS_SUCCESS, STATUS_ERROR)
+
+POWER_ON = 'power_on'
+UNDEPLOY = 'undeploy'
+DELETE = 'delete'
+
+UNDEPLOY_PARAMS = """<UndeployVAppParams xmlns="http://www.vmware.com/vcloud/v1.5">
+<UndeployPowerAction>powerOff</UndeployPowerAction>
+</UndeployVAppParams>"""
+UNDEPLOY_PARAMS_TYPE = "application/vnd.vmware.vcloud.undeployVAppParams+xml"
+# status of vApp in query record
+STATUS_POWERED_ON = 'POWERED_ON'
+# statuses of task in query record before it is finished
+TASK_UNFINISHED_STATUSES = ('queued', 'preRunning', 'running')
+
+# operations of other instances are collected during delay
+BULK_DELAY = 2
+BULK_POLL = 1
+BULK_TIMEOUT = TASK_DEADLINE
+
+
+class BulkRequestStore(WorkQueue):
+    """
+        on disk queue of lifecycle actions for vApps of server instances,
+        operation that holds lock submits actions of all waiting
+        operations at once
+    """
+
+    STORE_PATH_ENV_VAR = 'VCLOUD_SERVER_BULK_PATH'
+    STORE_PATH_DEFAULT = '~/.vcloud_server_bulk'
+
+
+def is_bulk():
+    return bool(ctx.node.properties.get('server', {}).get('bulk'))
+
+
+def run_bulk(vca_client, action, vapp_name):
+    """
+        queue action for vApp and wait for its result; operation that
+        gets lock resolves vApps of all queued actions with one query,
+        submits their tasks and waits for all of them together
+    """
+    config = get_vcloud_config()
+    store = BulkRequestStore(config.get('server_bulk_path'))
+    key = scope_key(config, 'servers', action)
+    request_id = store.add(key, [vapp_name])
+    delay = config.get('server_bulk_delay', BULK_DELAY)
+    if delay:
+        time.sleep(delay)
+    deadline = time.time() + BULK_TIMEOUT
+    while True:
+        result = store.result(key, request_id)
+        if result is None:
+            with store.lock(key) as locked:
+                if locked:
+                    _run_pending(vca_client, config['vdc'], action, store,
+                                 key)
+                    result = store.result(key, request_id)
+        if result is not None:
+            if result['status'] == STATUS_SUCCESS:
+                return
+            raise cfy_exc.NonRecoverableError(result['message'])
+        if time.time() > deadline:
+            store.discard(key, request_id)
+            raise cfy_exc.NonRecoverableError(
+                "Action {0} for vApp {1} was not finished in {2} seconds"
+                .format(action, vapp_name, BULK_TIMEOUT))
+        time.sleep(BULK_POLL)
+
+
+def _run_pending(vca_client, vdc_name, action, store, key):
+    batch = store.pending(key)
+    if not batch:
+        return
+    records = find_vapps(vca_client, vdc_name,
+                         set(names[0] for _, names in batch))
+    running = find_running_tasks(
+        vca_client, [record['href'] for record in records.values()])
+    tasks = {}
+    busy = []
+    for request_id, names in batch:
+        vapp_name = names[0]
+        record = records.get(vapp_name)
+        if not record:
+            if action == DELETE:
+                # deleted by task of operation that held lock before
+                store.complete(key, [request_id], STATUS_SUCCESS)
+            else:
+                store.complete(
+                    key, [request_id], STATUS_ERROR,
+                    "vApp {0} could not be found".format(vapp_name))
+            continue
+        if is_action_done(action, record):
+            store.complete(key, [request_id], STATUS_SUCCESS)
+            continue
+        if record['href'] in running:
+            # task could be submitted by operation that held lock and
+            # stopped before results were saved, action is not sent
+            # again: request stays pending and state of vApp is checked
+            # after the task
+            busy.extend(running[record['href']])
+            continue
+        try:
+            task = submit_action(vca_client, action, record['href'])
+        except cfy_exc.NonRecoverableError as e:
+            store.complete(key, [request_id], STATUS_ERROR, str(e))
+            continue
+        tasks[request_id] = task
+    if not tasks and not busy:
+        return
+    ctx.logger.info("Waiting for {0} tasks of {1} vApps, {2} vApps are "
+                    "busy with other tasks"
+                    .format(action, len(tasks), len(busy)))
+    busy_tasks = [get_entity(vca_client, href, taskType) for href in busy]
+    failed = {}
+    try:
+        wait_for_tasks(vca_client, tasks.values() + busy_tasks,
+                       failed=failed)
+    except cfy_exc.NonRecoverableError as e:
+        # tasks were not finished in time
+        store.complete(key, tasks.keys(), STATUS_ERROR, str(e))
+        return
+    for request_id, task in tasks.items():
+        message = failed.get(task.get_href())
+        store.complete(key, [request_id],
+                       STATUS_ERROR if message else STATUS_SUCCESS, message)
+
+
+def is_action_done(action, record):
+    """
+        vApp in query record is already in state that action leads to
+    """
+    if action == POWER_ON:
+        return record.get('status') == STATUS_POWERED_ON
+    if action == UNDEPLOY:
+        return record.get('isDeployed') == 'false'
+    return False
+
+
+def find_running_tasks(vca_client, vapp_hrefs):
+    """
+        hrefs of unfinished tasks by href of their vApp, one query for
+        each TASK_QUERY_SIZE vApps
+    """
+    hrefs = sorted(vapp_hrefs)
+    tasks = {}
+    for index in xrange(0, len(hrefs), TASK_QUERY_SIZE):
+        query_filter = "({0});({1})".format(
+            ",".join("object=={0}".format(quote_value(href))
+                     for href in hrefs[index:index + TASK_QUERY_SIZE]),
+            ",".join("status=={0}".format(status)
+                     for status in TASK_UNFINISHED_STATUSES))
+        for record in query_records(vca_client,
+                                    vca_client.vcloud_session.url, 'task',
+                                    query_filter):
+            tasks.setdefault(record.get('object'), []).append(
+                record.get('href'))
+    return tasks
+
+
+def find_vapps(vca_client, vdc_name, vapp_names):
+    """
+        vApp query records by name for vApps of vdc, one query for each
+        TASK_QUERY_SIZE names
+    """
+    names = sorted(vapp_names)
+    records = {}
+    for index in xrange(0, len(names), TASK_QUERY_SIZE):
+        query_filter = "({0});vdcName=={1}".format(
+            ",".join("name=={0}".format(quote_value(name))
+                     for name in names[index:index + TASK_QUERY_SIZE]),
+            quote_value(vdc_name))
+        for record in query_records(vca_client,
+                                    vca_client.vcloud_session.url, 'vApp',
+                                    query_filter):
+            records[record.get('name')] = record
+    return records
+
+
+def submit_action(vca_client, action, vapp_href):
+    """
+        start task of action for vApp by href, without request of vApp
+    """
+    headers = dict(vca_client.vcloud_session.get_vcloud_headers())
+    transport = get_transport()
+    if action == POWER_ON:
+        response = transport.post(vapp_href + '/power/action/powerOn',
+                                  headers=headers)
+    elif action == UNDEPLOY:
+        headers['Content-Type'] = UNDEPLOY_PARAMS_TYPE
+        response = transport.post(vapp_href + '/action/undeploy',
+                                  data=UNDEPLOY_PARAMS, headers=headers)
+    elif action == DELETE:
+        response = transport.delete(vapp_href, headers=headers)
+    else:
+        raise cfy_exc.NonRecoverableError(
+            "Unknown action {0}".format(action))
+    if response.status_code != requests.codes.accepted:
+        raise cfy_exc.NonRecoverableError(
+            "Could not {0} vApp {1}: {2}"
+            .format(action, vapp_href, response.content))
+    return taskType.parseString(response.content, True)
@@ -11,18 +11,31 @@
 #  * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 #  * See the License for the specific language governing permissions and
 #  * limitations under the License.
+import time
+
 from cloudify import ctx
 from cloudify.decorators import operation
 from cloudify import exceptions as cfy_exc
 
 from vcloud_plugin_common import (get_vcloud_config,
+                                  PollingStrategy,
                                   transform_resource_name,
                                   wait_for_task,
                                   with_vca_client,
+                                  run_task,
+                                  retry_for_task,
                                   STATUS_POWERED_ON)
+from vcloud_plugin_common.parallel import run_parallel_clients
+from vcloud_plugin_common.query import find_records
 
 from network_plugin import (get_network_name, get_network, is_network_exists,
                             get_vapp_name)
+from server_plugin import bulk
+from server_plugin.vapp_compose import (compose_vapp, get_template_hrefs,
+                                       instantiate_params)
+from server_plugin.vapp_networks import (connect_networks,
+                                        get_vm_href,
+                                        get_vm_network_connections)
 
 VCLOUD_VAPP_NAME = 'vcloud_vapp_name'
 GUEST_CUSTOMIZATION = 'guest_customization'
@@ -30,21 +43,32 @@ HARDWARE = 'hardware'
 DEFAULT_EXECUTOR = "/bin/bash"
 DEFAULT_USER = "ubuntu"
 DEFAULT_HOME = "/home"
+CREATE_VAPP_TASK = 'create_vapp'
+POWER_ON_TASK = 'power_on'
+UNDEPLOY_TASK = 'undeploy'
+DELETE_VAPP_TASK = 'delete_vapp'
+CREATE_MODE_COMPOSE = 'compose'
+VCLOUD_VM_HREF = 'vcloud_vm_href'
+# IP readiness probe waits inside operation before retry of operation
+IP_PROBE_DEADLINE = 30
+IP_PROBE_MIN_INTERVAL = 1
+IP_PROBE_MAX_INTERVAL = 5
 
 
 @operation
 @with_vca_client
 def creation_validation(vca_client, **kwargs):
     def get_catalog(catalog_name):
-        catalogs = vca_client.get_catalogs()
-        for catalog in catalogs:
-            if catalog.get_name() == catalog_name:
-                return catalog
+        catalogs = find_records(vca_client, 'catalog', name=catalog_name)
+        if catalogs:
+            return catalogs[0]
 
-    def get_template(catalog, template_name):
-        for template in catalog.get_CatalogItems().get_CatalogItem():
-            if template.get_name() == template_name:
-                return template
+    def get_template(catalog_name, template_name):
+        templates = find_records(vca_client, 'catalogItem',
+                                 name=template_name,
+                                 catalogName=catalog_name)
+        if templates:
+            return templates[0]
 
     if ctx.node.properties.get('use_external_resource'):
         if not ctx.node.properties.get('resource_id'):
@@ -66,7 +90,7 @@ def creation_validation(vca_client, **kwargs):
         raise cfy_exc.NonRecoverableError(
             "Catalog {0} could not be found".format(server_dict['catalog']))
 
-    template = get_template(catalog, server_dict['template'])
+    template = get_template(server_dict['catalog'], server_dict['template'])
     if template is None:
         raise cfy_exc.NonRecoverableError(
             "Template {0} could not be found".format(server_dict['template']))
@@ -88,38 +112,54 @@ def create(vca_client, **kwargs):
         ctx.logger.info(
             "External resource {0} has been used".format(res_id))
     else:
-        _create(vca_client, config, server)
+        return _create(vca_client, config, server)
+
 
 def _create(vca_client, config, server):
     vapp_name = server['name']
-    vapp_template = server['template']
-    vapp_catalog = server['catalog']
-    hardware = server.get('hardware')
-    cpu = None
-    memory = None
-    if hardware:
-        cpu = hardware.get('cpu')
-        memory = hardware.get('memory')
-        _check_hardware(cpu, memory)
-    ctx.logger.info("Creating VApp with parameters: {0}".format(str(server)))
-    task = vca_client.create_vapp(config['vdc'],
-                                  vapp_name,
-                                  vapp_template,
-                                  vapp_catalog,
-                                  vm_name=vapp_name,
-                                  vm_cpus=cpu,
-                                  vm_memory=memory)
-
-    if not task:
-        raise cfy_exc.NonRecoverableError("Could not create vApp: {0}"
-                                          .format(vca_client.response.content))
-
-    wait_for_task(vca_client, task)
+
+    def create_vapp():
+        vapp_template = server['template']
+        vapp_catalog = server['catalog']
+        hardware = server.get('hardware')
+        cpu = None
+        memory = None
+        if hardware:
+            cpu = hardware.get('cpu')
+            memory = hardware.get('memory')
+            _check_hardware(cpu, memory)
+        ctx.logger.info("Creating VApp with parameters: {0}"
+                        .format(str(server)))
+        task = vca_client.create_vapp(config['vdc'],
+                                      vapp_name,
+                                      vapp_template,
+                                      vapp_catalog,
+                                      vm_name=vapp_name,
+                                      vm_cpus=cpu,
+                                      vm_memory=memory)
+        if not task:
+            raise cfy_exc.NonRecoverableError(
+                "Could not create vApp: {0}"
+                .format(vca_client.response.content))
+        return task
+
+    def compose_app():
+        return _compose_vapp(vca_client, config, server)
+
+    compose = server.get('create_mode') == CREATE_MODE_COMPOSE
+    if run_task(vca_client, CREATE_VAPP_TASK,
+                compose_app if compose else create_vapp):
+        return retry_for_task(CREATE_VAPP_TASK)
     ctx.instance.runtime_properties[VCLOUD_VAPP_NAME] = vapp_name
+    if compose:
+        # networks and customization are parts of instantiation
+        return
     connections = _create_connections_list(vca_client)
 
     # we allways have connection to management_network_name
-    if connections:
+    if connections and server.get('networks_batch'):
+        _connect_networks_batch(vca_client, config, vapp_name, connections)
+    elif connections:
         for index, connection in enumerate(connections):
             vdc = vca_client.get_vdc(config['vdc'])
             vapp = vca_client.get_vapp(vdc, vapp_name)
@@ -187,6 +227,79 @@ def _create(vca_client, config, server):
                 "Can't run customization in next power on")
 
 
+def _connect_networks_batch(vca_client, config, vapp_name, connections):
+    """
+        connect vApp to all networks with one task for vApp networks and
+        one for NICs of VM, whatever number of connections
+    """
+    vdc = vca_client.get_vdc(config['vdc'])
+    vapp = vca_client.get_vapp(vdc, vapp_name)
+    if vapp is None:
+        raise cfy_exc.NonRecoverableError(
+            "vApp {0} could not be found".format(vapp_name))
+    networks, nics = _networks_and_nics(vca_client, connections)
+    ctx.logger.info("Connecting networks with parameters {0}"
+                    .format(str(nics)))
+    connect_networks(vca_client, vapp, networks, nics)
+
+
+def _networks_and_nics(vca_client, connections):
+    """
+        list of (name, href) of networks and list of NICs with
+        connection index for connections
+    """
+    networks = []
+    nics = []
+    for index, connection in enumerate(connections):
+        network_name = connection.get('network')
+        if network_name not in [name for name, _ in networks]:
+            network = get_network(vca_client, network_name)
+            networks.append((network_name, network.get_href()))
+        nics.append({
+            'network': network_name,
+            'index': index,
+            'primary_interface': connection.get('primary_interface'),
+            'ip_allocation_mode': connection.get('ip_allocation_mode',
+                                                 'POOL').upper(),
+            'mac_address': connection.get('mac_address'),
+            'ip_address': connection.get('ip_address')
+        })
+    return networks, nics
+
+
+def _compose_vapp(vca_client, config, server):
+    """
+        create vApp with hardware, networks and guest customization of VM
+        in one instantiate request, VM is ready for power on after the
+        task of request
+    """
+    vapp_name = server['name']
+    hardware = server.get('hardware') or {}
+    cpu = hardware.get('cpu')
+    memory = hardware.get('memory')
+    if hardware:
+        _check_hardware(cpu, memory)
+    networks, nics = _networks_and_nics(
+        vca_client, _create_connections_list(vca_client))
+    customization = None
+    custom = server.get(GUEST_CUSTOMIZATION)
+    if custom:
+        customization = {
+            'script': _build_script(custom),
+            'computer_name': custom.get('computer_name'),
+            'admin_password': custom.get('admin_password')
+        }
+    template_href, vm_href = get_template_hrefs(
+        vca_client, server['catalog'], server['template'])
+    ctx.logger.info("Composing VApp with parameters: {0}, networks: {1}"
+                    .format(str(server), str(nics)))
+    body = instantiate_params(vapp_name, template_href, vm_href, vapp_name,
+                              networks=networks, connections=nics,
+                              cpu=cpu, memory=memory,
+                              customization=customization)
+    return compose_vapp(vca_client, config['vdc'], body)
+
+
 @operation
 @with_vca_client
 def start(vca_client, **kwargs):
@@ -194,16 +307,24 @@ def start(vca_client, **kwargs):
         ctx.logger.info('not starting server since an external server is '
                         'being used')
     else:
-        vapp_name = get_vapp_name(ctx.instance.runtime_properties)
-        config = get_vcloud_config()
-        vdc = vca_client.get_vdc(config['vdc'])
-        vapp = vca_client.get_vapp(vdc, vapp_name)
-        if _vapp_is_on(vapp) is False:
-            ctx.logger.info("Power-on VApp {0}".format(vapp_name))
-            task = vapp.poweron()
-            if not task:
-                raise cfy_exc.NonRecoverableError("Could not power-on vApp")
-            wait_for_task(vca_client, task)
+        def power_on():
+            vapp_name = get_vapp_name(ctx.instance.runtime_properties)
+            config = get_vcloud_config()
+            vdc = vca_client.get_vdc(config['vdc'])
+            vapp = vca_client.get_vapp(vdc, vapp_name)
+            if _vapp_is_on(vapp) is False:
+                ctx.logger.info("Power-on VApp {0}".format(vapp_name))
+                task = vapp.poweron()
+                if not task:
+                    raise cfy_exc.NonRecoverableError(
+                        "Could not power-on vApp")
+                return task
+
+        if bulk.is_bulk():
+            bulk.run_bulk(vca_client, bulk.POWER_ON,
+                          get_vapp_name(ctx.instance.runtime_properties))
+        elif run_task(vca_client, POWER_ON_TASK, power_on):
+            return retry_for_task(POWER_ON_TASK)
 
     if not _get_state(vca_client):
         return ctx.operation.retry(
@@ -218,15 +339,23 @@ def stop(vca_client, **kwargs):
         ctx.logger.info('not stopping server since an external server is '
                         'being used')
     else:
-        vapp_name = get_vapp_name(ctx.instance.runtime_properties)
-        config = get_vcloud_config()
-        vdc = vca_client.get_vdc(config['vdc'])
-        vapp = vca_client.get_vapp(vdc, vapp_name)
-        ctx.logger.info("Power-off and undeploy VApp {0}".format(vapp_name))
-        task = vapp.undeploy()
-        if not task:
-            raise cfy_exc.NonRecoverableError("Could not undeploy vApp")
-        wait_for_task(vca_client, task)
+        def undeploy():
+            vapp_name = get_vapp_name(ctx.instance.runtime_properties)
+            config = get_vcloud_config()
+            vdc = vca_client.get_vdc(config['vdc'])
+            vapp = vca_client.get_vapp(vdc, vapp_name)
+            ctx.logger.info("Power-off and undeploy VApp {0}"
+                            .format(vapp_name))
+            task = vapp.undeploy()
+            if not task:
+                raise cfy_exc.NonRecoverableError("Could not undeploy vApp")
+            return task
+
+        if bulk.is_bulk():
+            bulk.run_bulk(vca_client, bulk.UNDEPLOY,
+                          get_vapp_name(ctx.instance.runtime_properties))
+        elif run_task(vca_client, UNDEPLOY_TASK, undeploy):
+            return retry_for_task(UNDEPLOY_TASK)
 
 
 @operation
@@ -236,17 +365,25 @@ def delete(vca_client, **kwargs):
         ctx.logger.info('not deleting server since an external server is '
                         'being used')
     else:
-        vapp_name = get_vapp_name(ctx.instance.runtime_properties)
-        config = get_vcloud_config()
-        vdc = vca_client.get_vdc(config['vdc'])
-        vapp = vca_client.get_vapp(vdc, vapp_name)
-        ctx.logger.info("Deleting VApp {0}".format(vapp_name))
-        task = vapp.delete()
-        if not task:
-            raise cfy_exc.NonRecoverableError("Could not delete vApp")
-        wait_for_task(vca_client, task)
+        def delete_vapp():
+            vapp_name = get_vapp_name(ctx.instance.runtime_properties)
+            config = get_vcloud_config()
+            vdc = vca_client.get_vdc(config['vdc'])
+            vapp = vca_client.get_vapp(vdc, vapp_name)
+            ctx.logger.info("Deleting VApp {0}".format(vapp_name))
+            task = vapp.delete()
+            if not task:
+                raise cfy_exc.NonRecoverableError("Could not delete vApp")
+            return task
+
+        if bulk.is_bulk():
+            bulk.run_bulk(vca_client, bulk.DELETE,
+                          get_vapp_name(ctx.instance.runtime_properties))
+        elif run_task(vca_client, DELETE_VAPP_TASK, delete_vapp):
+            return retry_for_task(DELETE_VAPP_TASK)
 
     del ctx.instance.runtime_properties[VCLOUD_VAPP_NAME]
+    ctx.instance.runtime_properties.pop(VCLOUD_VM_HREF, None)
 
 
 def _get_management_network_from_node():
@@ -263,10 +400,14 @@ def _get_management_network_from_node():
 
 def _get_state(vca_client):
     vapp_name = get_vapp_name(ctx.instance.runtime_properties)
-    config = get_vcloud_config()
-    vdc = vca_client.get_vdc(config['vdc'])
-    vapp = vca_client.get_vapp(vdc, vapp_name)
-    nw_connections = _get_vm_network_connections(vapp)
+    if ctx.node.properties.get('server', {}).get('ip_probe'):
+        nw_connections = _probe_vm_network_connections(vca_client,
+                                                       vapp_name)
+    else:
+        config = get_vcloud_config()
+        vdc = vca_client.get_vdc(config['vdc'])
+        vapp = vca_client.get_vapp(vdc, vapp_name)
+        nw_connections = _get_vm_network_connections(vapp)
     if len(nw_connections) == 0:
         ctx.logger.info("No networks connected")
         ctx.instance.runtime_properties['ip'] = None
@@ -291,6 +432,34 @@ def _get_state(vca_client):
     return False
 
 
+def _probe_vm_network_connections(vca_client, vapp_name):
+    """
+        connected NICs of VM from its network connection section only,
+        section is requested again with growing intervals until all NICs
+        have IPs or probe deadline is reached
+    """
+    vm_href = ctx.instance.runtime_properties.get(VCLOUD_VM_HREF)
+    if not vm_href:
+        vm_href = get_vm_href(vca_client, get_vcloud_config()['vdc'],
+                              vapp_name)
+        if not vm_href:
+            raise cfy_exc.NonRecoverableError(
+                "VM of vApp {0} could not be found".format(vapp_name))
+        ctx.instance.runtime_properties[VCLOUD_VM_HREF] = vm_href
+    strategy = PollingStrategy(deadline=IP_PROBE_DEADLINE,
+                               min_interval=IP_PROBE_MIN_INTERVAL,
+                               max_interval=IP_PROBE_MAX_INTERVAL)
+    while True:
+        connections = [
+            connection for connection
+            in get_vm_network_connections(vca_client, vm_href)
+            if connection['is_connected']]
+        if all(connection['ip'] for connection in connections) or \
+                strategy.is_expired():
+            return connections
+        time.sleep(strategy.next_interval())
+
+
 def _vapp_is_on(vapp):
     return vapp.me.get_status() == STATUS_POWERED_ON
 
@@ -375,10 +544,6 @@ def _create_connections_list(vca_client):
 
     management_network_name = _get_management_network_from_node()
 
-    if not is_network_exists(vca_client, management_network_name):
-        raise cfy_exc.NonRecoverableError(
-            "Network {0} could not be found".format(management_network_name))
-
     for port in ports:
         port_properties = port.node.properties['port']
         connections.append(
@@ -403,14 +568,12 @@ def _create_connections_list(vca_client):
                                                          False),
                                    connections)) > 0
 
+    _check_networks(vca_client, management_network_name, sorted(set(
+        conn['network'] for conn in connections
+        if conn['ip_allocation_mode'] == 'DHCP')))
+
     for conn in connections:
         network_name = conn['network']
-        if (conn['ip_allocation_mode'] == 'DHCP'
-                and not _isDhcpAvailable(vca_client, network_name)):
-            raise cfy_exc.NonRecoverableError(
-                "DHCP for network {0} is not available"
-                .format(network_name))
-
         if primary_iface_set is False:
             conn['primary_interface'] = \
                 (network_name == management_network_name)
@@ -418,6 +581,28 @@ def _create_connections_list(vca_client):
     return connections
 
 
+def _check_networks(vca_client, management_network_name, dhcp_networks):
+    """
+        check management network and DHCP of networks with independent
+        requests in parallel
+    """
+    def dhcp_check(network_name):
+        return lambda client: _isDhcpAvailable(client, network_name)
+
+    results = run_parallel_clients(
+        vca_client,
+        [lambda client: is_network_exists(client, management_network_name)] +
+        [dhcp_check(network_name) for network_name in dhcp_networks])
+    if not results[0]:
+        raise cfy_exc.NonRecoverableError(
+            "Network {0} could not be found".format(management_network_name))
+    for network_name, available in zip(dhcp_networks, results[1:]):
+        if not available:
+            raise cfy_exc.NonRecoverableError(
+                "DHCP for network {0} is not available"
+                .format(network_name))
+
+
 def _get_connected(instance, prop):
     relationships = getattr(instance, 'relationships', None)
     if relationships:
@@ -0,0 +1,238 @@
+# Copyright (c) 2014 GigaSpaces Technologies Ltd. All rights reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+#  * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  * See the License for the specific language governing permissions and
+#  * limitations under the License.
+
+from xml.etree import ElementTree
+from xml.sax.saxutils import escape, quoteattr
+
+from cloudify import exceptions as cfy_exc
+import requests
+from pyvcloud.schema.vcd.v1_5.schemas.vcloud import vAppType
+
+from vcloud_plugin_common.query import VCLOUD_NS, find_records
+from vcloud_plugin_common.transport import get_transport
+
+INSTANTIATE_PARAMS_TYPE = \
+    "application/vnd.vmware.vcloud.instantiateVAppTemplateParams+xml"
+
+INSTANTIATE_PARAMS = """<?xml version="1.0" encoding="UTF-8"?>
+<InstantiateVAppTemplateParams
+ xmlns="http://www.vmware.com/vcloud/v1.5"
+ xmlns:ovf="http://schemas.dmtf.org/ovf/envelope/1"
+ xmlns:rasd="http://schemas.dmtf.org/wbem/wscim/1/cim-schema/2/CIM_ResourceAllocationSettingData"
+ name={0} deploy="false" powerOn="false">
+{1}
+<Source href={2}/>
+<SourcedItem>
+<Source href={3}/>
+<VmGeneralParams><Name>{4}</Name></VmGeneralParams>
+{5}
+</SourcedItem>
+<AllEULAsAccepted>true</AllEULAsAccepted>
+</InstantiateVAppTemplateParams>
+"""
+NETWORK_CONFIG_SECTION = """<NetworkConfigSection>
+<ovf:Info>Configuration parameters for logical networks</ovf:Info>
+{0}
+</NetworkConfigSection>"""
+NETWORK_CONFIG = """<NetworkConfig networkName={0}>
+<Configuration><ParentNetwork href={1}/><FenceMode>bridged</FenceMode></Configuration>
+</NetworkConfig>"""
+HARDWARE_SECTION = """<ovf:VirtualHardwareSection>
+<ovf:Info>Virtual hardware requirements</ovf:Info>
+{0}
+</ovf:VirtualHardwareSection>"""
+HARDWARE_ITEM = """<ovf:Item>
+<rasd:AllocationUnits>{0}</rasd:AllocationUnits>
+<rasd:Description>{1}</rasd:Description>
+<rasd:ElementName>{2}</rasd:ElementName>
+<rasd:InstanceID>{3}</rasd:InstanceID>
+<rasd:ResourceType>{4}</rasd:ResourceType>
+<rasd:VirtualQuantity>{5}</rasd:VirtualQuantity>
+</ovf:Item>"""
+NETWORK_CONNECTION_SECTION = """<NetworkConnectionSection>
+<ovf:Info>Network connection</ovf:Info>
+{0}
+</NetworkConnectionSection>"""
+INSTANTIATION_PARAMS = """<InstantiationParams>
+{0}
+</InstantiationParams>"""
+GUEST_CUSTOMIZATION_SECTION = """<GuestCustomizationSection>
+<ovf:Info>Guest customization</ovf:Info>
+{0}
+</GuestCustomizationSection>"""
+
+
+def _text(value):
+    # body is utf-8 encoded str
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    return str(value)
+
+
+def _attr(value):
+    return quoteattr(_text(value))
+
+
+def _tag(name, value):
+    return "<{0}>{1}</{0}>".format(name, escape(_text(value)))
+
+
+def get_template_hrefs(vca_client, catalog_name, template_name):
+    """
+        hrefs of vApp template and its VM for catalog item
+    """
+    items = find_records(vca_client, 'catalogItem', name=template_name,
+                         catalogName=catalog_name)
+    if not items or not items[0].get('entity'):
+        raise cfy_exc.NonRecoverableError(
+            "Template {0} could not be found in catalog {1}"
+            .format(template_name, catalog_name))
+    template_href = items[0]['entity']
+    response = get_transport().get(
+        template_href,
+        headers=vca_client.vcloud_session.get_vcloud_headers())
+    if response.status_code != requests.codes.ok:
+        raise cfy_exc.NonRecoverableError(
+            "Could not get template {0}: {1}"
+            .format(template_name, response.content))
+    vms = ElementTree.fromstring(response.content).iter(VCLOUD_NS + 'Vm')
+    vm_hrefs = [vm.get('href') for vm in vms]
+    if not vm_hrefs:
+        raise cfy_exc.NonRecoverableError(
+            "Template {0} has no VMs".format(template_name))
+    return template_href, vm_hrefs[0]
+
+
+def hardware_section(cpu=None, memory=None):
+    items = []
+    if cpu:
+        items.append(HARDWARE_ITEM.format(
+            "hertz * 10^6", "Number of Virtual CPUs",
+            "{0} virtual CPU(s)".format(cpu), 1, 3, cpu))
+    if memory:
+        items.append(HARDWARE_ITEM.format(
+            "byte * 2^20", "Memory Size",
+            "{0} MB of memory".format(memory), 2, 4, memory))
+    if items:
+        return HARDWARE_SECTION.format("\n".join(items))
+
+
+def network_config_section(networks):
+    """
+        vApp networks for list of (name, href)
+    """
+    if networks:
+        return NETWORK_CONFIG_SECTION.format("\n".join(
+            NETWORK_CONFIG.format(_attr(name), _attr(href))
+            for name, href in networks))
+
+
+def network_connection_section(connections):
+    """
+        NICs of VM for list of connections as in
+        vapp_networks.network_connection_section
+    """
+    if not connections:
+        return None
+    content = []
+    for connection in connections:
+        if connection.get('primary_interface'):
+            content = [_tag('PrimaryNetworkConnectionIndex',
+                            connection['index'])]
+    for connection in connections:
+        ip_allocation_mode = connection['ip_allocation_mode']
+        nic = [_tag('NetworkConnectionIndex', connection['index'])]
+        if connection.get('ip_address') and ip_allocation_mode == 'MANUAL':
+            nic.append(_tag('IpAddress', connection['ip_address']))
+        nic.append(_tag('IsConnected', 'true'))
+        if connection.get('mac_address'):
+            nic.append(_tag('MACAddress', connection['mac_address']))
+        nic.append(_tag('IpAddressAllocationMode', ip_allocation_mode))
+        content.append("<NetworkConnection network={0}>{1}"
+                       "</NetworkConnection>"
+                       .format(_attr(connection['network']),
+                               "".join(nic)))
+    return NETWORK_CONNECTION_SECTION.format("\n".join(content))
+
+
+def guest_customization_section(script=None, computer_name=None,
+                                admin_password=None):
+    """
+        customization that runs on first power on of VM, the same
+        settings as pyvcloud customize_guest_os
+    """
+    content = [_tag('Enabled', 'true')]
+    if admin_password:
+        content.extend([_tag('AdminPasswordEnabled', 'true'),
+                        _tag('AdminPasswordAuto', 'false'),
+                        _tag('AdminPassword', admin_password)])
+    content.extend([_tag('AdminAutoLogonEnabled', 'false'),
+                    _tag('AdminAutoLogonCount', 0),
+                    _tag('ResetPasswordRequired', 'false')])
+    if script:
+        content.append(_tag('CustomizationScript', script))
+    if computer_name:
+        content.append(_tag('ComputerName', computer_name))
+    return GUEST_CUSTOMIZATION_SECTION.format("\n".join(content))
+
+
+def instantiate_params(vapp_name, template_href, vm_href, vm_name,
+                       networks=None, connections=None, cpu=None,
+                       memory=None, customization=None):
+    """
+        body of InstantiateVAppTemplateParams with hardware, networks and
+        guest customization of VM, customization is dict of
+        guest_customization_section arguments or None
+    """
+    vm_sections = [hardware_section(cpu, memory),
+                   network_connection_section(connections)]
+    if customization is not None:
+        vm_sections.append(guest_customization_section(**customization))
+    return INSTANTIATE_PARAMS.format(
+        _attr(vapp_name),
+        _instantiation_params([network_config_section(networks)]),
+        _attr(template_href), _attr(vm_href), escape(_text(vm_name)),
+        _instantiation_params(vm_sections))
+
+
+def _instantiation_params(sections):
+    sections = [section for section in sections if section]
+    if sections:
+        return INSTANTIATION_PARAMS.format("\n".join(sections))
+    return ''
+
+
+def compose_vapp(vca_client, vdc_name, body):
+    """
+        instantiate vApp template with single request, return task of
+        new vApp
+    """
+    vdc = vca_client.get_vdc(vdc_name)
+    if not vdc:
+        raise cfy_exc.NonRecoverableError(
+            "vdc {0} could not be found".format(vdc_name))
+    links = [link for link in vdc.get_Link()
+             if link.get_type() == INSTANTIATE_PARAMS_TYPE]
+    if not links:
+        raise cfy_exc.NonRecoverableError(
+            "vApp can't be instantiated in vdc {0}".format(vdc_name))
+    headers = dict(vca_client.vcloud_session.get_vcloud_headers())
+    headers['Content-Type'] = INSTANTIATE_PARAMS_TYPE
+    response = get_transport().post(links[0].get_href(), data=body,
+                                    headers=headers)
+    if response.status_code != requests.codes.created:
+        raise cfy_exc.NonRecoverableError(
+            "Could not create vApp: {0}".format(response.content))
+    vapp = vAppType.parseString(response.content, True)
+    return vapp.get_Tasks().get_Task()[0]
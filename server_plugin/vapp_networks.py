@@ -0,0 +1,225 @@
+# Copyright (c) 2014 GigaSpaces Technologies Ltd. All rights reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+#  * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  * See the License for the specific language governing permissions and
+#  * limitations under the License.
+
+import re
+from StringIO import StringIO
+from xml.etree import ElementTree
+
+from cloudify import exceptions as cfy_exc
+import requests
+from pyvcloud.schema.vcd.v1_5.schemas.vcloud import taskType, vAppType
+
+from vcloud_plugin_common import wait_for_task, wait_for_tasks
+from vcloud_plugin_common.query import VCLOUD_NS, find_records
+from vcloud_plugin_common.transport import get_transport
+
+NETWORK_CONFIG_SECTION_TYPE = \
+    "application/vnd.vmware.vcloud.networkConfigSection+xml"
+NETWORK_CONFIG_NAMESPACES = (
+    'xmlns="http://www.vmware.com/vcloud/v1.5" '
+    'xmlns:ovf="http://schemas.dmtf.org/ovf/envelope/1"')
+NETWORK_CONNECTION_NAMESPACES = (
+    'xmlns="http://www.vmware.com/vcloud/v1.5" '
+    'xmlns:vmw="http://www.vmware.com/vcloud/v1.5" '
+    'xmlns:ovf="http://schemas.dmtf.org/ovf/envelope/1"')
+
+
+def _get_section(sections, type_name):
+    # class is compared by name as pyvcloud does, sections can be parsed
+    # by different generated modules
+    for section in sections or []:
+        if section.__class__.__name__ == type_name:
+            return section
+
+
+def _info(text):
+    info = vAppType.Msg_Type()
+    info.set_valueOf_(text)
+    return info
+
+
+def network_config_section(vapp, networks, fence_mode='bridged'):
+    """
+        NetworkConfigSection of vApp with all networks from list of
+        (name, href) added, None if vApp already has all of them
+    """
+    section = _get_section(vapp.me.get_Section(), "NetworkConfigSectionType")
+    if section is None:
+        raise cfy_exc.NonRecoverableError(
+            "vApp {0} has no network config section".format(vapp.name))
+    existing = set(config.get_networkName()
+                   for config in section.get_NetworkConfig())
+    added = False
+    for name, href in networks:
+        if name in existing:
+            continue
+        existing.add(name)
+        configuration = vAppType.NetworkConfigurationType()
+        configuration.set_ParentNetwork(vAppType.ReferenceType(href=href))
+        configuration.set_FenceMode(fence_mode)
+        config = vAppType.VAppNetworkConfigurationType()
+        config.set_networkName(name)
+        config.set_Configuration(configuration)
+        section.add_NetworkConfig(config)
+        added = True
+    if not added:
+        return None
+    if section.get_Info() is None:
+        section.set_Info(
+            _info("Configuration parameters for logical networks"))
+    return section
+
+
+def network_connection_section(vm, connections):
+    """
+        NetworkConnectionSection of VM with NICs for all connections,
+        None if VM is already connected to all networks; connections
+        is list of dicts with network, index, primary_interface,
+        ip_allocation_mode, mac_address and ip_address
+    """
+    section = _get_section(vm.get_Section(), "NetworkConnectionSectionType")
+    if section is None:
+        raise cfy_exc.NonRecoverableError(
+            "VM {0} has no network connection section"
+            .format(vm.get_name()))
+    existing = set(connection.get_network().lower()
+                   for connection in section.get_NetworkConnection())
+    added = False
+    for connection in connections:
+        network_name = connection['network']
+        if network_name.lower() in existing:
+            continue
+        existing.add(network_name.lower())
+        ip_allocation_mode = connection['ip_allocation_mode']
+        nic = vAppType.NetworkConnectionType()
+        nic.set_network(network_name)
+        nic.set_NetworkConnectionIndex(connection['index'])
+        nic.set_IpAddressAllocationMode(ip_allocation_mode)
+        nic.set_IsConnected(True)
+        if connection.get('ip_address') and ip_allocation_mode == 'MANUAL':
+            nic.set_IpAddress(connection['ip_address'])
+        if connection.get('mac_address'):
+            nic.set_MACAddress(connection['mac_address'])
+        section.add_NetworkConnection(nic)
+        if connection.get('primary_interface'):
+            section.set_PrimaryNetworkConnectionIndex(connection['index'])
+        added = True
+    if not added:
+        return None
+    if section.get_Info() is None:
+        section.set_Info(_info("Network connection"))
+    return section
+
+
+def _export(section, name, namespaces):
+    output = StringIO()
+    section.export(output, 0, name_=name, namespacedef_=namespaces,
+                   pretty_print=False)
+    # Info of section belongs to ovf namespace, generated classes export
+    # it in vcloud namespace
+    body = re.sub(r'<vmw:Info[^>]*>', '<ovf:Info>', output.getvalue())
+    return body.replace('</vmw:Info>', '</ovf:Info>')
+
+
+def _put(vapp, href, body, description):
+    response = get_transport().put(href, data=body, headers=vapp.headers,
+                                   verify=vapp.verify)
+    if response.status_code != requests.codes.accepted:
+        raise cfy_exc.NonRecoverableError(
+            "Could not {0} of vApp {1}: {2}"
+            .format(description, vapp.name, response.content))
+    return taskType.parseString(response.content, True)
+
+
+def connect_networks(vca_client, vapp, networks, connections):
+    """
+        attach vApp and its VMs to all networks with one reconfigure
+        task per section instead of two tasks per NIC: networks are
+        added to NetworkConfigSection of vApp, then NICs of all
+        connections to NetworkConnectionSection of each VM
+    """
+    config_section = network_config_section(vapp, networks)
+    if config_section is not None:
+        links = [link for link in config_section.get_Link()
+                 if link.get_type() == NETWORK_CONFIG_SECTION_TYPE]
+        if not links:
+            raise cfy_exc.NonRecoverableError(
+                "vApp {0} network config section can't be changed"
+                .format(vapp.name))
+        body = _export(config_section, 'NetworkConfigSection',
+                       NETWORK_CONFIG_NAMESPACES).replace("vmw:", "")
+        wait_for_task(vca_client, _put(vapp, links[0].get_href(), body,
+                                       "add networks"))
+    tasks = []
+    children = vapp.me.get_Children()
+    for vm in children.get_Vm() if children else []:
+        connection_section = network_connection_section(vm, connections)
+        if connection_section is None:
+            continue
+        body = _export(connection_section, 'NetworkConnectionSection',
+                       NETWORK_CONNECTION_NAMESPACES)
+        tasks.append(_put(vapp, vm.get_href() + "/networkConnectionSection/",
+                          body, "connect VMs to networks"))
+    if tasks:
+        wait_for_tasks(vca_client, tasks)
+
+
+def get_vm_href(vca_client, vdc_name, vapp_name):
+    """
+        href of VM in vApp of vdc from query records, None if there is
+        no such vApp or VM; VM is looked up by href of its vApp, names
+        of vApps are unique only in vdc
+    """
+    vapps = find_records(vca_client, 'vApp', name=vapp_name,
+                         vdcName=vdc_name)
+    if not vapps:
+        return None
+    records = find_records(vca_client, 'vm', container=vapps[0].get('href'),
+                           isVAppTemplate='false')
+    if len(records) > 1:
+        raise cfy_exc.NonRecoverableError(
+            "vApp {0} has {1} VMs, VM for server can't be chosen"
+            .format(vapp_name, len(records)))
+    if records:
+        return records[0].get('href')
+
+
+def get_vm_network_connections(vca_client, vm_href):
+    """
+        NICs of VM from its NetworkConnectionSection only, in the same
+        form as get_vms_network_info of pyvcloud
+    """
+    response = get_transport().get(
+        vm_href + "/networkConnectionSection/",
+        headers=vca_client.vcloud_session.get_vcloud_headers())
+    if response.status_code != requests.codes.ok:
+        raise cfy_exc.NonRecoverableError(
+            "Could not get network connections of VM {0}: {1}"
+            .format(vm_href, response.content))
+    connections = []
+    root = ElementTree.fromstring(response.content)
+    primary_index = root.findtext(VCLOUD_NS + 'PrimaryNetworkConnectionIndex')
+    for nic in root.iter(VCLOUD_NS + 'NetworkConnection'):
+        connections.append({
+            'network_name': nic.get('network'),
+            'ip': nic.findtext(VCLOUD_NS + 'IpAddress'),
+            'mac': nic.findtext(VCLOUD_NS + 'MACAddress'),
+            'is_connected':
+                nic.findtext(VCLOUD_NS + 'IsConnected') == 'true',
+            'is_primary': nic.findtext(
+                VCLOUD_NS + 'NetworkConnectionIndex') == primary_index,
+            'allocation_mode':
+                nic.findtext(VCLOUD_NS + 'IpAddressAllocationMode')
+        })
+    return connections
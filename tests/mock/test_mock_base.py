@@ -1,6 +1,7 @@
 import mock
 import unittest
 from cloudify import mocks as cfy_mocks
+from pyvcloud.schema.vcd.v1_5.schemas.vcloud import networkType
 from network_plugin import BUSY_MESSAGE, NAT_ROUTED
 
 
@@ -89,6 +90,8 @@ class TestBase(unittest.TestCase):
         gate.is_fw_enabled = mock.MagicMock(return_value=True)
         # dont have any nat rules
         gate.get_nat_rules = mock.MagicMock(return_value=[])
+        # dont have any firewall rules
+        gate.get_fw_rules = mock.MagicMock(return_value=[])
         # cant deallocate ip
         gate.deallocate_public_ip = mock.MagicMock(return_value=None)
         # public ips not exist
@@ -124,6 +127,23 @@ class TestBase(unittest.TestCase):
         )
         return network
 
+    def generate_find_records(self, records=None):
+        """
+            fake lookup with query service, records is dict of lists of
+            records by query type, records are filtered by conditions
+        """
+        if records is None:
+            records = {
+                'catalog': [{'name': 'public'}],
+                'catalogItem': [{'name': 'secret', 'catalogName': 'public'}]
+            }
+
+        def _find_records(vca_client, query_type, **conditions):
+            return [record for record in records.get(query_type, [])
+                    if all([record.get(name) == value
+                            for name, value in conditions.items()])]
+        return _find_records
+
     def generate_nat_rule(
         self, rule_type, original_ip, original_port, translated_ip,
         translated_port, protocol
@@ -139,6 +159,19 @@ class TestBase(unittest.TestCase):
         rule_inlist.get_GatewayNatRule = mock.MagicMock(return_value=rule)
         return rule_inlist
 
+    def generate_fw_rule(
+        self, protocol, dest_port, dest_ip, source_port, source_ip,
+        action='allow', description='rule', enabled=True, log=False
+    ):
+        protocols = ['Tcp', 'Udp'] if protocol == 'Tcpudp' else [protocol]
+        return networkType.FirewallRuleType(
+            IsEnabled=enabled, Description=description, Policy=action,
+            Protocols=networkType.ProtocolsType(**dict(
+                (name, True) for name in protocols)),
+            DestinationPortRange=dest_port, DestinationIp=dest_ip,
+            SourcePortRange=source_port, SourceIp=source_ip,
+            EnableLogging=log)
+
     def genarate_pool(self, name, low_ip, high_ip):
         pool = mock.Mock()
         pool.Network = mock.Mock()
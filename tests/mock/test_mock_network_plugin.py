@@ -111,6 +111,90 @@ class NetworkPluginMockTestCase(test_mock_base.TestBase):
         with self.assertRaises(cfy_exc.NonRecoverableError):
             network_plugin.getFreeIP(gateway)
 
+    def test_nat_rule_index(self):
+        gateway = self.generate_gateway()
+        snat = self.generate_nat_rule(
+            'SNAT', 'internal', 'any', '10.18.1.1', 'any', 'any'
+        )
+        dnat = self.generate_nat_rule(
+            'DNAT', '10.18.1.2', '22', 'internal', '22', 'TCP'
+        )
+        undefined = self.generate_nat_rule(
+            'DNAT', '10.18.1.3', None, 'other', '22', 'TCP'
+        )
+        gateway.get_nat_rules = mock.MagicMock(
+            return_value=[snat, dnat, undefined])
+        index = network_plugin.NatRuleIndex.from_gateway(gateway)
+        # rules are requested once for all checks
+        self.assertEqual(gateway.get_nat_rules.call_count, 1)
+        self.assertEqual(
+            index.external_ips(),
+            set(['10.18.1.1', '10.18.1.2', '10.18.1.3']))
+        self.assertTrue(index.is_external_assigned('10.18.1.2'))
+        self.assertFalse(index.is_external_assigned('internal'))
+        self.assertTrue(index.is_internal_assigned('internal'))
+        self.assertEqual(index.by_internal['internal'], [snat, dnat])
+        # case insensitive, ports can be int
+        self.assertEqual(
+            index.find_rules('dnat', '10.18.1.2', 22, 'internal', '22',
+                             'tcp'),
+            [dnat])
+        self.assertFalse(index.is_rule_exists(
+            'DNAT', '10.18.1.2', 23, 'internal', '22', 'TCP'))
+        # rule with undefined field is never equal
+        self.assertFalse(index.is_rule_exists(
+            'DNAT', '10.18.1.3', None, 'other', '22', 'TCP'))
+        # checks with prepared index
+        gateway.get_public_ips = mock.MagicMock(return_value=[
+            '10.18.1.1', '10.18.1.4'
+        ])
+        self.assertEqual(
+            network_plugin.getFreeIP(gateway, index), '10.18.1.4')
+        network_plugin.CheckAssignedInternalIp('free', gateway, index)
+        with self.assertRaises(cfy_exc.NonRecoverableError):
+            network_plugin.CheckAssignedExternalIp(
+                '10.18.1.1', gateway, index)
+        self.assertEqual(gateway.get_nat_rules.call_count, 1)
+
+    def test_port_occupancy(self):
+        ports = network_plugin.PortOccupancy([22, '80', 81])
+        self.assertFalse(ports.is_free(22))
+        self.assertTrue(ports.is_free('23'))
+        self.assertEqual(ports.next_free(1), 1)
+        self.assertEqual(ports.next_free(80), 82)
+        self.assertEqual(ports.next_free('22'), 23)
+        # several ports for set of rules
+        self.assertEqual(ports.find_free(79, 3), [79, 82, 83])
+        ports.reserve(79, 82)
+        self.assertEqual(ports.next_free(79), 83)
+        # no free ports up to maximum
+        ports.reserve(network_plugin.MAX_PORT_NUMBER)
+        self.assertEqual(
+            ports.next_free(network_plugin.MAX_PORT_NUMBER), None)
+        self.assertEqual(
+            ports.find_free(network_plugin.MAX_PORT_NUMBER - 1, 2), None)
+        # ports of rules in index
+        gateway = self.generate_gateway()
+        gateway.get_nat_rules = mock.MagicMock(return_value=[
+            self.generate_nat_rule(
+                'DNAT', '10.18.1.1', '22', 'internal', '22', 'TCP'),
+            self.generate_nat_rule(
+                'DNAT', '10.18.1.1', '23', 'internal', '22', 'TCP'),
+            self.generate_nat_rule(
+                'DNAT', '10.18.1.1', '24', 'internal', '22', 'UDP'),
+            self.generate_nat_rule(
+                'DNAT', '10.18.1.1', 'any', 'internal', 'any', 'any')
+        ])
+        index = network_plugin.NatRuleIndex.from_gateway(gateway)
+        self.assertEqual(
+            index.port_occupancy(
+                'dnat', '10.18.1.1', 'internal', 22, 'tcp').next_free(22),
+            24)
+        self.assertEqual(
+            index.port_occupancy(
+                'DNAT', '10.18.1.1', 'internal', '22', 'UDP').next_free(22),
+            22)
+
     def test_del_ondemand_public_ip(self):
         vca_client = self.generate_client()
         gateway = self.generate_gateway()
@@ -292,13 +376,14 @@ class NetworkPluginMockTestCase(test_mock_base.TestBase):
         )
         fake_ctx = self.generate_node_context()
         # for subscription we dont use client
-        self.assertEqual(
-            network_plugin.get_public_ip(
-                None, gateway,
-                vcloud_plugin_common.SUBSCRIPTION_SERVICE_TYPE, fake_ctx
-            ),
-            '10.18.1.2'
-        )
+        with mock.patch('vcloud_plugin_common.ctx', fake_ctx):
+            self.assertEqual(
+                network_plugin.get_public_ip(
+                    None, gateway,
+                    vcloud_plugin_common.SUBSCRIPTION_SERVICE_TYPE, fake_ctx
+                ),
+                '10.18.1.2'
+            )
         #TODO add ondemand test
 
 if __name__ == '__main__':
@@ -0,0 +1,252 @@
+import json
+import mock
+import shutil
+import tempfile
+import unittest
+
+from cloudify import exceptions as cfy_exc
+import test_mock_base
+import network_plugin
+from network_plugin import firewall
+from network_plugin import gateway_changes
+import vcloud_plugin_common
+from vcloud_plugin_common import work_queue
+
+
+class NetworkPluginGatewayChangesMockTestCase(test_mock_base.TestBase):
+
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.work_dir)
+
+    def test_recording_gateway(self):
+        gateway = self.generate_gateway()
+        recording = gateway_changes.RecordingGateway(
+            gateway, 'key', 'vdc', 'gateway')
+        recording.add_nat_rule('DNAT', '1.1.1.1', 'any', '2.2.2.2', 'any',
+                               'any')
+        recording.delete_dhcp_pool('network')
+        recording.get_nat_rules()
+        gateway.add_nat_rule.assert_called_with(
+            'DNAT', '1.1.1.1', 'any', '2.2.2.2', 'any', 'any')
+        self.assertEqual(recording.changes, [
+            ['add_nat_rule',
+             ['DNAT', '1.1.1.1', 'any', '2.2.2.2', 'any', 'any']],
+            ['delete_dhcp_pool', ['network']]
+        ])
+        # the same changes for other gateway
+        other = self.generate_gateway()
+        gateway_changes.apply_changes(other, recording.changes)
+        other.add_nat_rule.assert_called_with(
+            'DNAT', '1.1.1.1', 'any', '2.2.2.2', 'any', 'any')
+        other.delete_dhcp_pool.assert_called_with('network')
+
+    def test_recording_fw_rules(self):
+        def fw_gateway(fw_rules):
+            gateway = self.generate_gateway()
+            gateway.get_fw_rules = mock.MagicMock(return_value=fw_rules)
+            return gateway
+
+        disabled = self.generate_fw_rule(
+            'Tcpudp', '53', 'external', 'Any', 'Any', enabled=False)
+        extra = self.generate_fw_rule('Tcp', '22', 'external', 'Any', 'Any')
+        recording = gateway_changes.RecordingGateway(
+            fw_gateway([disabled, extra]), 'key', 'vdc', 'gateway')
+        gateway_changes.change_gateway(
+            recording, 'replace_fw_rules',
+            [firewall.gateway_rule_fields(extra)],
+            [firewall.rule_fields(firewall.FirewallRule(
+                'dns', 'allow', 'Tcpudp', '53', 'external', 'Any', 'Any',
+                True))])
+        # changes are saved as json and applied to fresh gateway
+        changes = json.loads(json.dumps(recording.changes))
+        other = fw_gateway([
+            disabled,
+            self.generate_fw_rule('Tcp', '22', 'external', 'Any', 'Any')])
+        gateway_changes.apply_changes(other, changes)
+        fw_rules = other._getFirewallService().set_FirewallRule.call_args[
+            0][0]
+        self.assertEqual(len(fw_rules), 2)
+        self.assertTrue(fw_rules[0] is disabled)
+        self.assertEqual(
+            firewall.get_protocol(fw_rules[1].get_Protocols()), 'Tcpudp')
+        self.assertTrue(fw_rules[1].get_EnableLogging())
+
+    def test_gateway_key(self):
+        key = gateway_changes.gateway_key(
+            {'url': 'https://host', 'org': 'org', 'vdc': 'vdc'}, 'gateway')
+        self.assertEqual(key, gateway_changes.gateway_key(
+            {'url': 'https://host', 'org': 'org', 'vdc': 'vdc',
+             'username': 'user'}, 'gateway'))
+        self.assertNotEqual(key, gateway_changes.gateway_key(
+            {'url': 'https://host', 'org': 'org', 'vdc': 'vdc'}, 'other'))
+
+    def generate_deferred_context(self):
+        return self.generate_node_context(properties={
+            'vcloud_config': {
+                'vdc': 'vdc_name',
+                'gateway_deferred_commit': True,
+                'gateway_commit_delay': 0,
+                'gateway_changes_path': self.work_dir
+            }
+        })
+
+    def test_write_queue(self):
+        fake_ctx = self.generate_node_context(properties={
+            'vcloud_config': {
+                'vdc': 'vdc_name',
+                'gateway_write_queue': True,
+                'gateway_commit_delay': 5,
+                'gateway_changes_path': self.work_dir
+            }
+        })
+        fake_client = self.generate_client()
+        gateway = fake_client._vdc_gateway
+        self.set_services_conf_result(
+            gateway, vcloud_plugin_common.TASK_STATUS_SUCCESS)
+        fake_sleep = mock.MagicMock()
+        with mock.patch('vcloud_plugin_common.ctx', fake_ctx):
+            with mock.patch('network_plugin.ctx', fake_ctx):
+                with mock.patch('network_plugin.time.sleep', fake_sleep):
+                    recording = network_plugin.get_gateway(
+                        fake_client, 'gateway')
+                    recording.delete_dhcp_pool('network')
+                    self.assertTrue(
+                        network_plugin.save_gateway_configuration(
+                            recording, fake_client))
+        # no delay for batching without deferred commit
+        self.assertFalse(fake_sleep.called)
+        self.assertEqual(gateway.save_services_configuration.call_count, 1)
+
+    def test_deferred_commit(self):
+        fake_client = self.generate_client()
+        fake_ctx = self.generate_deferred_context()
+        gateway = fake_client._vdc_gateway
+        self.set_services_conf_result(
+            gateway, vcloud_plugin_common.TASK_STATUS_SUCCESS)
+        with mock.patch('vcloud_plugin_common.ctx', fake_ctx):
+            with mock.patch('network_plugin.ctx', fake_ctx):
+                recording = network_plugin.get_gateway(
+                    fake_client, 'gateway')
+                self.assertTrue(isinstance(
+                    recording, gateway_changes.RecordingGateway))
+                # nothing to save
+                self.assertTrue(network_plugin.save_gateway_configuration(
+                    recording, fake_client))
+                self.assertFalse(gateway.save_services_configuration.called)
+                # changes of other operation are committed together
+                store = gateway_changes.ChangeSetStore(self.work_dir)
+                other_id = store.add(recording.key, [
+                    ['del_nat_rule',
+                     ['SNAT', '3.3.3.3', 'any', '4.4.4.4', 'any', 'any']]
+                ])
+                recording.add_nat_rule(
+                    'SNAT', '1.1.1.1', 'any', '2.2.2.2', 'any', 'any')
+                gateway.add_nat_rule.reset_mock()
+                self.assertTrue(network_plugin.save_gateway_configuration(
+                    recording, fake_client))
+                self.assertEqual(
+                    gateway.save_services_configuration.call_count, 1)
+                gateway.add_nat_rule.assert_called_once_with(
+                    'SNAT', '1.1.1.1', 'any', '2.2.2.2', 'any', 'any')
+                gateway.del_nat_rule.assert_called_once_with(
+                    'SNAT', '3.3.3.3', 'any', '4.4.4.4', 'any', 'any')
+                self.assertEqual(
+                    store.result(recording.key, other_id)['status'],
+                    work_queue.STATUS_SUCCESS)
+                self.assertEqual(recording.changes, [])
+                # gateway is busy, writer waits and commits again
+                gateway.save_services_configuration = mock.MagicMock(
+                    side_effect=[None, self.generate_task(
+                        vcloud_plugin_common.TASK_STATUS_SUCCESS)])
+                self.set_gateway_busy(gateway)
+                recording.delete_dhcp_pool('network')
+                fake_sleep = mock.MagicMock()
+                with mock.patch('network_plugin.time.sleep', fake_sleep):
+                    self.assertTrue(
+                        network_plugin.save_gateway_configuration(
+                            recording, fake_client))
+                self.assertEqual(
+                    gateway.save_services_configuration.call_count, 2)
+                fake_sleep.assert_called_once_with(
+                    network_plugin.GATEWAY_BUSY_MIN_INTERVAL)
+                # gateway is busy for too long
+                self.set_services_conf_result(gateway, None)
+                recording.delete_dhcp_pool('network')
+                with mock.patch('network_plugin.GATEWAY_BUSY_TIMEOUT', -1):
+                    self.assertFalse(
+                        network_plugin.save_gateway_configuration(
+                            recording, fake_client))
+                # error in task
+                self.set_services_conf_result(
+                    gateway, vcloud_plugin_common.TASK_STATUS_ERROR)
+                recording.delete_dhcp_pool('network')
+                with self.assertRaises(cfy_exc.NonRecoverableError):
+                    network_plugin.save_gateway_configuration(
+                        recording, fake_client)
+                self.assertEqual(store.pending(recording.key), [])
+
+    def test_deferred_commit_failed_change_set(self):
+        fake_client = self.generate_client()
+        fake_ctx = self.generate_deferred_context()
+        gateway = fake_client._vdc_gateway
+        self.set_services_conf_result(
+            gateway, vcloud_plugin_common.TASK_STATUS_SUCCESS)
+        gateway.del_nat_rule = mock.MagicMock(
+            side_effect=cfy_exc.NonRecoverableError('rule not found'))
+        with mock.patch('vcloud_plugin_common.ctx', fake_ctx):
+            with mock.patch('network_plugin.ctx', fake_ctx):
+                recording = network_plugin.get_gateway(
+                    fake_client, 'gateway')
+                store = gateway_changes.ChangeSetStore(self.work_dir)
+                good_id = store.add(recording.key, [
+                    ['add_nat_rule',
+                     ['SNAT', '3.3.3.3', 'any', '4.4.4.4', 'any', 'any']]
+                ])
+                bad_id = store.add(recording.key, [
+                    ['del_nat_rule',
+                     ['SNAT', '5.5.5.5', 'any', '6.6.6.6', 'any', 'any']]
+                ])
+                recording.delete_dhcp_pool('network')
+                # only failed change set gets the error
+                self.assertTrue(network_plugin.save_gateway_configuration(
+                    recording, fake_client))
+                self.assertEqual(
+                    store.result(recording.key, good_id)['status'],
+                    work_queue.STATUS_SUCCESS)
+                self.assertEqual(
+                    store.result(recording.key, bad_id),
+                    {'status': work_queue.STATUS_ERROR,
+                     'message': 'rule not found'})
+                self.assertEqual(
+                    gateway.save_services_configuration.call_count, 2)
+                self.assertEqual(store.pending(recording.key), [])
+
+    def test_deferred_commit_by_other_operation(self):
+        fake_client = self.generate_client()
+        fake_ctx = self.generate_deferred_context()
+        gateway = fake_client._vdc_gateway
+        with mock.patch('vcloud_plugin_common.ctx', fake_ctx):
+            recording = network_plugin.get_gateway(fake_client, 'gateway')
+            recording.delete_dhcp_pool('network')
+            store = gateway_changes.ChangeSetStore(self.work_dir)
+
+            # other operation holds lock and commits pending changes
+            def commit_by_other(seconds):
+                for change_id, _ in store.pending(recording.key):
+                    store.complete(recording.key, [change_id],
+                                   work_queue.STATUS_SUCCESS)
+
+            with store.lock(recording.key):
+                with mock.patch('network_plugin.time.sleep',
+                                mock.MagicMock(side_effect=commit_by_other)):
+                    self.assertTrue(
+                        network_plugin.save_gateway_configuration(
+                            recording, fake_client))
+        self.assertFalse(gateway.save_services_configuration.called)
+
+
+if __name__ == '__main__':
+    unittest.main()
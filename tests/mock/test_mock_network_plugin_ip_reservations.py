@@ -0,0 +1,238 @@
+import mock
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+
+from cloudify import exceptions as cfy_exc
+import test_mock_base
+import network_plugin
+import vcloud_plugin_common
+from network_plugin import ip_reservations
+
+
+class NetworkPluginIpReservationsMockTestCase(test_mock_base.TestBase):
+
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.work_dir)
+
+    def test_reservation_store(self):
+        store = ip_reservations.IpReservationStore(self.work_dir, 60)
+        candidates = ['10.18.1.1', '10.18.1.2']
+        self.assertEqual(store.reserve('key', candidates, 'a'), '10.18.1.1')
+        self.assertEqual(store.reserve('key', candidates, 'b'), '10.18.1.2')
+        # the same address for retry of owner
+        self.assertEqual(store.reserve('key', candidates, 'a'), '10.18.1.1')
+        self.assertEqual(store.reserve('key', candidates, 'c'), None)
+        # other gateway
+        self.assertEqual(store.reserve('other', candidates, 'c'),
+                         '10.18.1.1')
+        self.assertEqual(store.reserved('key'),
+                         {'10.18.1.1': 'a', '10.18.1.2': 'b'})
+        store.release('key', 'a')
+        self.assertEqual(store.reserved('key'), {'10.18.1.2': 'b'})
+        # released address is used by committed rules of owner
+        self.assertEqual(store.reserve('key', candidates, 'c'), None)
+        self.assertEqual(store.reserve('key', candidates, 'a'), None)
+        # expired reservations
+        with mock.patch('network_plugin.ip_reservations.time.time',
+                        mock.MagicMock(return_value=10 ** 12)):
+            self.assertEqual(store.reserved('key'), {})
+            self.assertEqual(store.reserve('key', candidates, 'd'),
+                             '10.18.1.1')
+
+    def test_get_free_ip_with_reservations(self):
+        gateway = self.generate_gateway()
+        gateway.get_name = mock.MagicMock(return_value='gateway')
+        gateway.get_public_ips = mock.MagicMock(return_value=[
+            '10.18.1.1', '10.18.1.2', '10.18.1.3'
+        ])
+        gateway.get_nat_rules = mock.MagicMock(return_value=[
+            self.generate_nat_rule(
+                'DNAT', '10.18.1.1', 'any', 'internal', 'any', 'any')
+        ])
+        fake_ctx = self.generate_node_context(properties={
+            'vcloud_config': {
+                'vdc': 'vdc_name',
+                'public_ip_reservations': True,
+                'public_ip_reservations_path': self.work_dir
+            }
+        })
+        first = self.generate_relation_context()
+        second = self.generate_relation_context()
+        third = self.generate_relation_context()
+        with mock.patch('vcloud_plugin_common.ctx', fake_ctx):
+            # parallel operations get different addresses
+            self.assertEqual(
+                network_plugin.get_public_ip(
+                    None, gateway, 'subscription', first),
+                '10.18.1.2')
+            self.assertEqual(
+                network_plugin.get_public_ip(
+                    None, gateway, 'subscription', second),
+                '10.18.1.3')
+            with self.assertRaises(cfy_exc.NonRecoverableError):
+                network_plugin.get_public_ip(
+                    None, gateway, 'subscription', third)
+            # address committed by other operation is not given out
+            # for rules checked on gateway before the commit
+            network_plugin.release_public_ip(gateway, first)
+            with self.assertRaises(cfy_exc.NonRecoverableError):
+                network_plugin.get_public_ip(
+                    None, gateway, 'subscription', third)
+            network_plugin.release_public_ip(gateway, second)
+            with mock.patch('network_plugin.ip_reservations.time.time',
+                            mock.MagicMock(return_value=10 ** 12)):
+                # address is free when its rules are removed
+                self.assertEqual(
+                    network_plugin.get_public_ip(
+                        None, gateway, 'subscription', third),
+                    '10.18.1.2')
+            # without owner there is no reservation
+            self.assertTrue(network_plugin.getFreeIP(gateway) in
+                            ['10.18.1.2', '10.18.1.3'])
+
+    def test_public_ip_pool_store(self):
+        store = ip_reservations.IpReservationStore(self.work_dir)
+        store.add_to_pool('key', ['10.18.1.1', '10.18.1.2', '10.18.1.3'])
+        self.assertEqual(
+            store.take_from_pool('key', set(['10.18.1.2', '10.18.1.3'])),
+            '10.18.1.2')
+        # given out address is not added again
+        store.add_to_pool('key', ['10.18.1.2'])
+        self.assertEqual(store.pool('key'), ['10.18.1.1', '10.18.1.3'])
+        self.assertEqual(store.take_from_pool('key', set(['10.18.1.4'])),
+                         None)
+        self.assertEqual(
+            store.take_from_pool('key', set(['10.18.1.1'])), '10.18.1.1')
+        # pool is full
+        self.assertEqual(
+            store.return_to_pool('key', '10.18.1.1', 1), ['10.18.1.1'])
+        # place in pool
+        self.assertEqual(
+            store.return_to_pool('key', '10.18.1.1', 2), [])
+        self.assertEqual(store.pool('key'), ['10.18.1.3', '10.18.1.1'])
+        # last used address, all pool is returned
+        self.assertEqual(
+            store.return_to_pool('key', '10.18.1.2', 2),
+            ['10.18.1.3', '10.18.1.1', '10.18.1.2'])
+        self.assertEqual(store.pool('key'), [])
+
+    def test_pooled_public_ip(self):
+        vca_client = self.generate_client()
+        gateway = self.generate_gateway()
+        gateway.get_name = mock.MagicMock(return_value='gateway')
+        gateway.headers = {}
+        gateway.me.get_href = mock.MagicMock(
+            return_value='https://host/api/admin/edgeGateway/id')
+        gateway.get_public_ips = mock.MagicMock(return_value=['10.18.1.1'])
+        refreshed = self.generate_gateway()
+        refreshed.get_public_ips = mock.MagicMock(return_value=[
+            '10.18.1.1', '10.18.1.2', '10.18.1.3'
+        ])
+        refreshed.headers = {}
+        refreshed.me = gateway.me
+        refreshed.get_name = gateway.get_name
+        fake_ctx = self.generate_node_context(properties={
+            'vcloud_config': {
+                'vdc': 'vdc_name',
+                'public_ip_pool_size': 2,
+                'public_ip_reservations_path': self.work_dir
+            }
+        })
+        response = mock.Mock()
+        response.status_code = 200
+        transport = mock.Mock()
+        transport.put = mock.MagicMock(return_value=response)
+        # gateway has new addresses after allocation
+        vca_client.get_gateways = mock.MagicMock(
+            side_effect=lambda vdc: [
+                refreshed if transport.put.called else gateway])
+        task = self.generate_task(vcloud_plugin_common.TASK_STATUS_SUCCESS)
+        with mock.patch('vcloud_plugin_common.ctx', fake_ctx):
+            with mock.patch('network_plugin.get_transport',
+                            mock.MagicMock(return_value=transport)):
+                with mock.patch('network_plugin.taskType.parseString',
+                                mock.MagicMock(return_value=task)):
+                    # batch is allocated with one request
+                    self.assertEqual(
+                        network_plugin.get_public_ip(
+                            vca_client, gateway, 'ondemand', fake_ctx),
+                        '10.18.1.2')
+                    self.assertEqual(transport.put.call_count, 1)
+                    self.assertTrue(
+                        '<NumberOfExternalIpAddressesToAllocate>2<' in
+                        transport.put.call_args[1]['data'])
+                    # the next address is taken from pool
+                    self.assertEqual(
+                        network_plugin.get_public_ip(
+                            vca_client, refreshed, 'ondemand', fake_ctx),
+                        '10.18.1.3')
+                    self.assertEqual(transport.put.call_count, 1)
+                    # address is returned to pool while other is used
+                    network_plugin.release_ondemand_public_ip(
+                        vca_client, refreshed, '10.18.1.2', fake_ctx)
+                    self.assertEqual(transport.put.call_count, 1)
+                    # all addresses are returned with last one
+                    network_plugin.release_ondemand_public_ip(
+                        vca_client, refreshed, '10.18.1.3', fake_ctx)
+                    self.assertEqual(transport.put.call_count, 2)
+                    body = transport.put.call_args[1]['data']
+                    self.assertTrue('10.18.1.2' in body)
+                    self.assertTrue('10.18.1.3' in body)
+                    # allocation failed
+                    response.status_code = 400
+                    with self.assertRaises(cfy_exc.NonRecoverableError):
+                        network_plugin.get_public_ip(
+                            vca_client, refreshed, 'ondemand', fake_ctx)
+
+    def test_pooled_public_ip_parallel(self):
+        vca_client = self.generate_client()
+        gateway = self.generate_gateway()
+        gateway.get_name = mock.MagicMock(return_value='gateway')
+        gateway.get_public_ips = mock.MagicMock(return_value=[])
+        refreshed = self.generate_gateway()
+        refreshed.get_public_ips = mock.MagicMock(return_value=[
+            '10.18.1.1', '10.18.1.2'])
+        allocated = []
+
+        def allocate(vca_client, gateway, body):
+            # both operations found empty pool before allocation
+            time.sleep(0.1)
+            allocated.append(body)
+
+        vca_client.get_gateways = mock.MagicMock(
+            side_effect=lambda vdc: [refreshed if allocated else gateway])
+        fake_ctx = self.generate_node_context(properties={
+            'vcloud_config': {
+                'vdc': 'vdc_name',
+                'public_ip_pool_size': 2,
+                'public_ip_reservations_path': self.work_dir
+            }
+        })
+        results = []
+
+        def operation():
+            results.append(network_plugin.get_pooled_public_ip(
+                vca_client, gateway, fake_ctx, 2))
+
+        with mock.patch('vcloud_plugin_common.ctx', fake_ctx):
+            with mock.patch('network_plugin.manage_external_ips',
+                            allocate):
+                threads = [threading.Thread(target=operation)
+                           for _ in range(2)]
+                for thread in threads:
+                    thread.start()
+                for thread in threads:
+                    thread.join()
+        # pool is filled once, operations get different addresses
+        self.assertEqual(len(allocated), 1)
+        self.assertEqual(sorted(results), ['10.18.1.1', '10.18.1.2'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -9,17 +9,25 @@ from network_plugin import network
 class NetworkPluginNetworkSubroutesMockTestCase(test_mock_base.TestBase):
 
     def test__get_network_list(self):
-        # check list with one network
-        fake_client = self.generate_client(vdc_networks=['something'])
-        self.assertEqual(
-            ['something'],
-            network._get_network_list(fake_client, 'vdc_name')
-        )
-        fake_client.get_vdc.assert_called_with('vdc_name')
-        # can't get vdc
-        fake_client.get_vdc = mock.MagicMock(return_value=None)
-        with self.assertRaises(cfy_exc.NonRecoverableError):
-            network._get_network_list(fake_client, 'vdc_name')
+        fake_client = self.generate_client()
+        with mock.patch(
+            'network_plugin.network.find_records',
+            self.generate_find_records({
+                'orgVdcNetwork': [
+                    {'name': 'something', 'vdcName': 'vdc_name'},
+                    {'name': 'other', 'vdcName': 'other_vdc'}
+                ]
+            })
+        ):
+            # check list with one network
+            self.assertEqual(
+                ['something'],
+                network._get_network_list(fake_client, 'vdc_name')
+            )
+            # unknown vdc
+            self.assertEqual(
+                [], network._get_network_list(fake_client, 'unknown')
+            )
 
     def test_split_adresses(self):
         range_network = network._split_adresses("10.1.1.1-10.1.1.255")
@@ -1,4 +1,6 @@
 import mock
+import shutil
+import tempfile
 import unittest
 
 from cloudify import exceptions as cfy_exc
@@ -143,7 +145,7 @@ class NetworkPluginPublicNatMockTestCase(test_mock_base.TestBase):
             )
         # we dont have enought ports
         rule_inlist = self.generate_nat_rule(
-            'SNAT', 'external', public_nat.MAX_PORT_NUMBER,
+            'SNAT', 'external', network_plugin.MAX_PORT_NUMBER,
             'internal', 11, 'TCP'
         )
         gateway.get_nat_rules = mock.MagicMock(return_value=[rule_inlist])
@@ -154,7 +156,7 @@ class NetworkPluginPublicNatMockTestCase(test_mock_base.TestBase):
             with self.assertRaises(cfy_exc.NonRecoverableError):
                 public_nat._get_original_port_for_create(
                     gateway, 'SNAT', 'external',
-                    public_nat.MAX_PORT_NUMBER, 'internal', '11', 'TCP'
+                    network_plugin.MAX_PORT_NUMBER, 'internal', '11', 'TCP'
                 )
 
     def test_get_gateway_ip_range(self):
@@ -252,34 +254,44 @@ class NetworkPluginPublicNatMockTestCase(test_mock_base.TestBase):
                 )
 
     def test_get_network_ip_range(self):
-        # dont have ip range for this network
         vca_client = self.generate_client()
-        self.assertEqual(
-            public_nat._get_network_ip_range(
-                vca_client, "some_org", "some_network"
-            ),
-            None
-        )
-        vca_client.get_networks.assert_called_with("some_org")
-        # different network
         network = self.gen_vca_client_network(
             name="some", start_ip="127.1.1.1", end_ip="127.1.1.255"
         )
-        vca_client.get_networks = mock.MagicMock(return_value=[network])
-        self.assertEqual(
-            public_nat._get_network_ip_range(
-                vca_client, "some_org", "some_network"
-            ),
-            None
-        )
-        # correct network name
-        vca_client.get_networks = mock.MagicMock(return_value=[network])
-        self.assertEqual(
-            public_nat._get_network_ip_range(
-                vca_client, "some_org", "some"
-            ),
-            (IP('127.1.1.1'), IP('127.1.1.255'))
-        )
+        fake_get_entity = mock.MagicMock(return_value=network)
+        with mock.patch(
+            'network_plugin.public_nat.find_records',
+            self.generate_find_records({
+                'orgVdcNetwork': [
+                    {'name': 'some', 'href': 'some_href',
+                     'vdcName': 'vdc_name'},
+                    {'name': 'some', 'href': 'other_href',
+                     'vdcName': 'other_vdc'}
+                ]
+            })
+        ):
+            with mock.patch(
+                'network_plugin.public_nat.get_entity', fake_get_entity
+            ):
+                # different network
+                self.assertEqual(
+                    public_nat._get_network_ip_range(
+                        vca_client, "some_network", 'vdc_name'
+                    ),
+                    None
+                )
+                self.assertFalse(fake_get_entity.called)
+                # correct network name
+                self.assertEqual(
+                    public_nat._get_network_ip_range(vca_client, "some",
+                                                     'vdc_name'),
+                    (IP('127.1.1.1'), IP('127.1.1.255'))
+                )
+                # network with the same name in other vdc is not used
+                self.assertEqual(fake_get_entity.call_count, 1)
+                self.assertEqual(
+                    fake_get_entity.call_args[0][1], 'some_href'
+                )
 
     def test_create_ip_range(self):
         # context
@@ -289,7 +301,8 @@ class NetworkPluginPublicNatMockTestCase(test_mock_base.TestBase):
         }
         fake_ctx._source.node.properties = {
             'vcloud_config': {
-                'org': 'some_org'
+                'org': 'some_org',
+                'vdc': 'vdc_name'
             }
         }
         fake_ctx._target.instance.runtime_properties = {}
@@ -301,7 +314,7 @@ class NetworkPluginPublicNatMockTestCase(test_mock_base.TestBase):
         network = self.gen_vca_client_network(
             name="some", start_ip="127.1.1.100", end_ip="127.1.1.200"
         )
-        vca_client.get_networks = mock.MagicMock(return_value=[network])
+        self.set_network_lookup(network)
         with mock.patch(
             'network_plugin.public_nat.ctx', fake_ctx
         ):
@@ -314,7 +327,6 @@ class NetworkPluginPublicNatMockTestCase(test_mock_base.TestBase):
                     public_nat._create_ip_range(vca_client, gate),
                     '127.1.1.100 - 127.1.1.200'
                 )
-                vca_client.get_networks.assert_called_with("some_org")
                 # network from gate
                 gate.get_dhcp_pools = mock.MagicMock(return_value=[
                     self.genarate_pool(
@@ -326,16 +338,30 @@ class NetworkPluginPublicNatMockTestCase(test_mock_base.TestBase):
                     '127.1.1.1 - 127.1.1.255'
                 )
                 # network not exist
-                network = self.gen_vca_client_network(
-                    name="other", start_ip="127.1.1.100",
-                    end_ip="127.1.1.200"
-                )
-                vca_client.get_networks = mock.MagicMock(
-                    return_value=[network]
-                )
+                fake_ctx._source.instance.runtime_properties = {
+                    network_plugin.network.VCLOUD_NETWORK_NAME: "other"
+                }
                 with self.assertRaises(cfy_exc.NonRecoverableError):
                     public_nat._create_ip_range(vca_client, gate)
 
+    def set_network_lookup(self, network):
+        """
+            network is found by query service and returned by request
+            for the rest of test
+        """
+        for name, value in (
+            ('find_records', self.generate_find_records({
+                'orgVdcNetwork': [{
+                    'name': network.get_name(), 'href': 'network_href',
+                    'vdcName': 'vdc_name'
+                }]
+            })),
+            ('get_entity', mock.MagicMock(return_value=network))
+        ):
+            patcher = mock.patch('network_plugin.public_nat.' + name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
     def test_save_configuration(self):
 
         def _context_for_delete(service_type):
@@ -383,17 +409,21 @@ class NetworkPluginPublicNatMockTestCase(test_mock_base.TestBase):
             )
             self.check_retry_realy_called(fake_ctx)
         # operation create
-        fake_ctx = self.generate_relation_context()
+        fake_ctx = _context_for_delete(None)
+        fake_ctx._target.instance.runtime_properties = {}
         self.set_services_conf_result(
             gateway, vcloud_plugin_common.TASK_STATUS_SUCCESS
         )
         with mock.patch(
             'network_plugin.public_nat.ctx', fake_ctx
         ):
-            # success save configuration
-            public_nat._save_configuration(
-                gateway, vca_client, network_plugin.CREATE, "1.2.3.4"
-            )
+            with mock.patch(
+                'vcloud_plugin_common.ctx', fake_ctx
+            ):
+                # success save configuration
+                public_nat._save_configuration(
+                    gateway, vca_client, network_plugin.CREATE, "1.2.3.4"
+                )
             self.assertEqual(
                 fake_ctx._target.instance.runtime_properties,
                 {
@@ -615,6 +645,106 @@ class NetworkPluginPublicNatMockTestCase(test_mock_base.TestBase):
             'DNAT', '192.168.1.1', 'any', '1.1.1.1', 'any', 'any'
         )
 
+    def test_prepare_server_operation_batch(self):
+        work_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, work_dir)
+        vca_client, fake_ctx = self.generate_client_and_context_server()
+        fake_ctx._source.node.properties['vcloud_config'].update({
+            'gateway_changes_path': work_dir,
+            'gateway_commit_delay': 0
+        })
+        fake_ctx._target.node.properties = {
+            'nat': {
+                'edge_gateway': 'gateway',
+                network_plugin.PUBLIC_IP: '192.168.1.1',
+                'rules_batch': True
+            },
+            'rules': [{
+                'type': 'DNAT',
+                'protocol': 'TCP',
+                'original_port': 11,
+                'translated_port': 11
+            }]
+        }
+        gateway = vca_client._vdc_gateway
+        with mock.patch(
+            'network_plugin.public_nat.ctx', fake_ctx
+        ):
+            with mock.patch(
+                'vcloud_plugin_common.ctx', fake_ctx
+            ):
+                with mock.patch('network_plugin.ctx', fake_ctx):
+                    # the same rule is waiting in queue
+                    recording = network_plugin.get_gateway(
+                        vca_client, 'gateway', write_queue=True)
+                    store = network_plugin.get_change_set_store()
+                    store.add(recording.key, [[
+                        'add_nat_rule',
+                        ['DNAT', '192.168.1.1', '11', '1.1.1.1', '11',
+                         'TCP']
+                    ]])
+                    public_nat.prepare_server_operation(
+                        vca_client, network_plugin.CREATE
+                    )
+        # next free port is used, both change sets are saved together
+        gateway.add_nat_rule.assert_called_with(
+            'DNAT', '192.168.1.1', '12', '1.1.1.1', '11', 'TCP'
+        )
+        self.assertEqual(gateway.add_nat_rule.call_count, 3)
+        gateway.save_services_configuration.assert_called_once_with()
+        self.assertEqual(store.pending(recording.key), [])
+        self.assertEqual(
+            fake_ctx._target.instance.runtime_properties[
+                public_nat.PORT_REPLACEMENT],
+            {('192.168.1.1', 11): 12}
+        )
+
+    def test_prepare_server_operation_batch_public_ip(self):
+        work_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, work_dir)
+        vca_client, fake_ctx = self.generate_client_and_context_server()
+        fake_ctx._source.node.properties['vcloud_config'].update({
+            'gateway_changes_path': work_dir,
+            'gateway_commit_delay': 0
+        })
+        fake_ctx._target.node.properties = {
+            'nat': {
+                'edge_gateway': 'gateway',
+                'rules_batch': True
+            },
+            'rules': [{
+                'type': 'SNAT'
+            }]
+        }
+        gateway = vca_client._vdc_gateway
+        gateway.get_public_ips = mock.MagicMock(
+            return_value=['10.18.1.1', '10.18.1.2'])
+        with mock.patch(
+            'network_plugin.public_nat.ctx', fake_ctx
+        ):
+            with mock.patch(
+                'vcloud_plugin_common.ctx', fake_ctx
+            ):
+                with mock.patch('network_plugin.ctx', fake_ctx):
+                    # the first IP is used by rule waiting in queue
+                    recording = network_plugin.get_gateway(
+                        vca_client, 'gateway', write_queue=True)
+                    store = network_plugin.get_change_set_store()
+                    store.add(recording.key, [[
+                        'add_nat_rule',
+                        ['SNAT', '1.1.1.2', 'any', '10.18.1.1', 'any',
+                         'any']
+                    ]])
+                    public_nat.prepare_server_operation(
+                        vca_client, network_plugin.CREATE
+                    )
+        gateway.add_nat_rule.assert_called_with(
+            'SNAT', '1.1.1.1', 'any', '10.18.1.2', 'any', 'any'
+        )
+        self.assertEqual(
+            fake_ctx._target.instance.runtime_properties[
+                network_plugin.PUBLIC_IP], '10.18.1.2')
+
     def generate_client_and_context_network(self):
         """
             for test prepare_network_operation based operations
@@ -631,7 +761,7 @@ class NetworkPluginPublicNatMockTestCase(test_mock_base.TestBase):
         network = self.gen_vca_client_network(
             name="some", start_ip="127.1.1.100", end_ip="127.1.1.200"
         )
-        vca_client.get_networks = mock.MagicMock(return_value=[network])
+        self.set_network_lookup(network)
         self.set_services_conf_result(
             vca_client._vdc_gateway,
             vcloud_plugin_common.TASK_STATUS_SUCCESS
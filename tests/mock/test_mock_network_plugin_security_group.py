@@ -3,6 +3,7 @@ import unittest
 
 from cloudify import exceptions as cfy_exc
 import test_mock_base
+from network_plugin import firewall
 from network_plugin import security_group
 import vcloud_plugin_common
 
@@ -45,7 +46,8 @@ class NetworkPluginSecurityGroupMockTestCase(test_mock_base.TestBase):
         }
         return fake_ctx
 
-    def check_rule_operation(self, rule_type, rules, vms_networks=None):
+    def check_rule_operation(self, rule_type, rules, vms_networks=None,
+                             fw_rules=None):
         if not vms_networks:
             vms_networks = []
         fake_client = self.generate_client(vms_networks=vms_networks)
@@ -58,9 +60,8 @@ class NetworkPluginSecurityGroupMockTestCase(test_mock_base.TestBase):
         self.set_services_conf_result(
             gateway, vcloud_plugin_common.TASK_STATUS_SUCCESS
         )
-        # for check calls for add/delete rule
-        gateway.add_fw_rule = mock.MagicMock(return_value=None)
-        gateway.delete_fw_rule = mock.MagicMock(return_value=None)
+        # current rules of gateway
+        self.set_fw_rules(gateway, fw_rules)
         # any networks will be routed
         self.set_network_routed_in_client(fake_client)
         with mock.patch('network_plugin.security_group.ctx', fake_ctx):
@@ -70,7 +71,51 @@ class NetworkPluginSecurityGroupMockTestCase(test_mock_base.TestBase):
                 )
         return gateway
 
-    def check_rule_operation_fail(self, rule_type, rules):
+    def set_fw_rules(self, gateway, fw_rules):
+        """
+            firewall table of gateway, rules written by plugin replace
+            rules of table
+        """
+        gateway.initial_fw_rules = list(fw_rules or [])
+        gateway.fw_table = list(fw_rules or [])
+        gateway.get_fw_rules = mock.MagicMock(
+            side_effect=lambda: list(gateway.fw_table))
+
+        def set_rules(fw_rules):
+            gateway.fw_table = list(fw_rules)
+        gateway._getFirewallService = mock.MagicMock()
+        gateway._getFirewallService.return_value.set_FirewallRule = \
+            mock.MagicMock(side_effect=set_rules)
+
+    def added_rules(self, gateway):
+        """
+            new rules of table as arguments of pyvcloud add_fw_rule
+        """
+        return [
+            (fw_rule.get_IsEnabled(), fw_rule.get_Description(),
+             fw_rule.get_Policy(),
+             firewall.get_protocol(fw_rule.get_Protocols()),
+             fw_rule.get_DestinationPortRange(), fw_rule.get_DestinationIp(),
+             fw_rule.get_SourcePortRange(), fw_rule.get_SourceIp(),
+             fw_rule.get_EnableLogging())
+            for fw_rule in gateway.fw_table
+            if not self._in_rules(fw_rule, gateway.initial_fw_rules)]
+
+    def deleted_rules(self, gateway):
+        """
+            removed rules of table as arguments of pyvcloud delete_fw_rule
+        """
+        return [
+            (firewall.get_protocol(fw_rule.get_Protocols()),
+             fw_rule.get_DestinationPortRange(), fw_rule.get_DestinationIp(),
+             fw_rule.get_SourcePortRange(), fw_rule.get_SourceIp())
+            for fw_rule in gateway.initial_fw_rules
+            if not self._in_rules(fw_rule, gateway.fw_table)]
+
+    def _in_rules(self, fw_rule, fw_rules):
+        return any(fw_rule is other for other in fw_rules)
+
+    def check_rule_operation_fail(self, rule_type, rules, fw_rules=None):
         fake_client = self.generate_client()
         fake_ctx = self.generate_context_for_security_group()
         fake_ctx._target.node.properties = {
@@ -78,6 +123,7 @@ class NetworkPluginSecurityGroupMockTestCase(test_mock_base.TestBase):
         }
         # check busy
         gateway = fake_client._vdc_gateway
+        gateway.get_fw_rules = mock.MagicMock(return_value=fw_rules or [])
         self.set_gateway_busy(gateway)
         self.prepare_retry(fake_ctx)
         self.set_services_conf_result(
@@ -91,34 +137,45 @@ class NetworkPluginSecurityGroupMockTestCase(test_mock_base.TestBase):
 
         self.check_retry_realy_called(fake_ctx)
 
+    def existing_rules(self, rule_type, *rule):
+        """
+            rules of gateway before operation: rule exists for delete
+        """
+        if rule_type == security_group.DELETE_RULE:
+            return [self.generate_fw_rule(*rule)]
+        return []
+
     def test_rule_operation_empty_rule(self):
         for rule_type in [
             security_group.CREATE_RULE, security_group.DELETE_RULE
         ]:
             gateway = self.check_rule_operation(rule_type, [])
-            gateway.save_services_configuration.assert_called_once_with()
-            self.check_rule_operation_fail(rule_type, [])
-            self.assertFalse(gateway.add_fw_rule.called)
-            self.assertFalse(gateway.delete_fw_rule.called)
+            # nothing to change, nothing to save
+            self.assertFalse(gateway.save_services_configuration.called)
+            self.assertFalse(self.added_rules(gateway))
+            self.assertFalse(self.deleted_rules(gateway))
 
     def test_rule_operation_default_rule(self):
         for rule_type in [
             security_group.CREATE_RULE, security_group.DELETE_RULE
         ]:
-            gateway = self.check_rule_operation(rule_type, [{}])
+            existing = self.existing_rules(
+                rule_type, 'Any', 'Any', 'external', 'Any', 'external')
+            gateway = self.check_rule_operation(
+                rule_type, [{}], fw_rules=existing)
             gateway.save_services_configuration.assert_called_once_with()
             if rule_type == security_group.CREATE_RULE:
-                gateway.add_fw_rule.assert_called_once_with(
+                self.assertEqual(self.added_rules(gateway), [(
                     True, 'Rule added by pyvcloud', 'allow', 'Any',
                     'Any', 'External', 'Any', 'External', False
-                )
-                self.assertFalse(gateway.delete_fw_rule.called)
+                )])
+                self.assertFalse(self.deleted_rules(gateway))
             else:
-                gateway.delete_fw_rule.assert_called_once_with(
+                self.assertEqual(self.deleted_rules(gateway), [(
                     'Any', 'Any', 'external', 'Any', 'external'
-                )
-                self.assertFalse(gateway.add_fw_rule.called)
-            self.check_rule_operation_fail(rule_type, [{}])
+                )])
+                self.assertFalse(self.added_rules(gateway))
+            self.check_rule_operation_fail(rule_type, [{}], existing)
 
     def test_rule_operation_internal_rule(self):
         for rule_type in [
@@ -136,20 +193,23 @@ class NetworkPluginSecurityGroupMockTestCase(test_mock_base.TestBase):
                     'log_traffic': True
                 }
             ]
-            gateway = self.check_rule_operation(rule_type, rules)
+            existing = self.existing_rules(
+                rule_type, 'Tcp', '40', 'internal', '22', 'external', 'deny')
+            gateway = self.check_rule_operation(
+                rule_type, rules, fw_rules=existing)
             gateway.save_services_configuration.assert_called_once_with()
             if rule_type == security_group.CREATE_RULE:
-                gateway.add_fw_rule.assert_called_once_with(
+                self.assertEqual(self.added_rules(gateway), [(
                     True, 'description', 'deny', 'Tcp', '40',
                     'Internal', '22', 'External', True
-                )
-                self.assertFalse(gateway.delete_fw_rule.called)
+                )])
+                self.assertFalse(self.deleted_rules(gateway))
             else:
-                gateway.delete_fw_rule.assert_called_once_with(
+                self.assertEqual(self.deleted_rules(gateway), [(
                     'Tcp', '40', 'internal', '22', 'external'
-                )
-                self.assertFalse(gateway.add_fw_rule.called)
-            self.check_rule_operation_fail(rule_type, rules)
+                )])
+                self.assertFalse(self.added_rules(gateway))
+            self.check_rule_operation_fail(rule_type, rules, existing)
 
     def test_rule_operation_icmp_rule(self):
         for rule_type in [
@@ -167,20 +227,23 @@ class NetworkPluginSecurityGroupMockTestCase(test_mock_base.TestBase):
                     'log_traffic': True
                 }
             ]
-            gateway = self.check_rule_operation(rule_type, rules)
+            existing = self.existing_rules(
+                rule_type, 'Icmp', '22', '5.6.7.8', '60', '1.2.3.4', 'deny')
+            gateway = self.check_rule_operation(
+                rule_type, rules, fw_rules=existing)
             gateway.save_services_configuration.assert_called_once_with()
             if rule_type == security_group.CREATE_RULE:
-                gateway.add_fw_rule.assert_called_once_with(
+                self.assertEqual(self.added_rules(gateway), [(
                     True, 'ip', 'deny', 'Icmp', '22', '5.6.7.8',
                     '60', '1.2.3.4', True
-                )
-                self.assertFalse(gateway.delete_fw_rule.called)
+                )])
+                self.assertFalse(self.deleted_rules(gateway))
             else:
-                gateway.delete_fw_rule.assert_called_once_with(
+                self.assertEqual(self.deleted_rules(gateway), [(
                     'Icmp', '22', '5.6.7.8', '60', '1.2.3.4'
-                )
-                self.assertFalse(gateway.add_fw_rule.called)
-            self.check_rule_operation_fail(rule_type, rules)
+                )])
+                self.assertFalse(self.added_rules(gateway))
+            self.check_rule_operation_fail(rule_type, rules, existing)
 
     def test_rule_operation_tcp_rule(self):
         for rule_type in [
@@ -198,20 +261,23 @@ class NetworkPluginSecurityGroupMockTestCase(test_mock_base.TestBase):
                     'log_traffic': True
                 }
             ]
-            gateway = self.check_rule_operation(rule_type, rules)
+            existing = self.existing_rules(
+                rule_type, 'Tcp', '22', '5.6.7.8', '60', '1.2.3.4', 'deny')
+            gateway = self.check_rule_operation(
+                rule_type, rules, fw_rules=existing)
             gateway.save_services_configuration.assert_called_once_with()
             if rule_type == security_group.CREATE_RULE:
-                gateway.add_fw_rule.assert_called_once_with(
+                self.assertEqual(self.added_rules(gateway), [(
                     True, 'ip', 'deny', 'Tcp', '22', '5.6.7.8', '60',
                     '1.2.3.4', True
-                )
-                self.assertFalse(gateway.delete_fw_rule.called)
+                )])
+                self.assertFalse(self.deleted_rules(gateway))
             else:
-                gateway.delete_fw_rule.assert_called_once_with(
+                self.assertEqual(self.deleted_rules(gateway), [(
                     'Tcp', '22', '5.6.7.8', '60', '1.2.3.4'
-                )
-                self.assertFalse(gateway.add_fw_rule.called)
-            self.check_rule_operation_fail(rule_type, rules)
+                )])
+                self.assertFalse(self.added_rules(gateway))
+            self.check_rule_operation_fail(rule_type, rules, existing)
 
     def test_rule_operation_host_rule(self):
         for rule_type in [
@@ -237,20 +303,23 @@ class NetworkPluginSecurityGroupMockTestCase(test_mock_base.TestBase):
                     'network_name': 'network_name',
                     'is_primary': True,
                     'ip': '1.1.1.1'
-                }]
+                }],
+                self.existing_rules(
+                    rule_type, 'Tcp', '22', '5.6.7.8', '60', '1.1.1.1',
+                    'deny')
             )
             gateway.save_services_configuration.assert_called_once_with()
             if rule_type == security_group.CREATE_RULE:
-                gateway.add_fw_rule.assert_called_once_with(
+                self.assertEqual(self.added_rules(gateway), [(
                     True, 'ip', 'deny', 'Tcp', '22', '5.6.7.8', '60',
                     '1.1.1.1', True
-                )
-                self.assertFalse(gateway.delete_fw_rule.called)
+                )])
+                self.assertFalse(self.deleted_rules(gateway))
             else:
-                gateway.delete_fw_rule.assert_called_once_with(
+                self.assertEqual(self.deleted_rules(gateway), [(
                     'Tcp', '22', '5.6.7.8', '60', '1.1.1.1'
-                )
-                self.assertFalse(gateway.add_fw_rule.called)
+                )])
+                self.assertFalse(self.added_rules(gateway))
             # destination
             rules = [
                 {
@@ -271,20 +340,230 @@ class NetworkPluginSecurityGroupMockTestCase(test_mock_base.TestBase):
                     'is_primary': True,
                     'network_name': 'network_name',
                     'ip': '1.1.1.1'
-                }]
+                }],
+                self.existing_rules(
+                    rule_type, 'Tcp', '22', '1.1.1.1', '60', '1.2.3.4',
+                    'deny')
             )
             gateway.save_services_configuration.assert_called_once_with()
             if rule_type == security_group.CREATE_RULE:
-                gateway.add_fw_rule.assert_called_once_with(
+                self.assertEqual(self.added_rules(gateway), [(
                     True, 'ip', 'deny', 'Tcp', '22', '1.1.1.1', '60',
                     '1.2.3.4', True
-                )
-                self.assertFalse(gateway.delete_fw_rule.called)
+                )])
+                self.assertFalse(self.deleted_rules(gateway))
             else:
-                gateway.delete_fw_rule.assert_called_once_with(
+                self.assertEqual(self.deleted_rules(gateway), [(
                     'Tcp', '22', '1.1.1.1', '60', '1.2.3.4'
-                )
-                self.assertFalse(gateway.add_fw_rule.called)
+                )])
+                self.assertFalse(self.added_rules(gateway))
+
+    def test_rule_operation_reconcile(self):
+        rules = [
+            {
+                'description': 'ip',
+                'source': '1.2.3.4',
+                'destination_port': 22,
+                'protocol': 'tcp',
+                'action': 'allow'
+            }
+        ]
+        # rule already exists, repeated create changes nothing
+        gateway = self.check_rule_operation(
+            security_group.CREATE_RULE, rules + rules,
+            fw_rules=[self.generate_fw_rule(
+                'Tcp', '22', 'external', 'Any', '1.2.3.4')])
+        self.assertFalse(self.added_rules(gateway))
+        self.assertFalse(self.deleted_rules(gateway))
+        self.assertFalse(gateway.save_services_configuration.called)
+        # only extra copies are removed, the first copy is kept as is
+        kept = self.generate_fw_rule(
+            'Tcp', '22', 'external', 'Any', '1.2.3.4', description='old',
+            enabled=False)
+        gateway = self.check_rule_operation(
+            security_group.CREATE_RULE, rules,
+            fw_rules=[
+                kept,
+                self.generate_fw_rule(
+                    'Tcp', '22', 'external', 'Any', '1.2.3.4', log=True),
+                self.generate_fw_rule(
+                    'Tcp', '22', 'external', 'Any', '1.2.3.4')
+            ])
+        self.assertEqual(gateway.fw_table, [kept])
+        self.assertFalse(kept.get_IsEnabled())
+        gateway.save_services_configuration.assert_called_once_with()
+        # rule with other action is other rule
+        gateway = self.check_rule_operation(
+            security_group.CREATE_RULE, rules,
+            fw_rules=[self.generate_fw_rule(
+                'Tcp', '22', 'external', 'Any', '1.2.3.4', 'deny')])
+        self.assertEqual(len(self.added_rules(gateway)), 1)
+        # Tcp and Udp in one rule
+        gateway = self.check_rule_operation(
+            security_group.CREATE_RULE, [dict(rules[0], protocol='tcpudp')])
+        fw_rule = gateway.fw_table[0]
+        self.assertTrue(fw_rule.get_Protocols().get_Tcp())
+        self.assertTrue(fw_rule.get_Protocols().get_Udp())
+        self.assertFalse(fw_rule.get_Protocols().get_Any())
+        # delete removes all copies of rule
+        gateway = self.check_rule_operation(
+            security_group.DELETE_RULE, rules,
+            fw_rules=[
+                self.generate_fw_rule(
+                    'Tcp', '22', 'external', 'Any', '1.2.3.4'),
+                self.generate_fw_rule(
+                    'Tcpudp', '22', 'external', 'Any', '1.2.3.4'),
+                self.generate_fw_rule(
+                    'Tcp', '22', 'external', 'Any', '1.2.3.4')
+            ])
+        self.assertEqual(self.deleted_rules(gateway), [
+            ('Tcp', '22', 'external', 'Any', '1.2.3.4'),
+            ('Tcp', '22', 'external', 'Any', '1.2.3.4')])
+        # nothing to delete
+        gateway = self.check_rule_operation(
+            security_group.DELETE_RULE, rules)
+        self.assertFalse(self.deleted_rules(gateway))
+        self.assertFalse(gateway.save_services_configuration.called)
+
+    def test_compile_rules(self):
+        def rule(source_ip, dest_ip='external', action='allow',
+                 dest_port='22'):
+            return firewall.FirewallRule(
+                'rule', action, 'Tcp', dest_port, dest_ip, 'Any',
+                source_ip, False)
+
+        # hosts are joined into ranges, wider rules go first
+        compiled = firewall.compile_rules([
+            rule('10.0.0.5'), rule('10.0.0.7'), rule('10.0.0.6'),
+            rule('10.0.0.20'), rule('any'), rule('10.0.0.5'),
+            rule('10.0.0.8', dest_port='80')
+        ])
+        self.assertEqual(
+            [(r.source_ip, r.dest_port) for r in compiled],
+            [('any', '22'), ('10.0.0.5-10.0.0.7', '22'),
+             ('10.0.0.20', '22'), ('10.0.0.8', '80')])
+        # rules with other action between are not joined
+        compiled = firewall.compile_rules([
+            rule('10.0.0.5'), rule('10.0.0.6', action='deny'),
+            rule('10.0.0.6')
+        ])
+        self.assertEqual(len(compiled), 3)
+        # destination hosts
+        compiled = firewall.compile_rules([
+            rule('any', '192.168.0.1'), rule('any', '192.168.0.0/31')
+        ])
+        self.assertEqual([r.dest_ip for r in compiled], ['192.168.0.0/31'])
+        # removed host is cut out of range
+        self.assertEqual(
+            [r.source_ip for r in firewall.subtract_rules(
+                [rule('10.0.0.5-10.0.0.7'), rule('any')],
+                [rule('10.0.0.6'), rule('any')])],
+            ['10.0.0.5', '10.0.0.7'])
+
+    def test_rule_operation_compiled(self):
+        fake_client = self.generate_client()
+        fake_ctx = self.generate_context_for_security_group()
+        fake_ctx._target.node.properties = {
+            'security_group': {'compile_rules': True},
+            'rules': [{
+                'source': '10.0.0.6',
+                'destination_port': 22,
+                'protocol': 'tcp'
+            }]
+        }
+        gateway = fake_client._vdc_gateway
+        self.set_services_conf_result(
+            gateway, vcloud_plugin_common.TASK_STATUS_SUCCESS
+        )
+        self.set_fw_rules(gateway, [
+            self.generate_fw_rule('Any', 'Any', 'external', 'Any', 'Any',
+                                  'deny'),
+            self.generate_fw_rule('Tcp', '22', 'External', 'Any',
+                                  '10.0.0.5'),
+            self.generate_fw_rule('Tcp', '22', 'External', 'Any',
+                                  '10.0.0.7')
+        ])
+        with mock.patch('network_plugin.security_group.ctx', fake_ctx):
+            with mock.patch('vcloud_plugin_common.ctx', fake_ctx):
+                security_group._rule_operation(
+                    security_group.CREATE_RULE, fake_client)
+        # rules of group are joined, other rules are not changed
+        self.assertEqual(
+            [rule[3:] for rule in self.deleted_rules(gateway)],
+            [('Any', '10.0.0.5'), ('Any', '10.0.0.7')])
+        self.assertEqual(self.added_rules(gateway), [
+            (True, 'rule; Rule added by pyvcloud', 'allow', 'Tcp', '22',
+             'External', 'Any', '10.0.0.5-10.0.0.7', False)])
+        self.assertEqual(len(gateway.fw_table), 2)
+        self.assertTrue(
+            gateway.fw_table[0] is gateway.initial_fw_rules[0])
+        gateway.save_services_configuration.assert_called_once_with()
+        # compiled table is not changed again
+        self.set_fw_rules(gateway, [
+            self.generate_fw_rule('Tcp', '22', 'External', 'Any',
+                                  '10.0.0.5-10.0.0.7')
+        ])
+        gateway.save_services_configuration.reset_mock()
+        with mock.patch('network_plugin.security_group.ctx', fake_ctx):
+            with mock.patch('vcloud_plugin_common.ctx', fake_ctx):
+                security_group._rule_operation(
+                    security_group.CREATE_RULE, fake_client)
+        self.assertFalse(gateway.save_services_configuration.called)
+
+    def test_rule_operation_compiled_other_rules(self):
+        fake_client = self.generate_client()
+        fake_ctx = self.generate_context_for_security_group()
+        fake_ctx._target.node.properties = {
+            'security_group': {'compile_rules': True},
+            'rules': [{
+                'source': '10.0.0.2',
+                'destination_port': 53,
+                'protocol': 'tcpudp'
+            }]
+        }
+        gateway = fake_client._vdc_gateway
+        self.set_services_conf_result(
+            gateway, vcloud_plugin_common.TASK_STATUS_SUCCESS
+        )
+        other = self.generate_fw_rule(
+            'Any', '53', 'External', 'Any', '10.0.0.4')
+        other.get_Protocols().set_Any(None)
+        other.get_Protocols().set_Other('GRE')
+        fw_rules = [
+            self.generate_fw_rule('Tcpudp', '53', 'External', 'Any',
+                                  '10.0.0.3', enabled=False),
+            other,
+            self.generate_fw_rule('Tcpudp', '53', 'External', 'Any',
+                                  '10.0.0.1', description='dns')
+        ]
+        self.set_fw_rules(gateway, fw_rules)
+        with mock.patch('network_plugin.security_group.ctx', fake_ctx):
+            with mock.patch('vcloud_plugin_common.ctx', fake_ctx):
+                security_group._rule_operation(
+                    security_group.CREATE_RULE, fake_client)
+        # disabled rule and rule with other protocol are kept as is
+        self.assertEqual(len(gateway.fw_table), 3)
+        self.assertTrue(gateway.fw_table[0] is fw_rules[0])
+        self.assertFalse(gateway.fw_table[0].get_IsEnabled())
+        self.assertTrue(gateway.fw_table[1] is other)
+        self.assertEqual(other.get_Protocols().get_Other(), 'GRE')
+        # Tcp and Udp rules are joined into rule with both protocols
+        self.assertEqual(self.added_rules(gateway), [
+            (True, 'dns; Rule added by pyvcloud', 'allow', 'Tcpudp', '53',
+             'External', 'Any', '10.0.0.1-10.0.0.2', False)])
+        protocols = gateway.fw_table[2].get_Protocols()
+        self.assertTrue(protocols.get_Tcp())
+        self.assertTrue(protocols.get_Udp())
+        # delete cuts address of group out of joined rule
+        self.set_fw_rules(gateway, list(gateway.fw_table))
+        with mock.patch('network_plugin.security_group.ctx', fake_ctx):
+            with mock.patch('vcloud_plugin_common.ctx', fake_ctx):
+                security_group._rule_operation(
+                    security_group.DELETE_RULE, fake_client)
+        self.assertEqual(gateway.fw_table[:2], fw_rules[:2])
+        self.assertEqual(self.added_rules(gateway), [
+            (True, 'dns; Rule added by pyvcloud', 'allow', 'Tcpudp', '53',
+             'External', 'Any', '10.0.0.1', False)])
 
     def test_rule_operation_error_ip_rule(self):
         for rule_type in [
@@ -0,0 +1,198 @@
+import mock
+import shutil
+import tempfile
+import unittest
+
+from cloudify import exceptions as cfy_exc
+from server_plugin import bulk
+import vcloud_plugin_common
+from vcloud_plugin_common import work_queue
+import test_mock_base
+
+
+class ServerPluginBulkMockTestCase(test_mock_base.TestBase):
+
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.work_dir)
+
+    def generate_bulk_context(self):
+        return self.generate_node_context(properties={
+            'vcloud_config': {
+                'vdc': 'vdc_name',
+                'server_bulk_path': self.work_dir,
+                'server_bulk_delay': 0
+            },
+            'server': {
+                'bulk': True
+            }
+        })
+
+    def test_find_vapps(self):
+        fake_client = self.generate_client()
+        fake_query = mock.MagicMock(side_effect=lambda *args: [
+            {'name': name.split('==')[1], 'href': 'href'}
+            for name in args[3].split(';')[0].strip('()').split(',')])
+        with mock.patch('server_plugin.bulk.query_records', fake_query):
+            with mock.patch('server_plugin.bulk.TASK_QUERY_SIZE', 2):
+                records = bulk.find_vapps(fake_client, 'vdc',
+                                          set(['a', 'b', 'c']))
+        self.assertEqual(sorted(records.keys()), ['a', 'b', 'c'])
+        self.assertEqual(fake_query.call_count, 2)
+        self.assertEqual(fake_query.call_args_list[0][0][2:],
+                         ('vApp', '(name==a,name==b);vdcName==vdc'))
+
+    def test_find_running_tasks(self):
+        fake_client = self.generate_client()
+        fake_query = mock.MagicMock(return_value=[
+            {'object': 'https://host/vapp', 'href': 'https://host/task'}])
+        with mock.patch('server_plugin.bulk.query_records', fake_query):
+            self.assertEqual(
+                bulk.find_running_tasks(fake_client, ['https://host/vapp']),
+                {'https://host/vapp': ['https://host/task']})
+        self.assertEqual(
+            fake_query.call_args[0][2:],
+            ('task', '(object==https%3A%2F%2Fhost%2Fvapp);'
+                     '(status==queued,status==preRunning,status==running)'))
+
+    def test_submit_action(self):
+        fake_client = self.generate_client()
+        fake_client.vcloud_session.get_vcloud_headers = mock.MagicMock(
+            return_value={})
+        response = mock.Mock()
+        response.status_code = 202
+        transport = mock.Mock()
+        transport.post = mock.MagicMock(return_value=response)
+        transport.delete = mock.MagicMock(return_value=response)
+        task = mock.Mock()
+        with mock.patch('server_plugin.bulk.get_transport',
+                        mock.MagicMock(return_value=transport)):
+            with mock.patch('server_plugin.bulk.taskType.parseString',
+                            mock.MagicMock(return_value=task)):
+                self.assertEqual(
+                    bulk.submit_action(fake_client, bulk.POWER_ON,
+                                       'https://host/vapp'),
+                    task)
+                transport.post.assert_called_with(
+                    'https://host/vapp/power/action/powerOn', headers={})
+                bulk.submit_action(fake_client, bulk.UNDEPLOY,
+                                   'https://host/vapp')
+                self.assertEqual(
+                    transport.post.call_args[0][0],
+                    'https://host/vapp/action/undeploy')
+                self.assertEqual(
+                    transport.post.call_args[1]['headers']['Content-Type'],
+                    bulk.UNDEPLOY_PARAMS_TYPE)
+                bulk.submit_action(fake_client, bulk.DELETE,
+                                   'https://host/vapp')
+                transport.delete.assert_called_with(
+                    'https://host/vapp', headers={})
+                response.status_code = 400
+                with self.assertRaises(cfy_exc.NonRecoverableError):
+                    bulk.submit_action(fake_client, bulk.DELETE,
+                                       'https://host/vapp')
+
+    def test_run_bulk(self):
+        fake_ctx = self.generate_bulk_context()
+        fake_client = self.generate_client()
+        store = bulk.BulkRequestStore(self.work_dir)
+        fake_find = mock.MagicMock(return_value={
+            'vapp': {'name': 'vapp', 'href': 'https://host/vapp',
+                     'status': 'POWERED_OFF'},
+            'other': {'name': 'other', 'href': 'https://host/other',
+                      'status': 'POWERED_OFF'},
+            'on': {'name': 'on', 'href': 'https://host/on',
+                   'status': 'POWERED_ON'}
+        })
+        fake_submit = mock.MagicMock(
+            side_effect=lambda client, action, href: self.generate_task(
+                vcloud_plugin_common.TASK_STATUS_SUCCESS))
+        with mock.patch('vcloud_plugin_common.ctx', fake_ctx):
+            with mock.patch('server_plugin.bulk.ctx', fake_ctx):
+                key = work_queue.scope_key(
+                    vcloud_plugin_common.get_vcloud_config(),
+                    'servers', bulk.POWER_ON)
+                # actions queued by other instances
+                other_id = store.add(key, ['other'])
+                on_id = store.add(key, ['on'])
+                missing_id = store.add(key, ['missing'])
+                with mock.patch('server_plugin.bulk.find_vapps', fake_find), \
+                        mock.patch('server_plugin.bulk.find_running_tasks',
+                                   mock.MagicMock(return_value={})):
+                    with mock.patch('server_plugin.bulk.submit_action',
+                                    fake_submit):
+                        bulk.run_bulk(fake_client, bulk.POWER_ON, 'vapp')
+                        # vApps are resolved with one call
+                        self.assertEqual(fake_find.call_count, 1)
+                        self.assertEqual(
+                            fake_find.call_args[0][2],
+                            set(['vapp', 'other', 'on', 'missing']))
+                        # powered on vApp is skipped
+                        self.assertEqual(
+                            sorted(call[0][2] for call
+                                   in fake_submit.call_args_list),
+                            ['https://host/other', 'https://host/vapp'])
+                        self.assertEqual(store.result(key, other_id),
+                                         {'status': 'success',
+                                          'message': None})
+                        self.assertEqual(store.result(key, on_id)['status'],
+                                         'success')
+                        self.assertEqual(
+                            store.result(key, missing_id)['status'],
+                            'error')
+                        self.assertEqual(store.pending(key), [])
+                        # failed task
+                        fake_submit.side_effect = \
+                            lambda client, action, href: self.generate_task(
+                                vcloud_plugin_common.TASK_STATUS_ERROR)
+                        with self.assertRaises(cfy_exc.NonRecoverableError):
+                            bulk.run_bulk(fake_client, bulk.POWER_ON,
+                                          'vapp')
+                        self.assertEqual(store.pending(key), [])
+
+    def test_run_bulk_submitted_before(self):
+        fake_ctx = self.generate_bulk_context()
+        fake_client = self.generate_client()
+        powered_off = {'vapp': {'name': 'vapp', 'href': 'https://host/vapp',
+                                'status': 'POWERED_OFF'}}
+        powered_on = {'vapp': dict(powered_off['vapp'],
+                                   status='POWERED_ON')}
+        # task of operation that held lock before is still running
+        fake_find = mock.MagicMock(side_effect=[powered_off, powered_on])
+        fake_running = mock.MagicMock(side_effect=[
+            {'https://host/vapp': ['https://host/task']}, {}])
+        fake_get_entity = mock.MagicMock(return_value=self.generate_task(
+            vcloud_plugin_common.TASK_STATUS_SUCCESS))
+        fake_submit = mock.MagicMock()
+        with mock.patch('vcloud_plugin_common.ctx', fake_ctx):
+            with mock.patch('server_plugin.bulk.ctx', fake_ctx), \
+                    mock.patch('server_plugin.bulk.BULK_POLL', 0), \
+                    mock.patch('server_plugin.bulk.find_vapps', fake_find), \
+                    mock.patch('server_plugin.bulk.find_running_tasks',
+                               fake_running), \
+                    mock.patch('server_plugin.bulk.get_entity',
+                               fake_get_entity), \
+                    mock.patch('server_plugin.bulk.submit_action',
+                               fake_submit):
+                bulk.run_bulk(fake_client, bulk.POWER_ON, 'vapp')
+                # action is not sent again
+                self.assertFalse(fake_submit.called)
+                fake_get_entity.assert_called_once_with(
+                    fake_client, 'https://host/task', bulk.taskType)
+                self.assertEqual(fake_find.call_count, 2)
+                # vApp is already undeployed or deleted
+                fake_find.side_effect = None
+                fake_find.return_value = {'vapp': dict(
+                    powered_off['vapp'], isDeployed='false')}
+                fake_running.side_effect = None
+                fake_running.return_value = {}
+                bulk.run_bulk(fake_client, bulk.UNDEPLOY, 'vapp')
+                fake_find.return_value = {}
+                bulk.run_bulk(fake_client, bulk.DELETE, 'vapp')
+                self.assertFalse(fake_submit.called)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -64,6 +64,53 @@ class ServerPluginServerMockTestCase(test_mock_base.TestBase):
                 server.VCLOUD_VAPP_NAME in fake_ctx.instance.runtime_properties
             )
 
+    def test_delete_async(self):
+        fake_ctx = self.generate_node_context(properties={
+            'management_network': '_management_network',
+            'vcloud_config': {
+                'vdc': 'vdc_name',
+                'async_tasks': True
+            }
+        })
+        fake_client = self.generate_client()
+        fake_task = self.generate_task('running')
+        fake_task.get_href = mock.MagicMock(
+            return_value='https://host/api/task/1'
+        )
+        fake_client._vapp.delete = mock.MagicMock(
+            return_value=fake_task
+        )
+        with mock.patch(
+            'vcloud_plugin_common.VcloudAirClient.get',
+            mock.MagicMock(return_value=fake_client)
+        ):
+            # task submitted, operation retried
+            with self.assertRaises(cfy_exc.OperationRetry):
+                server.delete(ctx=fake_ctx)
+            self.assertEqual(
+                fake_ctx.instance.runtime_properties[
+                    vcloud_plugin_common.ASYNC_TASKS
+                ],
+                {server.DELETE_VAPP_TASK: 'https://host/api/task/1'}
+            )
+            self.assertTrue(
+                server.VCLOUD_VAPP_NAME in fake_ctx.instance.runtime_properties
+            )
+            # task finished on retry, no new task submitted
+            fake_ctx.operation._operation_retry = None
+            fake_client._vapp.delete.reset_mock()
+            with mock.patch(
+                'vcloud_plugin_common._get_task',
+                mock.MagicMock(return_value=self.generate_task(
+                    vcloud_plugin_common.TASK_STATUS_SUCCESS
+                ))
+            ):
+                server.delete(ctx=fake_ctx)
+            self.assertFalse(fake_client._vapp.delete.called)
+            self.assertFalse(
+                server.VCLOUD_VAPP_NAME in fake_ctx.instance.runtime_properties
+            )
+
     def test_stop_external_resource(self):
         fake_ctx = self.generate_node_context(
             properties={
@@ -196,6 +243,40 @@ class ServerPluginServerMockTestCase(test_mock_base.TestBase):
             with self.assertRaises(cfy_exc.OperationRetry):
                 server.start(ctx=fake_ctx)
 
+    def test_lifecycle_bulk(self):
+        fake_ctx = self.generate_node_context(properties={
+            'management_network': '_management_network',
+            'vcloud_config': {
+                'vdc': 'vdc_name'
+            },
+            'server': {
+                'bulk': True
+            }
+        })
+        fake_client = self.generate_client([{
+            'is_connected': True,
+            'network_name': '_management_network',
+            'ip': '1.1.1.1'
+        }])
+        fake_run = mock.MagicMock()
+        with mock.patch(
+            'vcloud_plugin_common.VcloudAirClient.get',
+            mock.MagicMock(return_value=fake_client)
+        ):
+            with mock.patch('server_plugin.bulk.run_bulk', fake_run):
+                server.start(ctx=fake_ctx)
+                fake_run.assert_called_with(
+                    mock.ANY, server.bulk.POWER_ON, 'vapp_name')
+                server.stop(ctx=fake_ctx)
+                fake_run.assert_called_with(
+                    mock.ANY, server.bulk.UNDEPLOY, 'vapp_name')
+                server.delete(ctx=fake_ctx)
+                fake_run.assert_called_with(
+                    mock.ANY, server.bulk.DELETE, 'vapp_name')
+        self.assertFalse(fake_client._vapp.poweron.called)
+        self.assertFalse(fake_client._vapp.undeploy.called)
+        self.assertFalse(fake_client._vapp.delete.called)
+
     def test_start_external_resource(self):
         """
             start with external resource, as success status used retry
@@ -510,6 +591,85 @@ class ServerPluginServerMockTestCase(test_mock_base.TestBase):
             server.create(ctx=fake_ctx)
             self.check_create_call(fake_client, fake_ctx)
 
+    def test_create_networks_batch(self):
+        """
+            all networks are connected with one call
+        """
+        fake_ctx = self.generate_context_for_create()
+        fake_ctx.node.properties['server']['networks_batch'] = True
+        fake_client = self.generate_client()
+        self.run_with_statuses(
+            fake_client, fake_ctx,
+            vcloud_plugin_common.TASK_STATUS_SUCCESS
+        )
+        fake_connect = mock.MagicMock()
+        with mock.patch(
+            'vcloud_plugin_common.VcloudAirClient.get',
+            mock.MagicMock(return_value=fake_client)
+        ):
+            with mock.patch('server_plugin.server.connect_networks',
+                            fake_connect):
+                server.create(ctx=fake_ctx)
+            self.check_create_call(fake_client, fake_ctx)
+        self.assertFalse(fake_client._vapp.connect_to_network.called)
+        self.assertFalse(fake_client._vapp.connect_vms.called)
+        self.assertEqual(fake_connect.call_count, 1)
+        vapp, networks, connections = fake_connect.call_args[0][1:]
+        self.assertEqual(vapp, fake_client._vapp)
+        self.assertEqual([name for name, _ in networks],
+                         ['_management_network'])
+        self.assertEqual(
+            connections,
+            [{
+                'network': '_management_network',
+                'index': 0,
+                'primary_interface': True,
+                'ip_allocation_mode': 'POOL',
+                'mac_address': None,
+                'ip_address': None
+            }]
+        )
+
+    def test_create_compose(self):
+        """
+            vApp with networks and customization is created by one task
+        """
+        fake_ctx = self.generate_context_for_customization()
+        fake_ctx.node.properties['server']['create_mode'] = 'compose'
+        fake_ctx.node.properties['server']['hardware'] = {
+            'cpu': 1, 'memory': 512
+        }
+        fake_client = self.generate_client()
+        self.run_with_statuses(fake_client, fake_ctx)
+        fake_task = self.generate_task(
+            vcloud_plugin_common.TASK_STATUS_SUCCESS)
+        fake_compose = mock.MagicMock(return_value=fake_task)
+        with mock.patch(
+            'vcloud_plugin_common.VcloudAirClient.get',
+            mock.MagicMock(return_value=fake_client)
+        ):
+            with mock.patch(
+                'server_plugin.server.get_template_hrefs',
+                mock.MagicMock(return_value=('https://host/template',
+                                             'https://host/vm'))
+            ):
+                with mock.patch('server_plugin.server.compose_vapp',
+                                fake_compose):
+                    server.create(ctx=fake_ctx)
+        self.assertTrue(
+            server.VCLOUD_VAPP_NAME in fake_ctx.instance.runtime_properties
+        )
+        self.assertFalse(fake_client.create_vapp.called)
+        self.assertFalse(fake_client._vapp.connect_to_network.called)
+        self.assertFalse(fake_client._vapp.connect_vms.called)
+        self.assertFalse(fake_client._vapp.customize_guest_os.called)
+        self.assertEqual(fake_compose.call_count, 1)
+        vdc_name, body = fake_compose.call_args[0][1:]
+        self.assertEqual(vdc_name, 'vdc_name')
+        self.assertTrue('networkName="_management_network"' in body)
+        self.assertTrue('<rasd:VirtualQuantity>512<' in body)
+        self.assertTrue('<GuestCustomizationSection>' in body)
+
     def test_create_customization(self):
         """
             test customization - task None
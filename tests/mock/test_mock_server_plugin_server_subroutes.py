@@ -205,11 +205,15 @@ class ServerPluginServerSubRoutesMockTestCase(test_mock_base.TestBase):
         )
 
         with mock.patch(
-            'vcloud_plugin_common.VcloudAirClient.get',
-            self.generate_vca()
+            'server_plugin.server.find_records',
+            self.generate_find_records()
         ):
-            with self.assertRaises(cfy_exc.NonRecoverableError):
-                server.creation_validation(ctx=fake_ctx)
+            with mock.patch(
+                'vcloud_plugin_common.VcloudAirClient.get',
+                self.generate_vca()
+            ):
+                with self.assertRaises(cfy_exc.NonRecoverableError):
+                    server.creation_validation(ctx=fake_ctx)
 
     def test_creation_validation_settings_wrong_template(self):
         fake_ctx = cfy_mocks.MockCloudifyContext(
@@ -225,11 +229,15 @@ class ServerPluginServerSubRoutesMockTestCase(test_mock_base.TestBase):
         )
 
         with mock.patch(
-            'vcloud_plugin_common.VcloudAirClient.get',
-            self.generate_vca()
+            'server_plugin.server.find_records',
+            self.generate_find_records()
         ):
-            with self.assertRaises(cfy_exc.NonRecoverableError):
-                server.creation_validation(ctx=fake_ctx)
+            with mock.patch(
+                'vcloud_plugin_common.VcloudAirClient.get',
+                self.generate_vca()
+            ):
+                with self.assertRaises(cfy_exc.NonRecoverableError):
+                    server.creation_validation(ctx=fake_ctx)
 
     def test_creation_validation_settings(self):
         fake_ctx = cfy_mocks.MockCloudifyContext(
@@ -245,10 +253,14 @@ class ServerPluginServerSubRoutesMockTestCase(test_mock_base.TestBase):
         )
 
         with mock.patch(
-            'vcloud_plugin_common.VcloudAirClient.get',
-            self.generate_vca()
+            'server_plugin.server.find_records',
+            self.generate_find_records()
         ):
-            server.creation_validation(ctx=fake_ctx)
+            with mock.patch(
+                'vcloud_plugin_common.VcloudAirClient.get',
+                self.generate_vca()
+            ):
+                server.creation_validation(ctx=fake_ctx)
 
     def test_isDhcpAvailable(self):
         client = self.generate_client()
@@ -513,6 +525,66 @@ class ServerPluginServerSubRoutesMockTestCase(test_mock_base.TestBase):
                 }])
                 self.assertTrue(server._get_state(fake_client))
 
+    def test_get_state_probe(self):
+        fake_ctx = self.generate_node_context(properties={
+            'management_network': '_management_network',
+            'vcloud_config': {
+                'vdc': 'vdc_name'
+            },
+            'server': {
+                'ip_probe': True
+            }
+        })
+        fake_client = self.generate_client()
+        not_ready = [{
+            'is_connected': True,
+            'network_name': '_management_network',
+            'ip': None
+        }, {
+            'is_connected': False,
+            'network_name': 'other',
+            'ip': None
+        }]
+        ready = [{
+            'is_connected': True,
+            'network_name': '_management_network',
+            'ip': '1.1.1.1'
+        }]
+        fake_get_href = mock.MagicMock(return_value='https://host/vm')
+        fake_connections = mock.MagicMock(side_effect=[not_ready, ready])
+        fake_sleep = mock.MagicMock()
+        with mock.patch('server_plugin.server.ctx', fake_ctx):
+            with mock.patch('vcloud_plugin_common.ctx', fake_ctx):
+                with mock.patch('server_plugin.server.get_vm_href',
+                                fake_get_href):
+                    with mock.patch(
+                        'server_plugin.server.get_vm_network_connections',
+                        fake_connections
+                    ):
+                        with mock.patch('server_plugin.server.time.sleep',
+                                        fake_sleep):
+                            self.assertTrue(server._get_state(fake_client))
+                            # section is requested again without retry
+                            # of operation
+                            self.assertEqual(fake_sleep.call_count, 1)
+                            self.assertEqual(
+                                fake_ctx.instance.runtime_properties['ip'],
+                                '1.1.1.1')
+                            # vApp is not requested
+                            self.assertFalse(fake_client.get_vapp.called)
+                            # href of VM is saved
+                            fake_connections.side_effect = None
+                            fake_connections.return_value = not_ready
+                            with mock.patch(
+                                'server_plugin.server.IP_PROBE_DEADLINE',
+                                -1
+                            ):
+                                self.assertFalse(
+                                    server._get_state(fake_client))
+                            self.assertEqual(fake_get_href.call_count, 1)
+                            fake_connections.assert_called_with(
+                                fake_client, 'https://host/vm')
+
 
 if __name__ == '__main__':
     unittest.main()
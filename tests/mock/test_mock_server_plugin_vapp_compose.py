@@ -0,0 +1,160 @@
+import mock
+import unittest
+from xml.etree import ElementTree
+
+from cloudify import exceptions as cfy_exc
+from server_plugin import vapp_compose
+import test_mock_base
+
+VCLOUD = '{http://www.vmware.com/vcloud/v1.5}'
+OVF = '{http://schemas.dmtf.org/ovf/envelope/1}'
+RASD = ('{http://schemas.dmtf.org/wbem/wscim/1/cim-schema/2/'
+        'CIM_ResourceAllocationSettingData}')
+
+
+class ServerPluginVappComposeMockTestCase(test_mock_base.TestBase):
+
+    def test_instantiate_params(self):
+        body = vapp_compose.instantiate_params(
+            'vapp', 'https://host/template', 'https://host/vm', u'vm\xe9',
+            networks=[('a', 'https://host/a'), ('b', 'https://host/b')],
+            connections=[{
+                'network': 'a', 'index': 0, 'primary_interface': False,
+                'ip_allocation_mode': 'POOL', 'mac_address': None,
+                'ip_address': None
+            }, {
+                'network': 'b', 'index': 1, 'primary_interface': True,
+                'ip_allocation_mode': 'MANUAL',
+                'mac_address': '00:50:56:01:01:01',
+                'ip_address': '10.1.1.1'
+            }],
+            cpu=2, memory=512,
+            customization={'script': 'echo "<1>" & exit',
+                           'computer_name': 'name',
+                           'admin_password': 'secret'})
+        root = ElementTree.fromstring(body)
+        self.assertEqual(root.get('name'), 'vapp')
+        self.assertEqual(root.find(VCLOUD + 'Source').get('href'),
+                         'https://host/template')
+        configs = root.findall('/'.join([
+            VCLOUD + 'InstantiationParams', VCLOUD + 'NetworkConfigSection',
+            VCLOUD + 'NetworkConfig']))
+        self.assertEqual([config.get('networkName') for config in configs],
+                         ['a', 'b'])
+        item = root.find(VCLOUD + 'SourcedItem')
+        self.assertEqual(item.find(VCLOUD + 'Source').get('href'),
+                         'https://host/vm')
+        self.assertEqual(item.find(VCLOUD + 'VmGeneralParams/' +
+                                   VCLOUD + 'Name').text, u'vm\xe9')
+        params = item.find(VCLOUD + 'InstantiationParams')
+        quantities = [element.text for element in params.findall(
+            OVF + 'VirtualHardwareSection/' + OVF + 'Item/' + RASD +
+            'VirtualQuantity')]
+        self.assertEqual(quantities, ['2', '512'])
+        section = params.find(VCLOUD + 'NetworkConnectionSection')
+        self.assertEqual(
+            section.find(VCLOUD + 'PrimaryNetworkConnectionIndex').text,
+            '1')
+        nics = section.findall(VCLOUD + 'NetworkConnection')
+        self.assertEqual([nic.get('network') for nic in nics], ['a', 'b'])
+        self.assertEqual(nics[0].find(VCLOUD + 'IpAddress'), None)
+        self.assertEqual(nics[1].find(VCLOUD + 'IpAddress').text,
+                         '10.1.1.1')
+        self.assertEqual(nics[1].find(VCLOUD + 'MACAddress').text,
+                         '00:50:56:01:01:01')
+        customization = params.find(VCLOUD + 'GuestCustomizationSection')
+        self.assertEqual(
+            customization.find(VCLOUD + 'CustomizationScript').text,
+            'echo "<1>" & exit')
+        self.assertEqual(
+            customization.find(VCLOUD + 'AdminPassword').text, 'secret')
+        # nothing to override
+        root = ElementTree.fromstring(vapp_compose.instantiate_params(
+            'vapp', 'https://host/template', 'https://host/vm', 'vm'))
+        self.assertEqual(root.find(VCLOUD + 'InstantiationParams'), None)
+        self.assertEqual(
+            root.find(VCLOUD + 'SourcedItem/' +
+                      VCLOUD + 'InstantiationParams'),
+            None)
+
+    def test_get_template_hrefs(self):
+        fake_client = self.generate_client()
+        response = mock.Mock()
+        response.status_code = 200
+        response.content = (
+            '<VAppTemplate xmlns="http://www.vmware.com/vcloud/v1.5">'
+            '<Children><Vm href="https://host/vm"/></Children>'
+            '</VAppTemplate>')
+        transport = mock.Mock()
+        transport.get = mock.MagicMock(return_value=response)
+        fake_find = mock.MagicMock(
+            return_value=[{'entity': 'https://host/template'}])
+        with mock.patch('server_plugin.vapp_compose.find_records',
+                        fake_find):
+            with mock.patch('server_plugin.vapp_compose.get_transport',
+                            mock.MagicMock(return_value=transport)):
+                self.assertEqual(
+                    vapp_compose.get_template_hrefs(
+                        fake_client, 'catalog', 'template'),
+                    ('https://host/template', 'https://host/vm'))
+                fake_find.assert_called_with(
+                    fake_client, 'catalogItem', name='template',
+                    catalogName='catalog')
+                # template without VMs
+                response.content = (
+                    '<VAppTemplate xmlns="http://www.vmware.com/vcloud/v1.5"'
+                    '/>')
+                with self.assertRaises(cfy_exc.NonRecoverableError):
+                    vapp_compose.get_template_hrefs(
+                        fake_client, 'catalog', 'template')
+                # unknown template
+                fake_find.return_value = []
+                with self.assertRaises(cfy_exc.NonRecoverableError):
+                    vapp_compose.get_template_hrefs(
+                        fake_client, 'catalog', 'template')
+
+    def test_compose_vapp(self):
+        fake_client = self.generate_client()
+        link = mock.Mock()
+        link.get_type = mock.MagicMock(
+            return_value=vapp_compose.INSTANTIATE_PARAMS_TYPE)
+        link.get_href = mock.MagicMock(
+            return_value='https://host/vdc/action/instantiateVAppTemplate')
+        fake_client._app_vdc.get_Link = mock.MagicMock(return_value=[link])
+        fake_client.vcloud_session.get_vcloud_headers = mock.MagicMock(
+            return_value={'x-vcloud-authorization': 'token'})
+        response = mock.Mock()
+        response.status_code = 201
+        transport = mock.Mock()
+        transport.post = mock.MagicMock(return_value=response)
+        task = mock.Mock()
+        vapp = mock.Mock()
+        vapp.get_Tasks().get_Task = mock.MagicMock(return_value=[task])
+        with mock.patch('server_plugin.vapp_compose.get_transport',
+                        mock.MagicMock(return_value=transport)):
+            with mock.patch(
+                'server_plugin.vapp_compose.vAppType.parseString',
+                mock.MagicMock(return_value=vapp)
+            ):
+                self.assertEqual(
+                    vapp_compose.compose_vapp(fake_client, 'vdc', 'body'),
+                    task)
+                transport.post.assert_called_once_with(
+                    'https://host/vdc/action/instantiateVAppTemplate',
+                    data='body', headers=mock.ANY)
+                self.assertEqual(
+                    transport.post.call_args[1]['headers']['Content-Type'],
+                    vapp_compose.INSTANTIATE_PARAMS_TYPE)
+                # request failed
+                response.status_code = 400
+                with self.assertRaises(cfy_exc.NonRecoverableError):
+                    vapp_compose.compose_vapp(fake_client, 'vdc', 'body')
+                # vdc without instantiate link
+                fake_client._app_vdc.get_Link = mock.MagicMock(
+                    return_value=[])
+                with self.assertRaises(cfy_exc.NonRecoverableError):
+                    vapp_compose.compose_vapp(fake_client, 'vdc', 'body')
+
+
+if __name__ == '__main__':
+    unittest.main()
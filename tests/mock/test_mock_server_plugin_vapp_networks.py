@@ -0,0 +1,220 @@
+import mock
+import unittest
+
+from cloudify import exceptions as cfy_exc
+from pyvcloud.schema.vcd.v1_5.schemas.vcloud import vAppType
+from server_plugin import vapp_networks
+import vcloud_plugin_common
+import test_mock_base
+
+
+class ServerPluginVappNetworksMockTestCase(test_mock_base.TestBase):
+
+    def generate_networks_vapp(self, networks=(), vm_networks=()):
+        config_section = vAppType.NetworkConfigSectionType()
+        config_section.add_Link(vAppType.LinkType(
+            href='https://host/api/vApp/id/networkConfigSection/',
+            type_=vapp_networks.NETWORK_CONFIG_SECTION_TYPE))
+        for name in networks:
+            config = vAppType.VAppNetworkConfigurationType()
+            config.set_networkName(name)
+            config_section.add_NetworkConfig(config)
+        connection_section = vAppType.NetworkConnectionSectionType()
+        for index, name in enumerate(vm_networks):
+            nic = vAppType.NetworkConnectionType()
+            nic.set_network(name)
+            nic.set_NetworkConnectionIndex(index)
+            connection_section.add_NetworkConnection(nic)
+        vm = mock.Mock()
+        vm.get_Section = mock.MagicMock(return_value=[connection_section])
+        vm.get_href = mock.MagicMock(return_value='https://host/api/vm/id')
+        vapp = self.generate_vapp()
+        vapp.name = 'vapp'
+        vapp.headers = {}
+        vapp.verify = True
+        vapp.me.get_Section = mock.MagicMock(return_value=[config_section])
+        vapp.me.get_Children().get_Vm = mock.MagicMock(return_value=[vm])
+        return vapp
+
+    def generate_connections(self, names):
+        return [{
+            'network': name,
+            'index': index,
+            'primary_interface': index == 1,
+            'ip_allocation_mode': 'MANUAL' if index else 'POOL',
+            'mac_address': None,
+            'ip_address': '10.1.1.{0}'.format(index)
+        } for index, name in enumerate(names)]
+
+    def test_network_config_section(self):
+        vapp = self.generate_networks_vapp(networks=['a'])
+        self.assertEqual(
+            vapp_networks.network_config_section(
+                vapp, [('a', 'https://host/a')]),
+            None)
+        section = vapp_networks.network_config_section(
+            vapp, [('a', 'https://host/a'), ('b', 'https://host/b'),
+                   ('c', 'https://host/c')])
+        self.assertEqual(
+            [config.get_networkName()
+             for config in section.get_NetworkConfig()],
+            ['a', 'b', 'c'])
+        self.assertEqual(
+            section.get_NetworkConfig()[2].get_Configuration()
+            .get_ParentNetwork().get_href(),
+            'https://host/c')
+        # vApp without section
+        vapp.me.get_Section = mock.MagicMock(return_value=[])
+        with self.assertRaises(cfy_exc.NonRecoverableError):
+            vapp_networks.network_config_section(
+                vapp, [('a', 'https://host/a')])
+
+    def test_network_connection_section(self):
+        vapp = self.generate_networks_vapp(vm_networks=['A'])
+        vm = vapp.me.get_Children().get_Vm()[0]
+        self.assertEqual(
+            vapp_networks.network_connection_section(
+                vm, self.generate_connections(['a'])),
+            None)
+        section = vapp_networks.network_connection_section(
+            vm, self.generate_connections(['a', 'b', 'c']))
+        nics = section.get_NetworkConnection()
+        self.assertEqual([nic.get_network() for nic in nics],
+                         ['A', 'b', 'c'])
+        self.assertEqual(nics[1].get_IpAddress(), '10.1.1.1')
+        self.assertEqual(nics[1].get_IpAddressAllocationMode(), 'MANUAL')
+        self.assertEqual(section.get_PrimaryNetworkConnectionIndex(), 1)
+
+    def test_connect_networks(self):
+        vapp = self.generate_networks_vapp()
+        fake_client = self.generate_client()
+        response = mock.Mock()
+        response.status_code = 202
+        transport = mock.Mock()
+        transport.put = mock.MagicMock(return_value=response)
+        task = self.generate_task(vcloud_plugin_common.TASK_STATUS_SUCCESS)
+        names = ['a', 'b', 'c', 'd']
+        with mock.patch('server_plugin.vapp_networks.get_transport',
+                        mock.MagicMock(return_value=transport)):
+            with mock.patch(
+                'server_plugin.vapp_networks.taskType.parseString',
+                mock.MagicMock(return_value=task)
+            ):
+                vapp_networks.connect_networks(
+                    fake_client, vapp,
+                    [(name, 'https://host/' + name) for name in names],
+                    self.generate_connections(names))
+                # one request per section for any number of NICs
+                self.assertEqual(transport.put.call_count, 2)
+                config_call, connection_call = transport.put.call_args_list
+                self.assertEqual(
+                    config_call[0][0],
+                    'https://host/api/vApp/id/networkConfigSection/')
+                self.assertEqual(
+                    connection_call[0][0],
+                    'https://host/api/vm/id/networkConnectionSection/')
+                for name in names:
+                    self.assertTrue(
+                        'networkName="{0}"'.format(name) in
+                        config_call[1]['data'])
+                    self.assertTrue(
+                        'network="{0}"'.format(name) in
+                        connection_call[1]['data'])
+                self.assertTrue(
+                    '<ovf:Info>' in config_call[1]['data'])
+                self.assertFalse('vmw:' in config_call[1]['data'])
+                self.assertTrue(
+                    '<ovf:Info>' in connection_call[1]['data'])
+                # everything is connected already
+                transport.put.reset_mock()
+                vapp_networks.connect_networks(
+                    fake_client, vapp, [('a', 'https://host/a')],
+                    self.generate_connections(['a']))
+                self.assertFalse(transport.put.called)
+                # request failed
+                response.status_code = 400
+                with self.assertRaises(cfy_exc.NonRecoverableError):
+                    vapp_networks.connect_networks(
+                        fake_client, vapp, [('e', 'https://host/e')],
+                        self.generate_connections(['e']))
+
+    def test_get_vm_network_connections(self):
+        fake_client = self.generate_client()
+        response = mock.Mock()
+        response.status_code = 200
+        response.content = (
+            '<NetworkConnectionSection'
+            ' xmlns="http://www.vmware.com/vcloud/v1.5">'
+            '<PrimaryNetworkConnectionIndex>1</PrimaryNetworkConnectionIndex>'
+            '<NetworkConnection network="a">'
+            '<NetworkConnectionIndex>0</NetworkConnectionIndex>'
+            '<IpAddress>10.1.1.2</IpAddress>'
+            '<IsConnected>true</IsConnected>'
+            '<MACAddress>00:50:56:01:01:01</MACAddress>'
+            '<IpAddressAllocationMode>POOL</IpAddressAllocationMode>'
+            '</NetworkConnection>'
+            '<NetworkConnection network="b">'
+            '<NetworkConnectionIndex>1</NetworkConnectionIndex>'
+            '<IsConnected>false</IsConnected>'
+            '<IpAddressAllocationMode>DHCP</IpAddressAllocationMode>'
+            '</NetworkConnection>'
+            '</NetworkConnectionSection>')
+        transport = mock.Mock()
+        transport.get = mock.MagicMock(return_value=response)
+        with mock.patch('server_plugin.vapp_networks.get_transport',
+                        mock.MagicMock(return_value=transport)):
+            self.assertEqual(
+                vapp_networks.get_vm_network_connections(
+                    fake_client, 'https://host/api/vm/id'),
+                [{
+                    'network_name': 'a', 'ip': '10.1.1.2',
+                    'mac': '00:50:56:01:01:01', 'is_connected': True,
+                    'is_primary': False, 'allocation_mode': 'POOL'
+                }, {
+                    'network_name': 'b', 'ip': None, 'mac': None,
+                    'is_connected': False, 'is_primary': True,
+                    'allocation_mode': 'DHCP'
+                }])
+            self.assertEqual(
+                transport.get.call_args[0][0],
+                'https://host/api/vm/id/networkConnectionSection/')
+            response.status_code = 404
+            with self.assertRaises(cfy_exc.NonRecoverableError):
+                vapp_networks.get_vm_network_connections(
+                    fake_client, 'https://host/api/vm/id')
+
+    def test_get_vm_href(self):
+        fake_client = self.generate_client()
+        fake_find = mock.MagicMock(side_effect=[
+            [{'href': 'https://host/api/vApp/vapp-id'}],
+            [{'href': 'https://host/api/vm/id'}]
+        ])
+        with mock.patch('server_plugin.vapp_networks.find_records',
+                        fake_find):
+            self.assertEqual(
+                vapp_networks.get_vm_href(fake_client, 'vdc', 'vapp'),
+                'https://host/api/vm/id')
+            # VM is looked up in vApp of vdc
+            self.assertEqual(fake_find.call_args_list, [
+                mock.call(fake_client, 'vApp', name='vapp',
+                          vdcName='vdc'),
+                mock.call(fake_client, 'vm',
+                          container='https://host/api/vApp/vapp-id',
+                          isVAppTemplate='false')
+            ])
+            # no vApp
+            fake_find.side_effect = [[]]
+            self.assertEqual(
+                vapp_networks.get_vm_href(fake_client, 'vdc', 'vapp'), None)
+            # VM of server can't be chosen
+            fake_find.side_effect = [
+                [{'href': 'https://host/api/vApp/vapp-id'}],
+                [{'href': 'https://host/api/vm/a'},
+                 {'href': 'https://host/api/vm/b'}]
+            ]
+            with self.assertRaises(cfy_exc.NonRecoverableError):
+                vapp_networks.get_vm_href(fake_client, 'vdc', 'vapp')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,9 +1,18 @@
 import mock
+import pyvcloud
+import os
+import shutil
+import tempfile
+import time
+import threading
 import unittest
 
 from cloudify import exceptions as cfy_exc
+from cloudify.state import current_ctx
 import test_mock_base
 import vcloud_plugin_common
+from vcloud_plugin_common import (async_client, inventory, parallel,
+                                  rate_limit, work_queue)
 
 
 class VcloudPluginCommonMockTestCase(test_mock_base.TestBase):
@@ -79,6 +88,54 @@ class VcloudPluginCommonMockTestCase(test_mock_base.TestBase):
             with self.assertRaises(cfy_exc.NonRecoverableError):
                 vcloud_plugin_common.get_vcloud_config()
 
+    def test_config_cache(self):
+        work_dir = tempfile.mkdtemp()
+        config_path = os.path.join(work_dir, 'vcloud_config.yaml')
+        try:
+            with open(config_path, 'w') as f:
+                f.write("vdc: vdc_name\norg: org_name\n")
+            with mock.patch.dict(
+                os.environ, {'VCLOUD_CONFIG_PATH': config_path}
+            ):
+                with mock.patch(
+                    'vcloud_plugin_common.yaml.load',
+                    mock.MagicMock(wraps=vcloud_plugin_common.yaml.load)
+                ) as fake_load:
+                    cfg = vcloud_plugin_common.Config().get()
+                    self.assertEqual(
+                        cfg, {'vdc': 'vdc_name', 'org': 'org_name'})
+                    self.assertTrue(
+                        cfg is vcloud_plugin_common.Config().get())
+                    self.assertEqual(fake_load.call_count, 1)
+                    # config is read only
+                    with self.assertRaises(cfy_exc.NonRecoverableError):
+                        cfg['vdc'] = 'other'
+                    # merged with node config
+                    fake_ctx = self.generate_node_context(properties={
+                        'vcloud_config': {'vdc': 'node_vdc'}
+                    })
+                    with mock.patch('vcloud_plugin_common.ctx', fake_ctx):
+                        merged = vcloud_plugin_common.get_vcloud_config()
+                        self.assertEqual(
+                            merged, {'vdc': 'node_vdc', 'org': 'org_name'})
+                        self.assertTrue(
+                            merged is
+                            vcloud_plugin_common.get_vcloud_config())
+                        fake_ctx.node.properties['vcloud_config'][
+                            'vdc'] = 'new_vdc'
+                        self.assertEqual(
+                            vcloud_plugin_common.get_vcloud_config()['vdc'],
+                            'new_vdc')
+                    # file changed
+                    with open(config_path, 'w') as f:
+                        f.write("vdc: changed_vdc\n")
+                    self.assertEqual(
+                        vcloud_plugin_common.Config().get(),
+                        {'vdc': 'changed_vdc'})
+                    self.assertEqual(fake_load.call_count, 2)
+        finally:
+            shutil.rmtree(work_dir)
+
     def test_transform_resource_name(self):
         fake_ctx = self.generate_node_context()
         fake_ctx._bootstrap_context = mock.Mock()
@@ -118,6 +175,843 @@ class VcloudPluginCommonMockTestCase(test_mock_base.TestBase):
             ),
             'prfx_prfx_test'
         )
+    def test_session_cache(self):
+        cache_dir = tempfile.mkdtemp()
+        try:
+            cache = vcloud_plugin_common.SessionCache(cache_dir, ttl=60)
+            cfg = {'url': 'url', 'org': 'org', 'username': 'user',
+                   'password': 'secret'}
+            key = cache.key(cfg)
+            # password is not part of key
+            self.assertEqual(
+                key,
+                cache.key({'url': 'url', 'org': 'org', 'username': 'user'})
+            )
+            self.assertNotEqual(
+                key,
+                cache.key({'url': 'url', 'org': 'other', 'username': 'user'})
+            )
+            # nothing cached
+            self.assertIsNone(cache.load(key, cfg))
+            # cached
+            cache.store(key, {'vcloud_token': 'token'}, cfg)
+            self.assertEqual(cache.load(key, cfg)['vcloud_token'], 'token')
+            # credentials are not saved as is
+            with open(cache._file_name(key)) as f:
+                self.assertNotIn('secret', f.read())
+            # other password or token does not get the session
+            self.assertIsNone(cache.load(key, dict(cfg, password='wrong')))
+            self.assertIsNone(cache.load(
+                key, {'url': 'url', 'org': 'org', 'username': 'user',
+                      'token': 'token'}))
+            self.assertEqual(cache.load(key, cfg)['vcloud_token'], 'token')
+            # dropped
+            cache.drop(key)
+            self.assertIsNone(cache.load(key, cfg))
+            # expired
+            cache.ttl = -1
+            cache.store(key, {'vcloud_token': 'token'}, cfg)
+            self.assertIsNone(cache.load(key, cfg))
+        finally:
+            shutil.rmtree(cache_dir)
+
+    def test_connect_with_cached_session(self):
+        cache_dir = tempfile.mkdtemp()
+        fake_ctx = self.generate_node_context()
+        cfg = {
+            'url': 'url',
+            'username': 'user',
+            'password': 'secret',
+            'service': 'service',
+            'org': 'org',
+            'session_cache_path': cache_dir
+        }
+        cache = vcloud_plugin_common.SessionCache(cache_dir)
+        key = cache.key(cfg)
+        session = {
+            'version': '5.6',
+            'token': 'vchs_token',
+            'vcloud_token': 'vcloud_token',
+            'session_url': 'org_url',
+            'org': 'org',
+            'instance': None,
+            'api_url': 'org_url',
+            'org_url': 'org_url'
+        }
+        logined_vca = mock.Mock(version='5.6', token='new_vchs_token')
+        logined_vca.vcloud_session = mock.Mock(
+            token='new_vcloud_token', url='org_url', org='org',
+            instance=None, api_url='org_url', org_url='org_url')
+        client = vcloud_plugin_common.VcloudAirClient()
+        client._subscription_login = mock.MagicMock(return_value=logined_vca)
+        try:
+            with mock.patch('vcloud_plugin_common.ctx', fake_ctx):
+                with mock.patch('vcloud_plugin_common.VCS') as fake_vcs:
+                    # token accepted, no full login
+                    cache.store(key, session, cfg)
+                    fake_vcs.return_value.login = mock.MagicMock(
+                        return_value=True)
+                    vca = client.connect(cfg)
+                    self.assertFalse(client._subscription_login.called)
+                    self.assertEqual(vca.token, 'vchs_token')
+                    fake_vcs.return_value.login.assert_called_with(
+                        token='vcloud_token')
+                    # expired token, full login and cache refresh
+                    fake_vcs.return_value.login = mock.MagicMock(
+                        return_value=False)
+                    vca = client.connect(cfg)
+                    self.assertTrue(client._subscription_login.called)
+                    self.assertEqual(vca, logined_vca)
+                    self.assertEqual(cache.load(key, cfg)['vcloud_token'],
+                                     'new_vcloud_token')
+                    self.assertTrue(
+                        cache.load(key, cfg)['expires'] > time.time())
+                    # wrong password does not get cached session
+                    fake_vcs.return_value.login = mock.MagicMock(
+                        return_value=True)
+                    client._subscription_login.reset_mock()
+                    vca = client.connect(dict(cfg, password='wrong'))
+                    self.assertTrue(client._subscription_login.called)
+                    self.assertFalse(fake_vcs.return_value.login.called)
+                    # cache disabled
+                    client._subscription_login.reset_mock()
+                    cfg['session_cache'] = False
+                    with mock.patch('vcloud_plugin_common.atexit'):
+                        client.connect(cfg)
+                    self.assertTrue(client._subscription_login.called)
+                    # requests are limited for organization
+                    cfg['max_in_flight'] = 2
+                    cfg['rate_limit_path'] = cache_dir
+                    with mock.patch('vcloud_plugin_common.atexit'):
+                        client.connect(cfg)
+                    transport = vcloud_plugin_common.get_transport()
+                    governor = transport.get_governor(
+                        {'x-vcloud-authorization': 'new_vcloud_token'})
+                    self.assertEqual(governor.max_in_flight, 2)
+                    self.assertEqual(governor.key,
+                                     rate_limit.governor_key(cfg))
+                    # other organization without limits does not change
+                    # governor of the first one
+                    other_vca = mock.Mock(version='5.6', token=None)
+                    other_vca.vcloud_session = mock.Mock(
+                        token='other_vcloud_token')
+                    client._subscription_login.return_value = other_vca
+                    other_cfg = dict(cfg, org='other')
+                    del other_cfg['max_in_flight']
+                    with mock.patch('vcloud_plugin_common.atexit'):
+                        client.connect(other_cfg)
+                    self.assertIsNone(transport.get_governor(
+                        {'x-vcloud-authorization': 'other_vcloud_token'}))
+                    self.assertEqual(transport.get_governor(
+                        {'x-vcloud-authorization': 'new_vcloud_token'}),
+                        governor)
+        finally:
+            vcloud_plugin_common.get_transport().governors.pop(
+                rate_limit.governor_key(cfg), None)
+            shutil.rmtree(cache_dir)
+    def test_transport(self):
+        transport = vcloud_plugin_common.transport.Transport(
+            pool_connections=1, pool_maxsize=2)
+        transport.session.request = mock.MagicMock(return_value='response')
+        original_requests = pyvcloud.requests
+        try:
+            # pyvcloud requests go through pooled session
+            transport.install()
+            self.assertEqual(
+                pyvcloud.Http.get('https://host/api', headers={}),
+                'response'
+            )
+            transport.session.request.assert_called_with(
+                'GET', 'https://host/api', allow_redirects=True, headers={}
+            )
+            pyvcloud.Http.post('https://host/api', data='body')
+            self.assertEqual(
+                transport.session.request.call_args[0],
+                ('POST', 'https://host/api')
+            )
+        finally:
+            pyvcloud.requests = original_requests
+        # no connections
+        self.assertEqual(
+            transport.stats(),
+            {'pool_maxsize': 2, 'hosts': 0, 'connections': 0,
+             'requests': 0, 'reused': 0}
+        )
+        # 5 requests over single connection
+        transport.adapter.poolmanager.pools['host'] = mock.Mock(
+            num_connections=1, num_requests=5)
+        self.assertEqual(
+            transport.stats(),
+            {'pool_maxsize': 2, 'hosts': 1, 'connections': 1,
+             'requests': 5, 'reused': 4}
+        )
+
+    def test_inventory_store(self):
+        work_dir = tempfile.mkdtemp()
+        try:
+            store = vcloud_plugin_common.InventoryStore(
+                os.path.join(work_dir, 'inventory.sqlite'),
+                {'catalog': 100})
+            self.assertEqual(store.get_ttl('https://host/api/catalog/1'), 100)
+            self.assertEqual(
+                store.get_ttl('https://host/api/admin/network/1'), 300)
+            self.assertEqual(store.get_ttl('https://host/api/vApp/1'), None)
+            self.assertEqual(
+                store.get_ttl('https://host/api/catalog/1/action/upload'),
+                None)
+            url = 'https://host/api/catalog/1'
+            session = mock.Mock()
+            session.get = mock.MagicMock(return_value=mock.Mock(
+                status_code=200, content='<Catalog/>',
+                headers={'ETag': 'v1', 'Content-Type': 'catalog+xml'}))
+            # first request goes to vCloud, second one is from store
+            for _ in range(2):
+                response = store.fetch(session, url, 'org',
+                                       headers={'a': 'b'})
+                self.assertEqual(response.content, '<Catalog/>')
+            self.assertEqual(session.get.call_count, 1)
+            # not stored types always go to vCloud
+            store.fetch(session, 'https://host/api/vApp/1', 'org')
+            self.assertEqual(session.get.call_count, 2)
+            # other organization or user does not see stored entity
+            store.fetch(session, url, 'other', headers={'a': 'b'})
+            self.assertEqual(session.get.call_count, 3)
+            store.invalidate(url)
+            store.fetch(session, url, 'org', headers={'a': 'b'})
+            self.assertEqual(session.get.call_count, 4)
+            store.hits = store.misses = 0
+            # expired entry is revalidated with etag
+            session.get.return_value = mock.Mock(
+                status_code=304, content='', headers={})
+            with mock.patch(
+                'vcloud_plugin_common.inventory_store.time.time',
+                mock.MagicMock(return_value=time.time() + 1000)
+            ):
+                response = store.fetch(session, url, 'org',
+                                       headers={'a': 'b'})
+            self.assertEqual(response.content, '<Catalog/>')
+            session.get.assert_called_with(
+                url, headers={'a': 'b', 'If-None-Match': 'v1'})
+            self.assertEqual(
+                store.stats(), {'hits': 0, 'misses': 1, 'revalidated': 1})
+            # change of entity drops it
+            store.invalidate(url + '/action/upload')
+            self.assertEqual(store._load('org', url, ''), None)
+            # network is dropped for both its hrefs
+            entry = {'etag': None, 'content_type': None,
+                     'content': '<OrgVdcNetwork/>',
+                     'expires': time.time() + 100}
+            store._save('org', 'https://host/api/network/1', '', entry)
+            store.invalidate('https://host/api/admin/network/1')
+            self.assertEqual(
+                store._load('org', 'https://host/api/network/1', ''), None)
+            # '_' and '%' of href are not wildcards
+            store._save('org', 'https://host/api/catalog/ab', '', entry)
+            store.invalidate('https://host/api/catalog/_b')
+            store.invalidate('https://host/api/catalog/%')
+            self.assertEqual(
+                store._load('org', 'https://host/api/catalog/ab', ''),
+                entry)
+            # transport uses store
+            transport = vcloud_plugin_common.transport.Transport()
+            transport.session = session
+            transport.inventory_store = store
+            session.get.return_value = mock.Mock(
+                status_code=200, content='<Catalog/>', headers={})
+            headers = {'x-vcloud-authorization': 'token'}
+            # request without registered session is not stored
+            transport.get(url, headers=headers)
+            self.assertEqual(store._load('org', url, ''), None)
+            transport.register_session(['token'], 'org')
+            transport.get(url, headers=headers)
+            transport.get(url, headers=headers)
+            self.assertEqual(store.stats()['hits'], 1)
+            transport.delete(url, headers=headers)
+            self.assertEqual(store._load('org', url, ''), None)
+        finally:
+            shutil.rmtree(work_dir)
+
+    def test_polling_strategy(self):
+        strategy = vcloud_plugin_common.PollingStrategy(
+            deadline=None, min_interval=1, max_interval=4, backoff=2)
+        # grows toward the cap
+        self.assertEqual(
+            [strategy.next_interval() for _ in range(4)],
+            [1, 2, 4, 4]
+        )
+        self.assertFalse(strategy.is_expired())
+        # progress estimates time left
+        strategy.started = time.time() - 9
+        self.assertAlmostEqual(strategy.next_interval(90), 1, places=1)
+        self.assertEqual(strategy.next_interval(10), 4)
+        # never sleep beyond deadline
+        strategy.deadline = 10
+        self.assertTrue(strategy.next_interval() <= 1)
+        strategy.started = time.time() - 11
+        self.assertTrue(strategy.is_expired())
+        self.assertEqual(strategy.next_interval(), 0)
+
+    def test_wait_for_task(self):
+        fake_client = self.generate_client()
+        strategy = vcloud_plugin_common.PollingStrategy(
+            deadline=None, min_interval=0, max_interval=0)
+        # already finished
+        stats = vcloud_plugin_common.wait_for_task(
+            fake_client,
+            self.generate_task(vcloud_plugin_common.TASK_STATUS_SUCCESS),
+            strategy)
+        self.assertEqual(stats.polls, 0)
+        self.assertEqual(stats.status,
+                         vcloud_plugin_common.TASK_STATUS_SUCCESS)
+        # error
+        with self.assertRaises(cfy_exc.NonRecoverableError):
+            vcloud_plugin_common.wait_for_task(
+                fake_client,
+                self.generate_task(vcloud_plugin_common.TASK_STATUS_ERROR),
+                strategy)
+        # canceled task is not polled
+        fake_transport = mock.Mock()
+        with mock.patch(
+            'vcloud_plugin_common.get_transport',
+            mock.MagicMock(return_value=fake_transport)
+        ):
+            canceled = self.generate_task(
+                vcloud_plugin_common.TASK_STATUS_CANCELED)
+            canceled.get_Error = mock.MagicMock(return_value=None)
+            with self.assertRaises(cfy_exc.NonRecoverableError):
+                vcloud_plugin_common.wait_for_task(
+                    fake_client, canceled, strategy)
+            self.assertFalse(fake_transport.get.called)
+        # finished after two checks
+        running = self.generate_task('running')
+        fake_transport = mock.Mock()
+        with mock.patch(
+            'vcloud_plugin_common.get_transport',
+            mock.MagicMock(return_value=fake_transport)
+        ):
+            with mock.patch(
+                'vcloud_plugin_common.taskType.parseString',
+                mock.MagicMock(side_effect=[
+                    self.generate_task('running'),
+                    self.generate_task(
+                        vcloud_plugin_common.TASK_STATUS_SUCCESS)
+                ])
+            ):
+                stats = vcloud_plugin_common.wait_for_task(
+                    fake_client, running, strategy)
+            self.assertEqual(stats.polls, 2)
+            self.assertEqual(fake_transport.get.call_count, 2)
+            # deadline reached
+            strategy.deadline = -1
+            with self.assertRaises(cfy_exc.NonRecoverableError):
+                vcloud_plugin_common.wait_for_task(
+                    fake_client, running, strategy)
+
+    def test_query_records(self):
+        self.assertEqual(
+            vcloud_plugin_common.query.get_api_url(
+                'https://host/api/task/1234'),
+            'https://host/api'
+        )
+        with self.assertRaises(cfy_exc.NonRecoverableError):
+            vcloud_plugin_common.query.get_api_url('https://host/1234')
+        content = '''<?xml version="1.0" encoding="UTF-8"?>
+            <QueryResultRecords xmlns="http://www.vmware.com/vcloud/v1.5">
+                <Link rel="alternate" href="https://host/api/query"/>
+                <TaskRecord href="https://host/api/task/1" status="success"/>
+                <TaskRecord href="https://host/api/task/2" status="running"/>
+            </QueryResultRecords>'''
+        response = mock.Mock(status_code=200, content=content)
+        fake_transport = mock.Mock()
+        fake_transport.get = mock.MagicMock(return_value=response)
+        fake_client = self.generate_client()
+        with mock.patch(
+            'vcloud_plugin_common.query.get_transport',
+            mock.MagicMock(return_value=fake_transport)
+        ):
+            self.assertEqual(
+                vcloud_plugin_common.query.query_records(
+                    fake_client, 'https://host/api/task/1', 'task',
+                    'id==1'),
+                [{'href': 'https://host/api/task/1', 'status': 'success'},
+                 {'href': 'https://host/api/task/2', 'status': 'running'}]
+            )
+            self.assertEqual(
+                fake_transport.get.call_args[1]['params'],
+                {'type': 'task', 'format': 'records', 'filter': 'id==1',
+                 'page': 1, 'pageSize': 128}
+            )
+            # all pages are requested
+            pages = [
+                '''<QueryResultRecords
+                    xmlns="http://www.vmware.com/vcloud/v1.5" total="3">
+                    <CatalogRecord name="a"/><CatalogRecord name="b"/>
+                </QueryResultRecords>''',
+                '''<QueryResultRecords
+                    xmlns="http://www.vmware.com/vcloud/v1.5" total="3">
+                    <CatalogRecord name="c"/>
+                </QueryResultRecords>'''
+            ]
+            fake_transport.get = mock.MagicMock(side_effect=[
+                mock.Mock(status_code=200, content=page) for page in pages
+            ])
+            fake_client.vcloud_session.url = 'https://host/api/session'
+            self.assertEqual(
+                vcloud_plugin_common.query.find_records(
+                    fake_client, 'catalog', name='x', isShared='true'),
+                [{'name': 'a'}, {'name': 'b'}, {'name': 'c'}]
+            )
+            self.assertEqual(fake_transport.get.call_count, 2)
+            self.assertEqual(
+                fake_transport.get.call_args[0][0], 'https://host/api/query')
+            self.assertEqual(
+                fake_transport.get.call_args[1]['params']['filter'],
+                'isShared==true;name==x')
+            # reserved characters of names are encoded
+            fake_transport.get = mock.MagicMock(return_value=mock.Mock(
+                status_code=200, content=pages[1]))
+            vcloud_plugin_common.query.find_records(
+                fake_client, 'catalogItem', name=u'a (b);c==d,\xe9')
+            self.assertEqual(
+                fake_transport.get.call_args[1]['params']['filter'],
+                'name==a%20%28b%29%3Bc%3D%3Dd%2C%C3%A9')
+            fake_transport.get = mock.MagicMock(return_value=response)
+            # query failed
+            response.status_code = 400
+            with self.assertRaises(cfy_exc.NonRecoverableError):
+                vcloud_plugin_common.query.query_records(
+                    fake_client, 'https://host/api/task/1', 'task')
+
+    def test_wait_for_tasks(self):
+        fake_client = self.generate_client()
+        strategy = vcloud_plugin_common.PollingStrategy(
+            deadline=None, min_interval=0, max_interval=0)
+        finished = self.generate_task(
+            vcloud_plugin_common.TASK_STATUS_SUCCESS)
+        first = self.generate_task('running')
+        first.get_href = mock.MagicMock(return_value='https://host/api/task/1')
+        second = self.generate_task('queued')
+        second.get_href = mock.MagicMock(return_value='https://host/api/task/2')
+        fake_query = mock.MagicMock(side_effect=[
+            [{'href': 'https://host/api/task/1', 'status': 'success'},
+             {'href': 'https://host/api/task/2', 'status': 'running'}],
+            [{'href': 'https://host/api/task/2', 'status': 'success'}],
+        ])
+        with mock.patch('vcloud_plugin_common.query_records', fake_query):
+            stats = vcloud_plugin_common.wait_for_tasks(
+                fake_client, [finished, first, second], strategy)
+        self.assertEqual(stats.polls, 2)
+        # single query for both tasks
+        self.assertEqual(
+            fake_query.call_args_list[0][0][3],
+            '(id==urn:vcloud:task:1,id==urn:vcloud:task:2)'
+        )
+        self.assertEqual(
+            fake_query.call_args_list[1][0][3],
+            '(id==urn:vcloud:task:2)'
+        )
+        # failed task
+        fake_query = mock.MagicMock(return_value=[
+            {'href': 'https://host/api/task/1', 'status': 'error'}
+        ])
+        with mock.patch('vcloud_plugin_common.query_records', fake_query):
+            with mock.patch(
+                'vcloud_plugin_common._get_task',
+                mock.MagicMock(return_value=self.generate_task(
+                    vcloud_plugin_common.TASK_STATUS_ERROR))
+            ):
+                with self.assertRaises(cfy_exc.NonRecoverableError):
+                    vcloud_plugin_common.wait_for_tasks(
+                        fake_client, [first, second], strategy)
+        # errors are collected, other tasks are waited for
+        fake_query = mock.MagicMock(side_effect=[
+            [{'href': 'https://host/api/task/1', 'status': 'error'},
+             {'href': 'https://host/api/task/2', 'status': 'running'}],
+            [{'href': 'https://host/api/task/2', 'status': 'success'}],
+        ])
+        failed = {}
+        with mock.patch('vcloud_plugin_common.query_records', fake_query):
+            with mock.patch(
+                'vcloud_plugin_common._get_task',
+                mock.MagicMock(return_value=self.generate_task(
+                    vcloud_plugin_common.TASK_STATUS_ERROR))
+            ):
+                stats = vcloud_plugin_common.wait_for_tasks(
+                    fake_client, [first, second], strategy, failed)
+        self.assertEqual(stats.status,
+                         vcloud_plugin_common.TASK_STATUS_ERROR)
+        self.assertEqual(stats.polls, 2)
+        self.assertEqual(failed.keys(), ['https://host/api/task/1'])
+        # already failed
+        with self.assertRaises(cfy_exc.NonRecoverableError):
+            vcloud_plugin_common.wait_for_tasks(
+                fake_client,
+                [finished, self.generate_task(
+                    vcloud_plugin_common.TASK_STATUS_ERROR)],
+                strategy)
+        # the same failed statuses as for wait_for_task
+        for status in vcloud_plugin_common.TASK_FAILED_STATUSES:
+            failed = {}
+            task = self.generate_task(status)
+            task.get_href = mock.MagicMock(return_value='https://host/task')
+            vcloud_plugin_common.wait_for_tasks(
+                fake_client, [task], strategy, failed)
+            self.assertEqual(failed.keys(), ['https://host/task'])
+            with self.assertRaises(cfy_exc.NonRecoverableError):
+                vcloud_plugin_common.wait_for_task(fake_client, task,
+                                                   strategy)
+
+    def test_run_task(self):
+        fake_client = self.generate_client()
+        fake_ctx = self.generate_node_context(properties={
+            'vcloud_config': {'vdc': 'vdc_name'}
+        })
+        running = self.generate_task('running')
+        running.get_href = mock.MagicMock(return_value='https://host/task/1')
+        submit = mock.MagicMock(return_value=running)
+        fake_wait = mock.MagicMock()
+        with mock.patch('vcloud_plugin_common.ctx', fake_ctx):
+            with mock.patch('vcloud_plugin_common.wait_for_task', fake_wait):
+                # nothing to do
+                self.assertFalse(vcloud_plugin_common.run_task(
+                    fake_client, 'task', mock.MagicMock(return_value=None)))
+                # synchronous mode
+                self.assertFalse(vcloud_plugin_common.run_task(
+                    fake_client, 'task', submit))
+                fake_wait.assert_called_with(fake_client, running, None)
+                self.assertFalse(
+                    fake_ctx.instance.runtime_properties.get(
+                        vcloud_plugin_common.ASYNC_TASKS))
+                # asynchronous mode, task is saved
+                fake_wait.reset_mock()
+                fake_ctx.node.properties['vcloud_config'][
+                    'async_tasks'] = True
+                self.assertTrue(vcloud_plugin_common.run_task(
+                    fake_client, 'task', submit))
+                self.assertFalse(fake_wait.called)
+                self.assertEqual(
+                    fake_ctx.instance.runtime_properties[
+                        vcloud_plugin_common.ASYNC_TASKS],
+                    {'task': 'https://host/task/1'})
+                # retry, task is still running
+                submit.reset_mock()
+                with mock.patch(
+                    'vcloud_plugin_common._get_task',
+                    mock.MagicMock(return_value=running)
+                ):
+                    self.assertTrue(vcloud_plugin_common.run_task(
+                        fake_client, 'task', submit))
+                self.assertFalse(submit.called)
+                # retry, task is finished
+                with mock.patch(
+                    'vcloud_plugin_common._get_task',
+                    mock.MagicMock(return_value=self.generate_task(
+                        vcloud_plugin_common.TASK_STATUS_SUCCESS))
+                ):
+                    self.assertFalse(vcloud_plugin_common.run_task(
+                        fake_client, 'task', submit))
+                self.assertEqual(
+                    fake_ctx.instance.runtime_properties[
+                        vcloud_plugin_common.ASYNC_TASKS], {})
+                # retry, task is failed
+                fake_ctx.instance.runtime_properties[
+                    vcloud_plugin_common.ASYNC_TASKS
+                ] = {'task': 'https://host/task/1'}
+                with mock.patch(
+                    'vcloud_plugin_common._get_task',
+                    mock.MagicMock(return_value=self.generate_task(
+                        vcloud_plugin_common.TASK_STATUS_ERROR))
+                ):
+                    with self.assertRaises(cfy_exc.NonRecoverableError):
+                        vcloud_plugin_common.run_task(
+                            fake_client, 'task', submit)
+                self.assertEqual(
+                    fake_ctx.instance.runtime_properties[
+                        vcloud_plugin_common.ASYNC_TASKS], {})
+        self.assertFalse(submit.called)
+
+    def test_inventory_cache(self):
+        fake_client = self.generate_client()
+        client = vcloud_plugin_common.InventoryCache(fake_client)
+        vdc = client.get_vdc('vdc_name')
+        self.assertTrue(vdc is client.get_vdc('vdc_name'))
+        fake_client.get_vdc.assert_called_once_with('vdc_name')
+        vapp = client.get_vapp(vdc, 'vapp_name')
+        self.assertTrue(vapp is client.get_vapp(vdc, 'vapp_name'))
+        fake_client.get_vapp.assert_called_once_with(vdc, 'vapp_name')
+        client.get_gateway('vdc_name', 'gateway')
+        client.get_gateway('vdc_name', 'gateway')
+        self.assertEqual(fake_client.get_gateway.call_count, 1)
+        self.assertEqual(
+            client.stats(), {'hits': 3, 'misses': 3, 'entries': 3})
+        # not found objects are not cached
+        fake_client.get_vapp = mock.MagicMock(return_value=None)
+        client.get_vapp(vdc, 'other')
+        client.get_vapp(vdc, 'other')
+        self.assertEqual(fake_client.get_vapp.call_count, 2)
+        # other attributes are from client
+        self.assertTrue(client.create_vdc_network is
+                        fake_client.create_vdc_network)
+        # task invalidates cache
+        vcloud_plugin_common.wait_for_task(
+            client,
+            self.generate_task(vcloud_plugin_common.TASK_STATUS_SUCCESS))
+        client.get_vdc('vdc_name')
+        self.assertEqual(fake_client.get_vdc.call_count, 2)
+
+    def test_run_parallel(self):
+        # results in order of calls
+        self.assertEqual(
+            parallel.run_parallel([lambda: 1, lambda: 2, lambda: 3],
+                                  max_workers=2),
+            [1, 2, 3])
+        self.assertEqual(parallel.run_parallel([]), [])
+        # calls are in other threads with context of caller
+        fake_ctx = self.generate_node_context()
+        threads = set()
+
+        def call():
+            threads.add(threading.current_thread())
+            return current_ctx.get_ctx()
+
+        current_ctx.set(fake_ctx)
+        try:
+            self.assertEqual(parallel.run_parallel([call, call]),
+                             [fake_ctx, fake_ctx])
+        finally:
+            current_ctx.clear()
+        self.assertFalse(threading.current_thread() in threads)
+
+        # single error is raised as is
+        def fail(error):
+            def call():
+                raise error
+            return call
+
+        with self.assertRaises(KeyError):
+            parallel.run_parallel([lambda: 1, fail(KeyError('a'))])
+        # errors of several calls are merged
+        with self.assertRaises(cfy_exc.NonRecoverableError) as context:
+            parallel.run_parallel([fail(cfy_exc.NonRecoverableError('a')),
+                                   lambda: 1,
+                                   fail(cfy_exc.NonRecoverableError('b'))])
+        self.assertEqual(str(context.exception), 'a; b')
+
+    def test_run_parallel_clients(self):
+        class FakeVCA(object):
+            """
+                keeps response in client as pyvcloud VCA, each call reads
+                its response after all calls have set theirs
+            """
+
+            def __init__(self, calls):
+                self.response = None
+                self.calls = calls
+                self.arrived = []
+                self.condition = threading.Condition()
+
+            def get_vdc(self, name):
+                self.response = name
+                with self.condition:
+                    self.arrived.append(name)
+                    self.condition.notify_all()
+                    deadline = time.time() + 5
+                    while len(self.arrived) < self.calls and \
+                            time.time() < deadline:
+                        self.condition.wait(0.1)
+                return self.response
+
+        calls = [lambda client: client.get_vdc('a'),
+                 lambda client: client.get_vdc('b')]
+        fake_client = inventory.InventoryCache(FakeVCA(2))
+        self.assertEqual(
+            parallel.run_parallel_clients(fake_client, calls), ['a', 'b'])
+        # results and counters are shared with wrapper of caller
+        self.assertEqual(fake_client.stats(),
+                         {'hits': 0, 'misses': 2, 'entries': 2})
+        parallel.run_parallel_clients(fake_client, calls)
+        self.assertEqual(fake_client.stats(),
+                         {'hits': 2, 'misses': 2, 'entries': 2})
+        # calls with the same client read response of each other
+        fake_client = inventory.InventoryCache(FakeVCA(2))
+        self.assertNotEqual(
+            parallel.run_parallel([lambda call=call: call(fake_client)
+                                   for call in calls]),
+            ['a', 'b'])
+
+    def test_async_client(self):
+        fake_client = self.generate_client()
+        fake_client.vcloud_session.get_vcloud_headers = mock.MagicMock(
+            return_value={'x-vcloud-authorization': 'token'})
+        lock = threading.Lock()
+        in_flight = {'now': 0, 'max': 0}
+
+        def fake_get(url, **kwargs):
+            with lock:
+                in_flight['now'] += 1
+                in_flight['max'] = max(in_flight['max'], in_flight['now'])
+            time.sleep(0.01)
+            with lock:
+                in_flight['now'] -= 1
+            return (url, kwargs)
+
+        transport = mock.Mock()
+        transport.get = fake_get
+        transport.post = mock.MagicMock(return_value='posted')
+        # client is not logged in
+        with async_client.AsyncVcloudClient() as client:
+            with self.assertRaises(cfy_exc.NonRecoverableError):
+                client.get('https://host/a').result()
+        with mock.patch('vcloud_plugin_common.async_client.get_transport',
+                        mock.MagicMock(return_value=transport)):
+            with async_client.AsyncVcloudClient(
+                fake_client, max_workers=8, max_per_endpoint=2
+            ) as client:
+                responses = client.gather(
+                    [client.get('https://host/{0}'.format(index))
+                     for index in xrange(8)])
+                self.assertEqual(responses[3][0], 'https://host/3')
+                self.assertEqual(
+                    responses[3][1],
+                    {'headers': {'x-vcloud-authorization': 'token'}})
+                # requests to one host are limited
+                self.assertEqual(in_flight['max'], 2)
+                self.assertEqual(
+                    client.post('https://host/a', data='body',
+                                headers={'Content-Type': 'type'}).result(),
+                    'posted')
+                transport.post.assert_called_with(
+                    'https://host/a', data='body',
+                    headers={'x-vcloud-authorization': 'token',
+                             'Content-Type': 'type'})
+                # tasks
+                task = self.generate_task(
+                    vcloud_plugin_common.TASK_STATUS_SUCCESS)
+                self.assertEqual(
+                    client.wait_for_task(task).result().status,
+                    vcloud_plugin_common.TASK_STATUS_SUCCESS)
+            # by default limited by connections kept in pool for one host
+            transport.pool_maxsize = 3
+            in_flight['max'] = 0
+            with async_client.AsyncVcloudClient(
+                fake_client, max_workers=8
+            ) as client:
+                client.gather([client.get('https://host/{0}'.format(index))
+                               for index in xrange(8)])
+            self.assertEqual(in_flight['max'], 3)
+
+    def test_work_queue(self):
+        # scope is resource of vdc, credentials are not part of it
+        key = work_queue.scope_key(
+            {'url': 'https://host', 'org': 'org', 'vdc': 'vdc'}, 'a', 'b')
+        self.assertEqual(key, work_queue.scope_key(
+            {'url': 'https://host', 'org': 'org', 'vdc': 'vdc',
+             'username': 'user'}, 'a', 'b'))
+        self.assertNotEqual(key, work_queue.scope_key(
+            {'url': 'https://host', 'org': 'org', 'vdc': 'vdc'}, 'a', 'c'))
+        work_dir = tempfile.mkdtemp()
+        try:
+            store = work_queue.WorkQueue(work_dir)
+            first = store.add('key', ['a'])
+            second = store.add('key', ['b'])
+            self.assertEqual(store.pending('other'), [])
+            self.assertEqual(store.pending('key'), [
+                (first, ['a']),
+                (second, ['b'])
+            ])
+            self.assertEqual(store.result('key', first), None)
+            store.complete('key', [first], work_queue.STATUS_SUCCESS)
+            self.assertEqual(store.pending('key'), [
+                (second, ['b'])
+            ])
+            self.assertEqual(store.result('key', first),
+                             {'status': 'success', 'message': None})
+            # result is read once
+            self.assertEqual(store.result('key', first), None)
+            store.discard('key', second)
+            self.assertEqual(store.pending('key'), [])
+            # lock is exclusive
+            with store.lock('key') as locked:
+                self.assertTrue(locked)
+                with store.lock('key') as other_locked:
+                    self.assertFalse(other_locked)
+            with store.lock('key') as locked:
+                self.assertTrue(locked)
+        finally:
+            shutil.rmtree(work_dir)
+
+    def test_request_governor(self):
+        # organizations have own limits
+        self.assertNotEqual(
+            rate_limit.governor_key({'url': 'https://host', 'org': 'a'}),
+            rate_limit.governor_key({'url': 'https://host', 'org': 'b'}))
+        work_dir = tempfile.mkdtemp()
+        try:
+            # burst of 2 requests, then 20 requests per second
+            governor = rate_limit.RequestGovernor(
+                'org', work_dir, rate=20, burst=2)
+            for _ in xrange(3):
+                with governor.request():
+                    pass
+            self.assertEqual(governor.requests, 3)
+            self.assertEqual(governor.waits, 1)
+            self.assertTrue(governor.waited >= 0.04)
+            # state is shared by governors of the same organization
+            other = rate_limit.RequestGovernor(
+                'org', work_dir, rate=20, burst=2, max_in_flight=1)
+            with other._state() as state:
+                self.assertTrue(state['tokens'] < 1)
+                self.assertEqual(state['in_flight'], {})
+            # request waits for slot in flight
+            slot = other.acquire()
+            released = []
+
+            def release():
+                time.sleep(0.1)
+                released.append(time.time())
+                other.release(slot)
+
+            thread = threading.Thread(target=release)
+            thread.start()
+            other.release(other.acquire())
+            self.assertTrue(released and time.time() >= released[0])
+            thread.join()
+            # operation is retried after timeout
+            other.timeout = 0
+            other.throttle(5)
+            with self.assertRaises(cfy_exc.RecoverableError) as error:
+                other.acquire()
+            self.assertTrue(1 <= error.exception.retry_after <= 5)
+        finally:
+            shutil.rmtree(work_dir)
+
+    def test_governed_session(self):
+        transport = vcloud_plugin_common.transport.Transport()
+        session = transport.session
+        throttled = mock.Mock(status_code=429, headers={'Retry-After': '0'})
+        ok = mock.Mock(status_code=200)
+        governor = mock.MagicMock(key='org_a')
+        transport.set_governor(governor)
+        transport.register_session(['token_a'], 'scope_a', 'org_a')
+        transport.register_session(['token_b'], 'scope_b')
+        for headers in (None, {'x-vcloud-authorization': 'token_b'}):
+            with mock.patch('requests.Session.request',
+                            mock.MagicMock(side_effect=[throttled, ok])):
+                # no governor
+                self.assertEqual(
+                    session.request('GET', 'https://host', headers=headers),
+                    throttled)
+        self.assertFalse(governor.request.called)
+        with mock.patch('requests.Session.request',
+                        mock.MagicMock(side_effect=[throttled, ok])):
+            # throttled request is repeated
+            self.assertEqual(session.request(
+                'GET', 'https://host',
+                headers={'x-vcloud-authorization': 'token_a'}), ok)
+        self.assertEqual(governor.request.call_count, 2)
+        governor.throttle.assert_called_once_with(0)
+        self.assertEqual(transport.stats()['governors'],
+                         {'org_a': governor.stats.return_value})
 
 if __name__ == '__main__':
     unittest.main()
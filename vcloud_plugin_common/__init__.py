@@ -13,23 +13,60 @@
 #  * limitations under the License.
 
 import atexit
+import collections
 from functools import wraps
 import yaml
 import os
-import requests
+import threading
 import time
 
 from pyvcloud import vcloudair
+from pyvcloud.vcloudsession import VCS
 from pyvcloud.schema.vcd.v1_5.schemas.vcloud import taskType
 
 from cloudify import ctx
 from cloudify import context
+from cloudify.context import ImmutableProperties
 from cloudify import exceptions as cfy_exc
 
-TASK_RECHECK_TIMEOUT = 2
+from vcloud_plugin_common.session_cache import (SessionCache,
+                                                DEFAULT_SESSION_TTL)
+from vcloud_plugin_common.inventory import InventoryCache
+from vcloud_plugin_common.inventory_store import InventoryStore
+from vcloud_plugin_common.query import query_records
+from vcloud_plugin_common.rate_limit import (RequestGovernor, governor_key,
+                                             DEFAULT_WAIT_TIMEOUT)
+from vcloud_plugin_common.transport import (get_transport,
+                                            DEFAULT_POOL_CONNECTIONS,
+                                            DEFAULT_POOL_MAXSIZE)
+
+TASK_POLL_MIN_INTERVAL = 0.5
+TASK_POLL_MAX_INTERVAL = 15
+TASK_POLL_BACKOFF = 1.5
+TASK_DEADLINE = 60 * 60
 RELOGIN_TIMEOUT = 3
 TASK_STATUS_SUCCESS = 'success'
 TASK_STATUS_ERROR = 'error'
+TASK_STATUS_CANCELED = 'canceled'
+TASK_STATUS_ABORTED = 'aborted'
+TASK_FAILED_STATUSES = (TASK_STATUS_ERROR, TASK_STATUS_CANCELED,
+                        TASK_STATUS_ABORTED)
+# keeps length of query url reasonable
+TASK_QUERY_SIZE = 25
+TASK_URN_PREFIX = 'urn:vcloud:task:'
+# runtime property with tasks submitted in asynchronous mode
+ASYNC_TASKS = 'vcloud_async_tasks'
+ASYNC_TASK_RETRY_AFTER = 10
+
+CONFIG_CACHE_SIZE = 64
+
+# libyaml based loader is much faster, but can be absent
+YamlLoader = getattr(yaml, 'CLoader', yaml.Loader)
+
+_empty_config = ImmutableProperties()
+_config_cache = {}
+_merged_config_cache = {}
+_config_cache_lock = threading.Lock()
 
 STATUS_COULD_NOT_BE_CREATED = -1
 STATUS_UNRESOLVED = 0
@@ -96,21 +133,41 @@ def transform_resource_name(res, ctx):
 
 
 class Config(object):
+    """
+        static configuration from yaml file, parsed content is cached
+        until file modification time or size is changed
+    """
 
     VCLOUD_CONFIG_PATH_ENV_VAR = 'VCLOUD_CONFIG_PATH'
     VCLOUD_CONFIG_PATH_DEFAULT = '~/vcloud_config.yaml'
 
     def get(self):
-        cfg = {}
         env_name = self.VCLOUD_CONFIG_PATH_ENV_VAR
         default_location_tpl = self.VCLOUD_CONFIG_PATH_DEFAULT
         default_location = os.path.expanduser(default_location_tpl)
         config_path = os.getenv(env_name, default_location)
+        try:
+            stat = os.stat(config_path)
+        except OSError:
+            return _empty_config
+        key = (config_path, stat.st_mtime, stat.st_size)
+        with _config_cache_lock:
+            cfg = _config_cache.get(key)
+        if cfg is not None:
+            return cfg
+        cfg = {}
         try:
             with open(config_path) as f:
-                cfg = yaml.load(f.read())
+                cfg = yaml.load(f.read(), Loader=YamlLoader) or {}
         except IOError:
             pass
+        cfg = ImmutableProperties(cfg)
+        with _config_cache_lock:
+            # keep only the latest version of each file
+            for cached in _config_cache.keys():
+                if cached[0] == config_path:
+                    del _config_cache[cached]
+            _config_cache[key] = cfg
         return cfg
 
 
@@ -147,6 +204,37 @@ class VcloudAirClient(object):
             raise cfy_exc.NonRecoverableError(
                 "vCloud service and vDC must be specified")
 
+        # all requests of the client go through the pool of the process
+        transport = get_transport(
+            cfg.get('http_pool_connections', DEFAULT_POOL_CONNECTIONS),
+            cfg.get('http_pool_size', DEFAULT_POOL_MAXSIZE))
+        if cfg.get('inventory_store') and transport.inventory_store is None:
+            transport.inventory_store = InventoryStore(
+                cfg.get('inventory_store_path'),
+                cfg.get('inventory_store_ttl'))
+        # limits of requests are shared by all processes of organization,
+        # requests of other organizations are not limited by them
+        limits_key = None
+        if cfg.get('rate_limit') or cfg.get('max_in_flight'):
+            limits_key = governor_key(cfg)
+            transport.set_governor(RequestGovernor(
+                limits_key, cfg.get('rate_limit_path'),
+                cfg.get('rate_limit'), cfg.get('rate_limit_burst'),
+                cfg.get('max_in_flight'),
+                cfg.get('rate_limit_timeout', DEFAULT_WAIT_TIMEOUT)))
+
+        session_cache = None
+        if cfg.get('session_cache', True):
+            session_cache = SessionCache(
+                cfg.get('session_cache_path'),
+                cfg.get('session_cache_ttl', DEFAULT_SESSION_TTL))
+            vcloud_air = self._restore_session(
+                session_cache, cfg, url, username, service_type, log)
+            if vcloud_air:
+                transport.register_session(_session_tokens(vcloud_air),
+                                           SessionCache.key(cfg), limits_key)
+                return vcloud_air
+
         if service_type == SUBSCRIPTION_SERVICE_TYPE:
             vcloud_air = self._subscription_login(
                 url, username, password, token, service, org_name, log)
@@ -161,8 +249,69 @@ class VcloudAirClient(object):
         else:
             raise cfy_exc.NonRecoverableError(
                 "Unrecognized service type: {0}".format(service_type))
+
+        if session_cache:
+            self._save_session(session_cache, cfg, vcloud_air)
+        else:
+            atexit.register(vcloud_air.logout)
+        # stored inventory is shared only by requests of the same
+        # organization and user
+        transport.register_session(_session_tokens(vcloud_air),
+                                   SessionCache.key(cfg), limits_key)
         return vcloud_air
 
+    def _restore_session(self, session_cache, cfg, url, username,
+                         service_type, log):
+        """
+            return client with session from cache, or None if there is no
+            cached session for credentials of cfg or vCloud does not
+            accept its token any more
+        """
+        session_key = SessionCache.key(cfg)
+        session = session_cache.load(session_key, cfg)
+        if not session:
+            return None
+        if service_type == 'private':
+            service_type = PRIVATE_SERVICE_TYPE
+        vca = vcloudair.VCA(url, username, service_type=service_type,
+                            version=session['version'], log=log)
+        vcloud_session = VCS(
+            session['session_url'], username, session['org'],
+            session['instance'], session['api_url'], session['org_url'],
+            version=session['version'], log=log)
+        # single request for organization, validates token as well
+        if not vcloud_session.login(token=session['vcloud_token']):
+            ctx.logger.info("Cached vCloud session expired.")
+            session_cache.drop(session_key)
+            return None
+        vca.token = session['token']
+        vca.org = session['org']
+        vca.vcloud_session = vcloud_session
+        # prolong session lifetime, vCloud counts it from last request
+        self._store_session(session_cache, cfg, session)
+        ctx.logger.info("Cached vCloud session reused.")
+        return vca
+
+    def _save_session(self, session_cache, cfg, vca):
+        vcloud_session = vca.vcloud_session
+        session = {
+            'version': vca.version,
+            'token': vca.token,
+            'vcloud_token': vcloud_session.token,
+            'session_url': vcloud_session.url,
+            'org': vcloud_session.org,
+            'instance': vcloud_session.instance,
+            'api_url': vcloud_session.api_url,
+            'org_url': vcloud_session.org_url
+        }
+        self._store_session(session_cache, cfg, session)
+
+    def _store_session(self, session_cache, cfg, session):
+        try:
+            session_cache.store(SessionCache.key(cfg), session, cfg)
+        except (IOError, OSError) as e:
+            ctx.logger.warn("Can't save vCloud session: {0}".format(e))
+
     def _subscription_login(self, url, username, password, token, service,
                             org_name, log):
         logined = False
@@ -209,10 +358,9 @@ class VcloudAirClient(object):
             raise cfy_exc.RecoverableError(message="Could not login to VDC",
                                            retry_after=RELOGIN_TIMEOUT)
 
-        atexit.register(vca.logout)
         return vca
 
-    def _ondemand_login(self, url, username, password, token, instance_idm, log):
+    def _ondemand_login(self, url, username, password, token, instance_id, log):
         def get_instance(vca, instance_id):
             instances = vca.get_instances() or []
             for instance in instances:
@@ -288,11 +436,10 @@ class VcloudAirClient(object):
                 message="Could not login to instance",
                 retry_after=RELOGIN_TIMEOUT)
 
-        atexit.register(vca.logout)
         return vca
 
     def _private_login(self, url, username, password, token, org_name,
-                       org_url=None, api_version='5.6', log=false):
+                       org_url=None, api_version='5.6', log=False):
         logined = False
 
         vca = vcloudair.VCA(
@@ -334,10 +481,21 @@ class VcloudAirClient(object):
         if logined is False:
             raise cfy_exc.NonRecoverableError("Invalid login credentials")
 
-        atexit.register(vca.logout)
         return vca
 
 
+def _session_tokens(vca):
+    """
+        values of authorization headers of requests made with client
+    """
+    tokens = []
+    if vca.token:
+        tokens.extend([vca.token, "Bearer {0}".format(vca.token)])
+    if vca.vcloud_session and vca.vcloud_session.token:
+        tokens.append(vca.vcloud_session.token)
+    return tokens
+
+
 def with_vca_client(f):
     @wraps(f)
     def wrapper(*args, **kw):
@@ -348,29 +506,233 @@ def with_vca_client(f):
             config = ctx.source.node.properties.get('vcloud_config')
         else:
             raise cfy_exc.NonRecoverableError("Unsupported context")
-        client = VcloudAirClient().get(config=config)
+        client = InventoryCache(VcloudAirClient().get(config=config))
         kw['vca_client'] = client
-        return f(*args, **kw)
+        try:
+            return f(*args, **kw)
+        finally:
+            ctx.logger.debug("vCloud HTTP connections: {0}"
+                             .format(get_transport().stats()))
+            ctx.logger.debug("vCloud inventory cache: {0}"
+                             .format(client.stats()))
     return wrapper
 
 
-def wait_for_task(vca_client, task):
-    status = task.get_status()
-    while status != TASK_STATUS_SUCCESS:
-        if status == TASK_STATUS_ERROR:
-            error = task.get_Error()
+def invalidate_inventory(vca_client):
+    """
+        drop cached lookups of client, objects could be changed by task
+    """
+    if isinstance(vca_client, InventoryCache):
+        vca_client.invalidate()
+
+
+TaskStats = collections.namedtuple('TaskStats', 'status polls wall_time')
+
+
+class PollingStrategy(object):
+    """
+        intervals between checks of vCloud task status: start with short
+        interval and grow it toward the cap, task progress (percents)
+        is used as hint for the time left
+    """
+
+    def __init__(self, deadline=TASK_DEADLINE,
+                 min_interval=TASK_POLL_MIN_INTERVAL,
+                 max_interval=TASK_POLL_MAX_INTERVAL,
+                 backoff=TASK_POLL_BACKOFF):
+        self.deadline = deadline
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.backoff = backoff
+        self.interval = min_interval
+        self.started = time.time()
+
+    def elapsed(self):
+        return time.time() - self.started
+
+    def is_expired(self):
+        return self.deadline is not None and self.elapsed() > self.deadline
+
+    def next_interval(self, progress=None):
+        interval = self.interval
+        self.interval = min(self.interval * self.backoff, self.max_interval)
+        if progress and 0 < progress < 100:
+            # linear estimation of time left
+            left = self.elapsed() * (100 - progress) / progress
+            interval = max(self.min_interval, min(left, self.max_interval))
+        if self.deadline is not None:
+            interval = min(interval,
+                           max(self.deadline - self.elapsed(), 0))
+        return interval
+
+
+def wait_for_task(vca_client, task, strategy=None):
+    """
+        wait until task is finished, return TaskStats with count of
+        status requests and wall time spent
+    """
+    if strategy is None:
+        strategy = PollingStrategy()
+    # objects looked up before the task was submitted can be outdated
+    invalidate_inventory(vca_client)
+    polls = 0
+    while not _task_finished(task.get_href(), task):
+        if strategy.is_expired():
             raise cfy_exc.NonRecoverableError(
-                "Error during task execution: {0}".format(error.get_message()))
-        else:
-            time.sleep(TASK_RECHECK_TIMEOUT)
-            response = requests.get(
-                task.get_href(),
-                headers=vca_client.vcloud_session.get_vcloud_headers())
-            task = taskType.parseString(response.content, True)
-            status = task.get_status()
+                "Task {0} was not finished in {1} seconds"
+                .format(task.get_href(), strategy.deadline))
+        time.sleep(strategy.next_interval(_get_task_progress(task)))
+        response = get_transport().get(
+            task.get_href(),
+            headers=vca_client.vcloud_session.get_vcloud_headers())
+        polls += 1
+        task = taskType.parseString(response.content, True)
+    return TaskStats(TASK_STATUS_SUCCESS, polls, strategy.elapsed())
+
+
+def wait_for_tasks(vca_client, tasks, strategy=None, failed=None):
+    """
+        wait until all tasks are finished, statuses of running tasks are
+        requested from query service with one request per check, error
+        is raised on first failed task; if 'failed' dict is given, error
+        messages of failed tasks are saved there by href instead and
+        other tasks are still waited for
+    """
+    if strategy is None:
+        strategy = PollingStrategy()
+    invalidate_inventory(vca_client)
+    running = []
+    for task in tasks:
+        if not _task_finished(task.get_href(), task, failed):
+            running.append(task.get_href())
+    polls = 0
+    while running:
+        if strategy.is_expired():
+            raise cfy_exc.NonRecoverableError(
+                "Tasks {0} were not finished in {1} seconds"
+                .format(running, strategy.deadline))
+        time.sleep(strategy.next_interval())
+        statuses = {}
+        for index in xrange(0, len(running), TASK_QUERY_SIZE):
+            statuses.update(_query_task_statuses(
+                vca_client, running[index:index + TASK_QUERY_SIZE]))
+        polls += 1
+        for href in list(running):
+            status = statuses.get(href)
+            if status == TASK_STATUS_SUCCESS:
+                running.remove(href)
+            elif status is None or status in TASK_FAILED_STATUSES:
+                # task is not visible for query service yet, or its
+                # error is needed
+                if _task_finished(href, _get_task(vca_client, href),
+                                  failed):
+                    running.remove(href)
+    return TaskStats(TASK_STATUS_ERROR if failed else TASK_STATUS_SUCCESS,
+                     polls, strategy.elapsed())
+
+
+def is_async_mode():
+    return bool(get_vcloud_config().get('async_tasks'))
+
+
+def run_task(vca_client, name, submit, strategy=None):
+    """
+        submit task with 'submit' function and wait for it. In asynchronous
+        mode href of the task is saved in runtime properties and True is
+        returned, operation should be retried then; on the retry the task
+        status is checked once instead of waiting. 'submit' may return None
+        if there is nothing to do.
+    """
+    tasks = ctx.instance.runtime_properties.get(ASYNC_TASKS) or {}
+    if name in tasks:
+        task = _get_task(vca_client, tasks[name])
+        status = task.get_status()
+        invalidate_inventory(vca_client)
+        if status == TASK_STATUS_SUCCESS or status in TASK_FAILED_STATUSES:
+            tasks = dict(tasks)
+            del tasks[name]
+            ctx.instance.runtime_properties[ASYNC_TASKS] = tasks
+        if status in TASK_FAILED_STATUSES:
+            _raise_task_error(task)
+        return status != TASK_STATUS_SUCCESS
+
+    task = submit()
+    if task is None:
+        return False
+    if is_async_mode() and task.get_status() not in (
+            (TASK_STATUS_SUCCESS,) + TASK_FAILED_STATUSES):
+        tasks = dict(tasks)
+        tasks[name] = task.get_href()
+        ctx.instance.runtime_properties[ASYNC_TASKS] = tasks
+        ctx.logger.info("Task {0} submitted: {1}"
+                        .format(name, task.get_href()))
+        return True
+    wait_for_task(vca_client, task, strategy)
+    return False
+
+
+def retry_for_task(name):
+    return ctx.operation.retry(
+        message="Waiting for task {0} to complete".format(name),
+        retry_after=ASYNC_TASK_RETRY_AFTER)
+
+
+def _query_task_statuses(vca_client, hrefs):
+    ids = [TASK_URN_PREFIX + href.rstrip('/').rsplit('/', 1)[-1]
+           for href in hrefs]
+    query_filter = "({0})".format(
+        ",".join(["id=={0}".format(task_id) for task_id in ids]))
+    records = query_records(vca_client, hrefs[0], 'task', query_filter)
+    return {record.get('href'): record.get('status') for record in records}
+
+
+def _get_task(vca_client, href):
+    response = get_transport().get(
+        href, headers=vca_client.vcloud_session.get_vcloud_headers())
+    return taskType.parseString(response.content, True)
+
+
+def _raise_task_error(task):
+    raise cfy_exc.NonRecoverableError(_task_error_message(task))
+
+
+def _task_error_message(task):
+    error = task.get_Error()
+    message = error.get_message() if error else task.get_status()
+    return "Error during task execution: {0}".format(message)
+
+
+def _task_finished(href, task, failed=None):
+    """
+        check status of task for wait_for_task and wait_for_tasks: True
+        if task is finished; failed task raises error, or its message
+        is saved in 'failed' dict by href
+    """
+    status = task.get_status()
+    if status in TASK_FAILED_STATUSES:
+        _task_failed(href, task, failed)
+        return True
+    return status == TASK_STATUS_SUCCESS
+
+
+def _task_failed(href, task, failed):
+    if failed is None:
+        _raise_task_error(task)
+    failed[href] = _task_error_message(task)
+
+
+def _get_task_progress(task):
+    try:
+        return int(task.get_Progress())
+    except (TypeError, ValueError):
+        return None
 
 
 def get_vcloud_config():
+    """
+        static configuration merged with 'vcloud_config' of node,
+        result is cached and read only
+    """
     config = None
     if ctx.type == context.NODE_INSTANCE:
         config = ctx.node.properties.get('vcloud_config')
@@ -379,9 +741,32 @@ def get_vcloud_config():
     else:
         raise cfy_exc.NonRecoverableError("Unsupported context")
     static_config = Config().get()
-    if config:
-        static_config.update(config)
-    return static_config
+    if not config:
+        return static_config
+    key = _freeze(config)
+    with _config_cache_lock:
+        cached = _merged_config_cache.get(key)
+        # merged config is valid while static config is the same object
+        if cached and cached[0] is static_config:
+            return cached[1]
+        merged = dict(static_config)
+        merged.update(config)
+        merged = ImmutableProperties(merged)
+        if len(_merged_config_cache) >= CONFIG_CACHE_SIZE:
+            _merged_config_cache.clear()
+        _merged_config_cache[key] = (static_config, merged)
+    return merged
+
+
+def _freeze(value):
+    """
+        hashable copy of value from node properties
+    """
+    if isinstance(value, dict):
+        return tuple(sorted((k, _freeze(v)) for k, v in value.items()))
+    if isinstance(value, (list, tuple)):
+        return tuple(_freeze(v) for v in value)
+    return value
 
 
 def get_mandatory(obj, parameter):
@@ -0,0 +1,117 @@
+# Copyright (c) 2014 GigaSpaces Technologies Ltd. All rights reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+#  * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  * See the License for the specific language governing permissions and
+#  * limitations under the License.
+
+import threading
+import urlparse
+
+from cloudify import exceptions as cfy_exc
+
+from vcloud_plugin_common import (VcloudAirClient, wait_for_task,
+                                  wait_for_tasks)
+from vcloud_plugin_common.parallel import WorkerPool, gather
+from vcloud_plugin_common.transport import (get_transport,
+                                            DEFAULT_POOL_MAXSIZE)
+
+# one thread for each pooled connection of transport
+DEFAULT_MAX_WORKERS = DEFAULT_POOL_MAXSIZE
+
+
+class AsyncVcloudClient(object):
+    """
+        facade of vCloud client for workflows that drive many resources:
+        login, REST requests and waiting for tasks are run in bounded
+        pool of threads and return Future, requests in flight to one
+        endpoint (scheme and host) are limited by max_per_endpoint. By
+        default it is pool_maxsize of transport (http_pool_size of
+        config), the number of kept connections to one host, so
+        requests don't open connections that the pool drops afterwards.
+    """
+
+    def __init__(self, vca_client=None, max_workers=DEFAULT_MAX_WORKERS,
+                 max_per_endpoint=None):
+        self.vca_client = vca_client
+        self.max_per_endpoint = max_per_endpoint
+        self._pool = WorkerPool(max_workers)
+        self._endpoints = {}
+        self._lock = threading.Lock()
+
+    def login(self, config=None):
+        """
+            connect with VcloudAirClient, future result is the client
+        """
+        def call():
+            self.vca_client = VcloudAirClient().get(config=config)
+            return self.vca_client
+        return self._pool.submit(call)
+
+    def get(self, url, **kwargs):
+        return self.request('get', url, **kwargs)
+
+    def post(self, url, data=None, **kwargs):
+        return self.request('post', url, data=data, **kwargs)
+
+    def put(self, url, data=None, **kwargs):
+        return self.request('put', url, data=data, **kwargs)
+
+    def delete(self, url, **kwargs):
+        return self.request('delete', url, **kwargs)
+
+    def request(self, method, url, **kwargs):
+        """
+            request with headers of vCloud session through transport of
+            the process, future result is the response
+        """
+        return self._pool.submit(
+            lambda: self._request(method, url, **kwargs))
+
+    def wait_for_task(self, task, strategy=None):
+        return self._pool.submit(
+            lambda: wait_for_task(self._client(), task, strategy))
+
+    def wait_for_tasks(self, tasks, strategy=None, failed=None):
+        return self._pool.submit(
+            lambda: wait_for_tasks(self._client(), tasks, strategy, failed))
+
+    def gather(self, futures):
+        return gather(futures)
+
+    def shutdown(self, wait=True):
+        self._pool.shutdown(wait)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.shutdown()
+
+    def _client(self):
+        if self.vca_client is None:
+            raise cfy_exc.NonRecoverableError("vCloud client is not logged in")
+        return self.vca_client
+
+    def _request(self, method, url, **kwargs):
+        headers = dict(self._client().vcloud_session.get_vcloud_headers())
+        headers.update(kwargs.pop('headers', None) or {})
+        with self._endpoint(url):
+            return getattr(get_transport(), method)(url, headers=headers,
+                                                    **kwargs)
+
+    def _endpoint(self, url):
+        parsed = urlparse.urlparse(url)
+        key = (parsed.scheme, parsed.netloc)
+        with self._lock:
+            if key not in self._endpoints:
+                self._endpoints[key] = threading.BoundedSemaphore(
+                    self.max_per_endpoint or get_transport().pool_maxsize)
+            return self._endpoints[key]
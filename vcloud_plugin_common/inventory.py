@@ -0,0 +1,111 @@
+# Copyright (c) 2014 GigaSpaces Technologies Ltd. All rights reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+#  * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  * See the License for the specific language governing permissions and
+#  * limitations under the License.
+
+import collections
+import copy
+import threading
+
+
+class InventoryCache(object):
+    """
+        wrapper of vCloud client for the time of one operation, results
+        of vdc, vApp, network and gateway lookups are remembered until
+        invalidate() is called, all other attributes are taken from
+        wrapped client
+    """
+
+    def __init__(self, vca_client):
+        self._vca_client = vca_client
+        self._entries = {}
+        # counters are shared with copies, see __copy__
+        self._counts = collections.Counter()
+        self._counts_lock = threading.Lock()
+
+    def __getattr__(self, name):
+        return getattr(self._vca_client, name)
+
+    def __copy__(self):
+        """
+            wrapper of copy of client with the same remembered results
+            and counters, for calls in other thread
+        """
+        clone = InventoryCache(copy.copy(self._vca_client))
+        clone._entries = self._entries
+        clone._counts = self._counts
+        clone._counts_lock = self._counts_lock
+        return clone
+
+    @property
+    def hits(self):
+        return self._counts['hits']
+
+    @property
+    def misses(self):
+        return self._counts['misses']
+
+    def get_vdc(self, vdc_name):
+        return self._lookup(('vdc', vdc_name),
+                            self._vca_client.get_vdc, vdc_name)
+
+    def get_vapp(self, vdc, vapp_name):
+        return self._lookup(('vapp', _entity_key(vdc), vapp_name),
+                            self._vca_client.get_vapp, vdc, vapp_name)
+
+    def get_network(self, vdc_name, network_name):
+        return self._lookup(('network', vdc_name, network_name),
+                            self._vca_client.get_network,
+                            vdc_name, network_name)
+
+    def get_gateway(self, vdc_name, gateway_name):
+        return self._lookup(('gateway', vdc_name, gateway_name),
+                            self._vca_client.get_gateway,
+                            vdc_name, gateway_name)
+
+    def get_gateways(self, vdc_name):
+        return self._lookup(('gateways', vdc_name),
+                            self._vca_client.get_gateways, vdc_name)
+
+    def invalidate(self):
+        """
+            forget all results, must be called when vCloud objects
+            could be changed
+        """
+        self._entries.clear()
+
+    def stats(self):
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'entries': len(self._entries)
+        }
+
+    def _lookup(self, key, method, *args):
+        if key in self._entries:
+            self._count('hits')
+            return self._entries[key]
+        self._count('misses')
+        value = method(*args)
+        # object not found now can be created later in the same operation
+        if value:
+            self._entries[key] = value
+        return value
+
+    def _count(self, name):
+        with self._counts_lock:
+            self._counts[name] += 1
+
+
+def _entity_key(entity):
+    href = getattr(entity, 'href', None)
+    return href if href is not None else id(entity)
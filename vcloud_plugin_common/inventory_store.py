@@ -0,0 +1,206 @@
+# Copyright (c) 2014 GigaSpaces Technologies Ltd. All rights reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+#  * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  * See the License for the specific language governing permissions and
+#  * limitations under the License.
+
+import os
+import sqlite3
+import threading
+import time
+
+import requests
+
+from vcloud_plugin_common.query import API_PATH
+
+# seconds to keep entity of type, type is the first part of href path
+# after '/api/'; vdc, vApp and gateway content changes with every
+# deployment so they are never stored
+DEFAULT_TTLS = {
+    'catalog': 10 * 60,
+    'catalogItem': 10 * 60,
+    'vAppTemplate': 60 * 60,
+    'network': 5 * 60,
+    'admin/network': 5 * 60,
+}
+STORE_TIMEOUT = 5
+# the same network is available by org vdc and admin hrefs
+NETWORK_PATHS = ('/api/network/', '/api/admin/network/')
+
+# entities are visible only for scope (organization and user) they
+# were requested by
+SCHEMA = """CREATE TABLE IF NOT EXISTS scoped_entities (
+    scope TEXT,
+    url TEXT,
+    accept TEXT,
+    etag TEXT,
+    content_type TEXT,
+    content BLOB,
+    expires REAL,
+    PRIMARY KEY (scope, url, accept)
+)"""
+
+
+class InventoryStore(object):
+    """
+        on disk store of rarely changed vCloud entities (catalogs,
+        templates, networks) shared by operations of all processes on
+        the manager that use the same organization and user. Entities
+        older than ttl of their type are revalidated with conditional
+        request if vCloud returned ETag for them, and requested again
+        otherwise.
+    """
+
+    STORE_PATH_ENV_VAR = 'VCLOUD_INVENTORY_STORE_PATH'
+    STORE_PATH_DEFAULT = '~/.vcloud_inventory.sqlite'
+
+    def __init__(self, path=None, ttls=None):
+        if not path:
+            default_location = os.path.expanduser(self.STORE_PATH_DEFAULT)
+            path = os.getenv(self.STORE_PATH_ENV_VAR, default_location)
+        self.path = os.path.expanduser(path)
+        self.ttls = dict(DEFAULT_TTLS)
+        if ttls:
+            self.ttls.update(ttls)
+        self.hits = 0
+        self.misses = 0
+        self.revalidated = 0
+        self._local = threading.local()
+
+    def get_ttl(self, url):
+        """
+            ttl for entity with href, None if entity must not be stored
+        """
+        position = url.find(API_PATH)
+        if position < 0:
+            return None
+        path = url[position + len(API_PATH):].split('?')[0].split('/')
+        # href is '<type>/<id>', links with more parts are actions
+        # and sub resources
+        if len(path) == 3 and path[0] == 'admin':
+            return self.ttls.get('admin/' + path[1])
+        if len(path) == 2:
+            return self.ttls.get(path[0])
+        return None
+
+    def fetch(self, session, url, scope, **kwargs):
+        """
+            response for GET request of url, from store of scope if
+            possible
+        """
+        ttl = self.get_ttl(url)
+        if not ttl:
+            return session.get(url, **kwargs)
+        headers = dict(kwargs.pop('headers', None) or {})
+        accept = headers.get('Accept', '')
+        entry = self._load(scope, url, accept)
+        if entry and entry['expires'] > time.time():
+            self.hits += 1
+            return _make_response(url, entry)
+        self.misses += 1
+        if entry and entry['etag']:
+            headers['If-None-Match'] = entry['etag']
+        response = session.get(url, headers=headers, **kwargs)
+        if entry and response.status_code == requests.codes.not_modified:
+            self.revalidated += 1
+            entry['expires'] = time.time() + ttl
+            self._save(scope, url, accept, entry)
+            return _make_response(url, entry)
+        if response.status_code == requests.codes.ok:
+            self._save(scope, url, accept, {
+                'etag': response.headers.get('ETag'),
+                'content_type': response.headers.get('Content-Type'),
+                'content': response.content,
+                'expires': time.time() + ttl
+            })
+        return response
+
+    def invalidate(self, url):
+        """
+            drop entities changed by request to url: entity itself,
+            its parents and sub resources, in all scopes; network is
+            dropped for both its hrefs
+        """
+        url = url.split('?')[0]
+        urls = [url]
+        for path in NETWORK_PATHS:
+            if path in url:
+                urls = [url.replace(path, other) for other in NETWORK_PATHS]
+        # prefixes are compared with substr, '_' and '%' of LIKE would
+        # match any character of href
+        for url in urls:
+            self._execute(
+                "DELETE FROM scoped_entities "
+                "WHERE substr(?, 1, length(url)) = url "
+                "OR substr(url, 1, length(?)) = ?", (url, url, url))
+
+    def stats(self):
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'revalidated': self.revalidated
+        }
+
+    def _connection(self):
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            directory = os.path.dirname(self.path)
+            if directory and not os.path.isdir(directory):
+                os.makedirs(directory, 0o700)
+            connection = sqlite3.connect(self.path, timeout=STORE_TIMEOUT)
+            connection.execute(SCHEMA)
+            self._local.connection = connection
+        return connection
+
+    def _execute(self, statement, parameters):
+        # store is optimization only, operations must not fail because
+        # of it
+        try:
+            connection = self._connection()
+            with connection:
+                return connection.execute(statement, parameters).fetchall()
+        except (sqlite3.Error, OSError):
+            return []
+
+    def _load(self, scope, url, accept):
+        rows = self._execute(
+            "SELECT etag, content_type, content, expires "
+            "FROM scoped_entities WHERE scope = ? AND url = ? AND accept = ?",
+            (scope, url, accept))
+        if not rows:
+            return None
+        etag, content_type, content, expires = rows[0]
+        return {
+            'etag': etag,
+            'content_type': content_type,
+            'content': str(content),
+            'expires': expires
+        }
+
+    def _save(self, scope, url, accept, entry):
+        self._execute(
+            "INSERT OR REPLACE INTO scoped_entities "
+            "(scope, url, accept, etag, content_type, content, expires) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?)",
+            (scope, url, accept, entry['etag'], entry['content_type'],
+             sqlite3.Binary(entry['content']), entry['expires']))
+
+
+def _make_response(url, entry):
+    response = requests.Response()
+    response.status_code = requests.codes.ok
+    response.url = url
+    response._content = entry['content']
+    if entry['content_type']:
+        response.headers['Content-Type'] = entry['content_type']
+    if entry['etag']:
+        response.headers['ETag'] = entry['etag']
+    return response
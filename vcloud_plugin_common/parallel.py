@@ -0,0 +1,187 @@
+# Copyright (c) 2014 GigaSpaces Technologies Ltd. All rights reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+#  * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  * See the License for the specific language governing permissions and
+#  * limitations under the License.
+
+import copy
+import Queue
+import sys
+import threading
+
+from cloudify import exceptions as cfy_exc
+from cloudify.state import current_ctx
+
+from vcloud_plugin_common.transport import DEFAULT_POOL_MAXSIZE
+
+# calls go to one vCloud host, so one thread for each connection that
+# transport keeps for a host
+DEFAULT_MAX_WORKERS = DEFAULT_POOL_MAXSIZE
+
+
+class Future(object):
+    """
+        result of call submitted to WorkerPool
+    """
+
+    def __init__(self):
+        self._done = threading.Event()
+        self._result = None
+        self._error = None
+
+    def done(self):
+        return self._done.is_set()
+
+    def set_result(self, result):
+        self._result = result
+        self._done.set()
+
+    def set_error(self, error):
+        # error is sys.exc_info() of failed call
+        self._error = error
+        self._done.set()
+
+    def error(self, timeout=None):
+        self._wait(timeout)
+        return self._error
+
+    def result(self, timeout=None):
+        self._wait(timeout)
+        if self._error:
+            raise self._error[0], self._error[1], self._error[2]
+        return self._result
+
+    def _wait(self, timeout):
+        if not self._done.wait(timeout):
+            raise cfy_exc.NonRecoverableError(
+                "Call was not finished in {0} seconds".format(timeout))
+
+
+class WorkerPool(object):
+    """
+        bounded pool of threads for calls (functions without arguments),
+        threads are started on demand and get cloudify context of the
+        thread that created the pool
+    """
+
+    def __init__(self, max_workers=DEFAULT_MAX_WORKERS):
+        self.max_workers = max(max_workers, 1)
+        self._pending = Queue.Queue()
+        self._threads = []
+        self._lock = threading.Lock()
+        # cloudify context is thread local
+        self._context = _get_context()
+
+    def submit(self, call):
+        future = Future()
+        self._pending.put((future, call))
+        with self._lock:
+            if len(self._threads) < self.max_workers:
+                thread = threading.Thread(target=self._work)
+                thread.daemon = True
+                thread.start()
+                self._threads.append(thread)
+        return future
+
+    def shutdown(self, wait=True):
+        """
+            stop threads after all submitted calls
+        """
+        with self._lock:
+            threads = list(self._threads)
+            self._threads = []
+        for _ in threads:
+            self._pending.put(None)
+        if wait:
+            for thread in threads:
+                thread.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.shutdown()
+
+    def _work(self):
+        if self._context:
+            current_ctx.set(*self._context)
+        try:
+            while True:
+                item = self._pending.get()
+                if item is None:
+                    return
+                future, call = item
+                try:
+                    future.set_result(call())
+                except Exception:
+                    future.set_error(sys.exc_info())
+        finally:
+            if self._context:
+                current_ctx.clear()
+
+
+def gather(futures):
+    """
+        wait for all futures and return list of their results, error of
+        single call is raised as is, errors of several calls are merged
+        into one NonRecoverableError
+    """
+    errors = [future.error() for future in futures]
+    _raise_errors([error for error in errors if error])
+    return [future.result() for future in futures]
+
+
+def run_parallel(calls, max_workers=DEFAULT_MAX_WORKERS):
+    """
+        run independent calls (functions without arguments) in bounded
+        pool of threads and return list of their results in order of
+        calls, errors are raised as by gather
+    """
+    calls = list(calls)
+    if len(calls) < 2 or max_workers < 2:
+        return [call() for call in calls]
+    with WorkerPool(min(max_workers, len(calls))) as pool:
+        futures = [pool.submit(call) for call in calls]
+    return gather(futures)
+
+
+def run_parallel_clients(vca_client, calls,
+                         max_workers=DEFAULT_MAX_WORKERS):
+    """
+        run_parallel for calls with vCloud client as argument. pyvcloud
+        VCA saves each response in the client and parses it from there,
+        so each call gets its own copy of the client with the same
+        session.
+    """
+    return run_parallel([_with_client(call, vca_client) for call in calls],
+                        max_workers)
+
+
+def _with_client(call, vca_client):
+    return lambda: call(copy.copy(vca_client))
+
+
+def _get_context():
+    try:
+        return current_ctx.get_ctx(), current_ctx.get_parameters()
+    except RuntimeError:
+        return None
+
+
+def _raise_errors(errors):
+    if not errors:
+        return
+    if len(errors) == 1 or not all(
+            issubclass(error[0], cfy_exc.NonRecoverableError)
+            for error in errors):
+        raise errors[0][0], errors[0][1], errors[0][2]
+    raise cfy_exc.NonRecoverableError(
+        "; ".join(str(error[1]) for error in errors))
@@ -0,0 +1,118 @@
+# Copyright (c) 2014 GigaSpaces Technologies Ltd. All rights reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+#  * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  * See the License for the specific language governing permissions and
+#  * limitations under the License.
+
+import urllib
+from xml.etree import ElementTree
+
+import requests
+
+from cloudify import exceptions as cfy_exc
+
+from vcloud_plugin_common.transport import get_transport
+
+VCLOUD_NS = '{http://www.vmware.com/vcloud/v1.5}'
+API_PATH = '/api/'
+# default limit of vCloud Director for records in one page
+QUERY_PAGE_SIZE = 128
+
+
+def get_api_url(href):
+    """
+        return root of vCloud API for any entity href
+    """
+    position = href.find(API_PATH)
+    if position < 0:
+        raise cfy_exc.NonRecoverableError(
+            "Can't get vCloud API url from {0}".format(href))
+    return href[:position + len(API_PATH) - 1]
+
+
+def query_records(vca_client, href, query_type, query_filter=None,
+                  page_size=QUERY_PAGE_SIZE):
+    """
+        run typed query of vCloud query service and return list of
+        records, each record is dict of its attributes; all pages of
+        result are requested
+    """
+    params = {'type': query_type, 'format': 'records',
+              'pageSize': page_size}
+    if query_filter:
+        params['filter'] = query_filter
+    url = get_api_url(href) + '/query'
+    headers = vca_client.vcloud_session.get_vcloud_headers()
+    records = []
+    page = 1
+    while True:
+        params['page'] = page
+        response = get_transport().get(url, params=params, headers=headers)
+        if response.status_code != requests.codes.ok:
+            raise cfy_exc.NonRecoverableError(
+                "Query of {0} records failed: {1}"
+                .format(query_type, response.content))
+        page_records, total = parse_records(response.content)
+        records.extend(page_records)
+        if not page_records or total is None or len(records) >= total:
+            return records
+        page += 1
+
+
+def find_records(vca_client, query_type, **conditions):
+    """
+        return records of query_type with attributes equal to
+        conditions, e.g. find_records(client, 'catalogItem',
+        name='template', catalogName='catalog')
+    """
+    query_filter = ";".join(
+        ["{0}=={1}".format(name, quote_value(value))
+         for name, value in sorted(conditions.items())])
+    return query_records(vca_client, vca_client.vcloud_session.url,
+                         query_type, query_filter)
+
+
+def quote_value(value):
+    """
+        percent-encode value for filter of query, so FIQL reserved
+        characters (e.g. ';', ',', '(', ')', '=') in names don't change
+        the filter
+    """
+    if isinstance(value, unicode):
+        value = value.encode('utf-8')
+    return urllib.quote(str(value), safe='')
+
+
+def get_entity(vca_client, href, entity_type):
+    """
+        request single entity by href and parse it with generated
+        pyvcloud schema module (e.g. networkType)
+    """
+    response = get_transport().get(
+        href, headers=vca_client.vcloud_session.get_vcloud_headers())
+    if response.status_code != requests.codes.ok:
+        raise cfy_exc.NonRecoverableError(
+            "Could not get {0}: {1}".format(href, response.content))
+    return entity_type.parseString(response.content, True)
+
+
+def parse_records(content):
+    """
+        return records of page and total count of records in result
+    """
+    root = ElementTree.fromstring(content)
+    records = []
+    for element in root:
+        if element.tag.startswith(VCLOUD_NS) and \
+                element.tag.endswith('Record'):
+            records.append(dict(element.attrib))
+    total = root.get('total')
+    return records, int(total) if total is not None else None
@@ -0,0 +1,186 @@
+# Copyright (c) 2014 GigaSpaces Technologies Ltd. All rights reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+#  * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  * See the License for the specific language governing permissions and
+#  * limitations under the License.
+
+import contextlib
+import errno
+import fcntl
+import hashlib
+import json
+import math
+import os
+import time
+import uuid
+
+from cloudify import exceptions as cfy_exc
+
+# requests wait for their turn instead of failing, up to this time
+DEFAULT_WAIT_TIMEOUT = 10 * 60
+WAIT_MIN_INTERVAL = 0.05
+WAIT_MAX_INTERVAL = 1
+# slot of request in flight is dropped if its process died
+IN_FLIGHT_TTL = 10 * 60
+# pause of all requests when vCloud answers 'Too Many Requests'
+# without Retry-After
+DEFAULT_THROTTLE_PAUSE = 1
+
+
+def governor_key(cfg):
+    """
+        identity of vCloud organization for config with url and org
+    """
+    values = [unicode(cfg.get(field) or '') for field in ('url', 'org')]
+    return hashlib.sha1(u'\n'.join(values).encode('utf-8')).hexdigest()
+
+
+class RequestGovernor(object):
+    """
+        token bucket rate limit and limit of requests in flight for one
+        vCloud organization, shared by all processes on the manager
+        through state file locked with flock. Request that exceeds the
+        limits waits for its turn.
+    """
+
+    STORE_PATH_ENV_VAR = 'VCLOUD_RATE_LIMIT_PATH'
+    STORE_PATH_DEFAULT = '~/.vcloud_rate_limit'
+
+    def __init__(self, key, path=None, rate=None, burst=None,
+                 max_in_flight=None, timeout=DEFAULT_WAIT_TIMEOUT):
+        if not path:
+            default_location = os.path.expanduser(self.STORE_PATH_DEFAULT)
+            path = os.getenv(self.STORE_PATH_ENV_VAR, default_location)
+        self.path = os.path.expanduser(path)
+        self.key = key
+        # requests per second, burst is size of bucket
+        self.rate = rate
+        self.burst = burst or max(rate or 0, 1)
+        self.max_in_flight = max_in_flight
+        self.timeout = timeout
+        self.requests = 0
+        self.waits = 0
+        self.waited = 0
+
+    @contextlib.contextmanager
+    def request(self):
+        """
+            wait for turn of request, slot in flight is held until exit
+        """
+        slot = self.acquire()
+        try:
+            yield
+        finally:
+            self.release(slot)
+
+    def acquire(self):
+        """
+            take token and slot in flight, return id of the slot
+        """
+        started = time.time()
+        waited = False
+        while True:
+            with self._state() as state:
+                now = time.time()
+                wait = self._take(state, now)
+                if not wait:
+                    slot = uuid.uuid4().hex
+                    state['in_flight'][slot] = now + IN_FLIGHT_TTL
+                    break
+            if now + wait - started > self.timeout:
+                # operation is retried by cloudify when limits allow it
+                raise cfy_exc.RecoverableError(
+                    "vCloud request was not allowed by rate limit in {0} "
+                    "seconds".format(self.timeout),
+                    retry_after=max(int(math.ceil(wait)), 1))
+            waited = True
+            time.sleep(min(max(wait, WAIT_MIN_INTERVAL), WAIT_MAX_INTERVAL))
+        self.requests += 1
+        if waited:
+            self.waits += 1
+            self.waited += time.time() - started
+        return slot
+
+    def release(self, slot):
+        with self._state() as state:
+            state['in_flight'].pop(slot, None)
+
+    def throttle(self, pause=None):
+        """
+            vCloud throttled request, hold all requests for pause seconds
+        """
+        if pause is None:
+            pause = DEFAULT_THROTTLE_PAUSE
+        with self._state() as state:
+            state['paused'] = max(state.get('paused', 0), time.time() + pause)
+            state['tokens'] = 0
+
+    def stats(self):
+        return {
+            'requests': self.requests,
+            'waits': self.waits,
+            'waited': self.waited
+        }
+
+    def _take(self, state, now):
+        """
+            take token if request can be sent now and return 0,
+            otherwise return seconds to wait
+        """
+        if self.rate:
+            elapsed = max(now - state.get('updated', now), 0)
+            state['tokens'] = min(
+                state.get('tokens', self.burst) + elapsed * self.rate,
+                self.burst)
+        state['updated'] = now
+        in_flight = state['in_flight']
+        for slot, expires in in_flight.items():
+            if expires < now:
+                del in_flight[slot]
+        if state.get('paused', 0) > now:
+            return state['paused'] - now
+        if self.max_in_flight and len(in_flight) >= self.max_in_flight:
+            return WAIT_MIN_INTERVAL
+        if self.rate:
+            if state['tokens'] < 1:
+                return (1 - state['tokens']) / self.rate
+            state['tokens'] -= 1
+        return 0
+
+    @contextlib.contextmanager
+    def _state(self):
+        """
+            state of the organization under exclusive lock, changes are
+            written back on exit
+        """
+        if not os.path.isdir(self.path):
+            try:
+                os.makedirs(self.path, 0o700)
+            except OSError as e:
+                if e.errno != errno.EEXIST:
+                    raise
+        fd = os.open(os.path.join(self.path, self.key + '.json'),
+                     os.O_RDWR | os.O_CREAT, 0o600)
+        with os.fdopen(fd, 'r+') as state_file:
+            fcntl.flock(state_file, fcntl.LOCK_EX)
+            try:
+                try:
+                    state = json.loads(state_file.read() or '{}')
+                except ValueError:
+                    state = {}
+                state.setdefault('in_flight', {})
+                yield state
+                state_file.seek(0)
+                state_file.truncate()
+                json.dump(state, state_file)
+                state_file.flush()
+            finally:
+                fcntl.flock(state_file, fcntl.LOCK_UN)
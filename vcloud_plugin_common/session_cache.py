@@ -0,0 +1,117 @@
+# Copyright (c) 2014 GigaSpaces Technologies Ltd. All rights reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+#  * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  * See the License for the specific language governing permissions and
+#  * limitations under the License.
+
+import binascii
+import hashlib
+import hmac
+import json
+import os
+import tempfile
+import time
+
+# vCloud Director drops idle sessions after 30 minutes by default
+DEFAULT_SESSION_TTL = 20 * 60
+SESSION_KEY_FIELDS = ('url', 'service_type', 'service', 'org', 'instance',
+                      'username')
+CREDENTIAL_FIELDS = ('password', 'token')
+CREDENTIAL_HASH_ROUNDS = 10000
+
+
+def credential_hash(cfg, salt):
+    """
+        salted hash of password and token of config
+    """
+    values = [unicode(cfg.get(field) or '') for field in CREDENTIAL_FIELDS]
+    return binascii.hexlify(hashlib.pbkdf2_hmac(
+        'sha256', u'\n'.join(values).encode('utf-8'), str(salt),
+        CREDENTIAL_HASH_ROUNDS))
+
+
+class SessionCache(object):
+    """
+        keeps vCloud session tokens on disk, so operations running in
+        different processes can reuse a login instead of repeating it
+    """
+
+    CACHE_PATH_ENV_VAR = 'VCLOUD_SESSION_CACHE_PATH'
+    CACHE_PATH_DEFAULT = '~/.vcloud_sessions'
+
+    def __init__(self, path=None, ttl=DEFAULT_SESSION_TTL):
+        if not path:
+            default_location = os.path.expanduser(self.CACHE_PATH_DEFAULT)
+            path = os.getenv(self.CACHE_PATH_ENV_VAR, default_location)
+        self.path = os.path.expanduser(path)
+        self.ttl = ttl
+
+    @staticmethod
+    def key(cfg):
+        """
+            hash of the config values that identify a session,
+            credentials are not part of the key, load checks them
+        """
+        values = [unicode(cfg.get(field) or '')
+                  for field in SESSION_KEY_FIELDS]
+        return hashlib.sha1(u'\n'.join(values).encode('utf-8')).hexdigest()
+
+    def load(self, key, cfg):
+        """
+            return cached session or None if absent or expired, or if
+            it was stored with other credentials than those of cfg
+        """
+        try:
+            with open(self._file_name(key)) as f:
+                session = json.load(f)
+        except (IOError, ValueError):
+            return None
+        if session.get('expires', 0) < time.time():
+            self.drop(key)
+            return None
+        # session of the same user logged in with other password or
+        # token is kept for its owner
+        if not hmac.compare_digest(
+                str(session.get('credential_hash', '')),
+                credential_hash(cfg, session.get('salt', ''))):
+            return None
+        return session
+
+    def store(self, key, session, cfg):
+        """
+            save session logged in with credentials of cfg
+        """
+        if not os.path.isdir(self.path):
+            os.makedirs(self.path, 0o700)
+        session = dict(session)
+        session['expires'] = time.time() + self.ttl
+        session['salt'] = binascii.hexlify(os.urandom(16))
+        session['credential_hash'] = credential_hash(cfg, session['salt'])
+        # write to temporary file (created with 0600 mode) and rename it,
+        # so concurrent readers never see partially written session
+        fd, tmp_name = tempfile.mkstemp(dir=self.path)
+        try:
+            with os.fdopen(fd, 'w') as f:
+                json.dump(session, f)
+            os.rename(tmp_name, self._file_name(key))
+        except (IOError, OSError):
+            if os.path.exists(tmp_name):
+                os.remove(tmp_name)
+            raise
+
+    def drop(self, key):
+        try:
+            os.remove(self._file_name(key))
+        except OSError:
+            pass
+
+    def _file_name(self, key):
+        return os.path.join(self.path, key + '.json')
@@ -0,0 +1,206 @@
+# Copyright (c) 2014 GigaSpaces Technologies Ltd. All rights reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+#  * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  * See the License for the specific language governing permissions and
+#  * limitations under the License.
+
+import threading
+
+import pyvcloud
+import requests
+from requests.adapters import HTTPAdapter
+
+DEFAULT_POOL_CONNECTIONS = 4
+DEFAULT_POOL_MAXSIZE = 16
+# requests throttled by vCloud are repeated after pause
+THROTTLE_RETRIES = 5
+# headers with session token of vCloud Air and vCloud Director
+AUTH_HEADERS = ('x-vcloud-authorization', 'x-vchs-authorization',
+                'Authorization')
+
+_transport = None
+_transport_lock = threading.Lock()
+
+
+class GovernedSession(requests.Session):
+    """
+        session that sends requests through governor of vCloud
+        organization, if there is one, and repeats requests throttled
+        by vCloud instead of failing; governor is looked up for each
+        request by its headers with get_governor
+    """
+
+    def __init__(self, get_governor=None):
+        super(GovernedSession, self).__init__()
+        self.get_governor = get_governor or (lambda headers: None)
+
+    def request(self, method, url, **kwargs):
+        governor = self.get_governor(kwargs.get('headers'))
+        if governor is None:
+            return super(GovernedSession, self).request(method, url,
+                                                        **kwargs)
+        for attempt in xrange(THROTTLE_RETRIES + 1):
+            with governor.request():
+                response = super(GovernedSession, self).request(
+                    method, url, **kwargs)
+            if (response.status_code != requests.codes.too_many_requests
+                    or attempt == THROTTLE_RETRIES):
+                return response
+            governor.throttle(_retry_after(response))
+
+
+def _retry_after(response):
+    try:
+        return float(response.headers.get('Retry-After'))
+    except (TypeError, ValueError):
+        return None
+
+
+class Transport(object):
+    """
+        keep-alive HTTP session with connection pool, shared by all
+        vCloud requests of the process: pyvcloud calls, task polling
+        and direct REST calls of the plugin
+    """
+
+    def __init__(self, pool_connections=DEFAULT_POOL_CONNECTIONS,
+                 pool_maxsize=DEFAULT_POOL_MAXSIZE):
+        self.pool_connections = pool_connections
+        self.pool_maxsize = pool_maxsize
+        self.adapter = HTTPAdapter(pool_connections=pool_connections,
+                                   pool_maxsize=pool_maxsize)
+        self.session = GovernedSession(self.get_governor)
+        self.session.mount('https://', self.adapter)
+        self.session.mount('http://', self.adapter)
+        self.inventory_store = None
+        # governor_key of organization -> RequestGovernor
+        self.governors = {}
+        # session token -> scope (organization and user) of requests
+        self._scopes = {}
+        # session token -> governor_key of organization
+        self._governor_keys = {}
+        self._lock = threading.Lock()
+
+    def register_session(self, tokens, scope, governor_key=None):
+        """
+            requests with any of session tokens belong to scope and go
+            through governor with governor_key, if there is one
+        """
+        with self._lock:
+            for token in tokens:
+                self._scopes[token] = scope
+                self._governor_keys[token] = governor_key
+
+    def set_governor(self, governor):
+        """
+            governor for requests of sessions of its organization
+        """
+        with self._lock:
+            self.governors[governor.key] = governor
+
+    def get_scope(self, headers):
+        """
+            scope of request with headers, None for requests without
+            registered session
+        """
+        return _find_by_token(self._scopes, headers)
+
+    def get_governor(self, headers):
+        """
+            governor of organization of request with headers, None for
+            requests without registered session or without limits
+        """
+        key = _find_by_token(self._governor_keys, headers)
+        return self.governors.get(key) if key else None
+
+    # the same signatures as module level functions of requests
+    def get(self, url, **kwargs):
+        scope = self.get_scope(kwargs.get('headers'))
+        if (self.inventory_store is None or kwargs.get('params')
+                or scope is None):
+            return self.session.get(url, **kwargs)
+        return self.inventory_store.fetch(self.session, url, scope, **kwargs)
+
+    def post(self, url, data=None, json=None, **kwargs):
+        self._invalidate(url)
+        return self.session.post(url, data=data, json=json, **kwargs)
+
+    def put(self, url, data=None, **kwargs):
+        self._invalidate(url)
+        return self.session.put(url, data=data, **kwargs)
+
+    def delete(self, url, **kwargs):
+        self._invalidate(url)
+        return self.session.delete(url, **kwargs)
+
+    def _invalidate(self, url):
+        if self.inventory_store is not None:
+            self.inventory_store.invalidate(url)
+
+    def install(self):
+        """
+            route pyvcloud requests through this transport, pyvcloud.Http
+            calls module level functions of 'requests' imported in pyvcloud
+        """
+        pyvcloud.requests = self
+
+    def stats(self):
+        """
+            return pool size and connection reuse counters, requests
+            that did not open new connection reused pooled one
+        """
+        pools = self.adapter.poolmanager.pools
+        connections = 0
+        requests_count = 0
+        hosts = 0
+        for key in pools.keys():
+            pool = pools.get(key)
+            if pool is None:
+                continue
+            hosts += 1
+            connections += pool.num_connections
+            requests_count += pool.num_requests
+        stats = {
+            'pool_maxsize': self.pool_maxsize,
+            'hosts': hosts,
+            'connections': connections,
+            'requests': requests_count,
+            'reused': requests_count - connections
+        }
+        if self.inventory_store is not None:
+            stats['inventory_store'] = self.inventory_store.stats()
+        if self.governors:
+            stats['governors'] = dict(
+                (key, governor.stats())
+                for key, governor in self.governors.items())
+        return stats
+
+
+def _find_by_token(values, headers):
+    for name in AUTH_HEADERS:
+        token = (headers or {}).get(name)
+        if token and token in values:
+            return values[token]
+    return None
+
+
+def get_transport(pool_connections=DEFAULT_POOL_CONNECTIONS,
+                  pool_maxsize=DEFAULT_POOL_MAXSIZE):
+    """
+        return transport of the process, pool settings are used
+        only when transport is created
+    """
+    global _transport
+    with _transport_lock:
+        if _transport is None:
+            _transport = Transport(pool_connections, pool_maxsize)
+            _transport.install()
+        return _transport
@@ -0,0 +1,194 @@
+# Copyright (c) 2014 GigaSpaces Technologies Ltd. All rights reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+#  * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  * See the License for the specific language governing permissions and
+#  * limitations under the License.
+
+import contextlib
+import errno
+import fcntl
+import hashlib
+import json
+import os
+import tempfile
+import time
+import uuid
+
+# results not read by their owners are removed after a day
+RESULT_TTL = 24 * 60 * 60
+
+STATUS_SUCCESS = 'success'
+STATUS_BUSY = 'busy'
+STATUS_ERROR = 'error'
+
+
+def scope_key(cfg, *names):
+    """
+        identity of named resource of vdc for config with url, org and
+        vdc
+    """
+    values = [unicode(cfg.get(field) or '')
+              for field in ('url', 'org', 'vdc')]
+    values.extend(unicode(name) for name in names)
+    return hashlib.sha1(u'\n'.join(values).encode('utf-8')).hexdigest()
+
+
+class WorkQueue(object):
+    """
+        on disk queue of work items for a scope (e.g. edge gateway),
+        shared by operations of all processes on the manager. Each
+        operation adds its item to pending ones of the scope, operation
+        that holds lock of the scope handles all pending items at once
+        and writes result for each of them.
+    """
+
+    STORE_PATH_ENV_VAR = 'VCLOUD_WORK_QUEUE_PATH'
+    STORE_PATH_DEFAULT = '~/.vcloud_work_queue'
+
+    def __init__(self, path=None):
+        if not path:
+            default_location = os.path.expanduser(self.STORE_PATH_DEFAULT)
+            path = os.getenv(self.STORE_PATH_ENV_VAR, default_location)
+        self.path = os.path.expanduser(path)
+
+    def add(self, key, item):
+        """
+            add item to pending ones, return its id; ids are ordered by
+            time of adding
+        """
+        item_id = "{0:017.6f}-{1}".format(time.time(), uuid.uuid4().hex)
+        self._write(self._dir(key, 'pending'), item_id, item)
+        return item_id
+
+    def pending(self, key):
+        """
+            list of (id, item) for all pending items in order of adding
+        """
+        directory = self._dir(key, 'pending')
+        result = []
+        for name in sorted(os.listdir(directory)):
+            if not name.endswith('.json'):
+                continue
+            item_id = name[:-len('.json')]
+            item = self._read(directory, item_id)
+            if item is not None:
+                result.append((item_id, item))
+        return result
+
+    def complete(self, key, item_ids, status, message=None):
+        """
+            save result for items and remove them from pending
+        """
+        pending = self._dir(key, 'pending')
+        done = self._dir(key, 'done')
+        for item_id in item_ids:
+            self._write(done, item_id,
+                        {'status': status, 'message': message})
+            self._remove(pending, item_id)
+        self._prune(done)
+
+    def result(self, key, item_id):
+        """
+            result for item, None if it is still pending; result is
+            removed when it is read
+        """
+        done = self._dir(key, 'done')
+        result = self._read(done, item_id)
+        if result is not None:
+            self._remove(done, item_id)
+        return result
+
+    def discard(self, key, item_id):
+        self._remove(self._dir(key, 'pending'), item_id)
+
+    @contextlib.contextmanager
+    def lock(self, key):
+        """
+            try to get exclusive lock of scope, yield True if lock is
+            taken, False if it is held by other process
+        """
+        lock_file = open(os.path.join(self._dir(key), 'lock'), 'a')
+        try:
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except IOError as e:
+                if e.errno not in (errno.EAGAIN, errno.EACCES):
+                    raise
+                yield False
+                return
+            try:
+                yield True
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+        finally:
+            lock_file.close()
+
+    @contextlib.contextmanager
+    def planning(self, key):
+        """
+            exclusive lock for planning of items, operations that take
+            free resources of scope (e.g. ports of gateway) plan their
+            items and add them to queue one by one
+        """
+        lock_file = open(os.path.join(self._dir(key), 'planning'), 'a')
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+        finally:
+            lock_file.close()
+
+    def _dir(self, key, *parts):
+        directory = os.path.join(self.path, key, *parts)
+        if not os.path.isdir(directory):
+            try:
+                os.makedirs(directory, 0o700)
+            except OSError as e:
+                if e.errno != errno.EEXIST:
+                    raise
+        return directory
+
+    def _write(self, directory, item_id, value):
+        # rename of complete file, readers never see partial content
+        fd, tmp_name = tempfile.mkstemp(dir=directory, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'w') as f:
+                json.dump(value, f)
+            os.rename(tmp_name, os.path.join(directory, item_id + '.json'))
+        except (IOError, OSError):
+            if os.path.exists(tmp_name):
+                os.remove(tmp_name)
+            raise
+
+    def _read(self, directory, item_id):
+        try:
+            with open(os.path.join(directory, item_id + '.json')) as f:
+                return json.load(f)
+        except (IOError, ValueError):
+            return None
+
+    def _remove(self, directory, item_id):
+        try:
+            os.remove(os.path.join(directory, item_id + '.json'))
+        except OSError:
+            pass
+
+    def _prune(self, directory):
+        expired = time.time() - RESULT_TTL
+        for name in os.listdir(directory):
+            file_name = os.path.join(directory, name)
+            try:
+                if os.path.getmtime(file_name) < expired:
+                    os.remove(file_name)
+            except OSError:
+                pass